@@ -4,6 +4,14 @@ import sys
 sys.path.insert(0, '../utils/')
 from utils import execute_query_connection_established
 from utils import parse_text_spectra_return_pairs
+from utils import split_stored_spectrum_clusters
+from utils import convert_stored_spectrum_to_text
+sys.path.insert(0, '../pre_db_pipeline/pycutter_step_1/')
+from alignment_tables import is_alignment_arrow
+from alignment_tables import read_alignment_arrow
+from alignment_tables import read_alignment_run_metadata
+from alignment_tables import write_alignment_tables
+from alignment_tables import pycutter_header_row_values
 import sqlalchemy
 import spectral_entropy
 
@@ -86,6 +94,7 @@ def select_candidate_bins(
     (adduct="{transient_adduct}") AND
     ((consensus_mz>{mz_min}) AND (consensus_mz<{mz_max})) AND
     ((consensus_rt>{rt_min}) AND (consensus_rt<{rt_max}))
+    order by bin_id
     '''
     bins_reply=execute_query_connection_established(a_database_connection,query)
     if bins_reply=='no results found':
@@ -98,6 +107,77 @@ def select_candidate_bins(
     return bins_df
 
 
+def build_candidate_bin_index(a_database_connection,ion_mode):
+    '''
+    loads every bin that select_candidate_bins could ever return (valid for autocuration, this polarity)
+    once, and splits them by adduct. within an adduct the bins are sorted by consensus_mz
+    so that the mz window is two binary searches. returns {adduct: (bins_df, sorted mz array, rt array)}
+    '''
+    query=f'''PRAGMA table_info(bins)'''
+    bins_column_reply=execute_query_connection_established(a_database_connection,query)
+    bin_columns=[element[1] for element in bins_column_reply]
+
+    query=f'''
+    select * from bins
+    where
+    (valid_for_autocuration=1) AND
+    (polarity="{ion_mode}")
+    order by
+    bin_id'''
+    bins_reply=execute_query_connection_established(a_database_connection,query)
+    if bins_reply=='no results found':
+        bins_reply=list()
+    bins_df=pd.DataFrame.from_records(
+        data=bins_reply,
+        columns=bin_columns
+    )
+    #null mz or rt can never fall inside a window, same as in sql
+    bins_df=bins_df.loc[bins_df['consensus_mz'].notna() & bins_df['consensus_rt'].notna()]
+
+    candidate_bin_index=dict()
+    for temp_adduct,temp_df in bins_df.groupby('adduct',sort=False):
+        temp_df=temp_df.sort_values(by='consensus_mz',kind='stable')
+        candidate_bin_index[temp_adduct]=(
+            temp_df,
+            temp_df['consensus_mz'].to_numpy(dtype=float),
+            temp_df['consensus_rt'].to_numpy(dtype=float)
+        )
+    return candidate_bin_index
+
+def select_candidate_bins_from_index(
+    candidate_bin_index,
+    transient_adduct,
+    transient_mz,
+    transient_rt,
+    mz_tolerance,
+    rt_tolerance
+):
+    '''
+    the same rows as select_candidate_bins, found with binary search on the mz of the in-memory index.
+    rows come back in bin_id order with a fresh 0..n index, like select_candidate_bins gives them
+    '''
+    if transient_adduct not in candidate_bin_index:
+        return 'no results found'
+    bins_df,sorted_mz,rt_array=candidate_bin_index[transient_adduct]
+
+    mz_min=transient_mz-mz_tolerance
+    mz_max=transient_mz+mz_tolerance
+    rt_min=transient_rt-rt_tolerance
+    rt_max=transient_rt+rt_tolerance   
+
+    #strict inequalities on both ends, like the sql
+    window_start=np.searchsorted(sorted_mz,mz_min,side='right')
+    window_end=np.searchsorted(sorted_mz,mz_max,side='left')
+    window_rt=rt_array[window_start:window_end]
+    in_rt_window=(window_rt>rt_min) & (window_rt<rt_max)
+    if not in_rt_window.any():
+        return 'no results found'
+
+    candidate_bins_df=bins_df.iloc[window_start:window_end].loc[in_rt_window]
+    candidate_bins_df=candidate_bins_df.sort_values(by='bin_id').reset_index(drop=True)
+    return candidate_bins_df
+
+
 #can refactor as an apply if desired once we see what columns we weant
 #expect a 4x speedup compared to iterrows
 def autocurate_transient_bins(
@@ -109,9 +189,12 @@ def autocurate_transient_bins(
     mz_tolerance,
     rt_tolerance,
     ms2_tolerance,
-    output_panda
+    output_panda,
+    candidate_bin_index=None
 ):
     '''
+    if a candidate_bin_index (build_candidate_bin_index) is given, candidates are looked up in memory
+    instead of with one select_candidate_bins query per transient bin
     '''
 
     
@@ -134,15 +217,25 @@ def autocurate_transient_bins(
             transient_bins_panda.at[transient_bin_id,'matching_bins_text']='not valid for autocuration'
             continue
         
-        candidate_bins_df=select_candidate_bins(
-            database_connection,
-            ion_mode,
-            series['adduct'],
-            series['consensus_mz'],
-            series['consensus_rt'],
-            mz_tolerance,
-            rt_tolerance
-        )
+        if candidate_bin_index is not None:
+            candidate_bins_df=select_candidate_bins_from_index(
+                candidate_bin_index,
+                series['adduct'],
+                series['consensus_mz'],
+                series['consensus_rt'],
+                mz_tolerance,
+                rt_tolerance
+            )
+        else:
+            candidate_bins_df=select_candidate_bins(
+                database_connection,
+                ion_mode,
+                series['adduct'],
+                series['consensus_mz'],
+                series['consensus_rt'],
+                mz_tolerance,
+                rt_tolerance
+            )
         english_name=series['english_name']
         transient_bin_id=series['bin_id']
         #print(f'we are trying to curate {english_name} which has transient bin_id {transient_bin_id}')
@@ -168,7 +261,8 @@ def autocurate_transient_bins(
             #candidate_bins_df=pd.concat([candidate_bins_df,new_columns_panda],axis='columns')
 
             candidate_bins_df['avg_similarity']=weight_of_dot_product*candidate_bins_df['dot_product']+weight_of_reverse_dot_product*candidate_bins_df['reverse_dot_product']
-            candidate_bins_df.sort_values(by='avg_similarity',inplace=True,ascending=False)
+            #stable, so that tied candidates stay in bin_id order
+            candidate_bins_df.sort_values(by='avg_similarity',inplace=True,ascending=False,kind='stable')
             
             
             
@@ -178,10 +272,14 @@ def autocurate_transient_bins(
             #print(candidate_bins_df.columns)
             #hold=input('hold')
 
-            transient_bins_panda.at[transient_bin_id,'top_match_bin_id']=candidate_bins_df.at[0,'bin_id']
-            transient_bins_panda.at[transient_bin_id,'top_match_english_name']=candidate_bins_df.at[0,'english_name']
+            #the first row after sorting is the most similar candidate
+            transient_bins_panda.at[transient_bin_id,'top_match_bin_id']=candidate_bins_df['bin_id'].iloc[0]
+            transient_bins_panda.at[transient_bin_id,'top_match_english_name']=candidate_bins_df['english_name'].iloc[0]
             transient_bins_panda.at[transient_bin_id,'matching_bins_df']=candidate_bins_df
-            temp_json=candidate_bins_df.to_json(orient='records')
+            #binary spectra are turned back into text for the json
+            temp_json=candidate_bins_df.assign(
+                consensus_spectrum=candidate_bins_df['consensus_spectrum'].map(convert_stored_spectrum_to_text)
+            ).to_json(orient='records')
             #Microsoft Excel has a character limit of 32,767 characters in each cell.
             if len(temp_json)>32000:
                 temp_json=temp_json[:32000]
@@ -202,13 +300,18 @@ def guide_auto_curation_wrapper(
         mz_tolerance,
         rt_tolerance,
         ms2_tolerance,
-        output_panda
+        output_panda,
+        use_candidate_bin_index=True
     ):
     '''
     we hae this lil mini function so that we can pseudo-vectrize (as apply) and/or multip
     rocess autocurate_transient_bins if we desire
     '''
     transient_bins_panda=select_all_bins(transient_connection,ion_mode)
+    #the main database bins are read once, rather than once per transient bin
+    candidate_bin_index=None
+    if use_candidate_bin_index==True:
+        candidate_bin_index=build_candidate_bin_index(database_connection,ion_mode)
     #database_bins_panda=select_all_bins(database_connection,ion_mode)
     print(transient_bins_panda)
     print(transient_bins_panda.columns)
@@ -221,7 +324,8 @@ def guide_auto_curation_wrapper(
         mz_tolerance,
         rt_tolerance,
         ms2_tolerance,
-        output_panda
+        output_panda,
+        candidate_bin_index
     )
     return transient_database_auto_curated_as_df
 
@@ -233,13 +337,10 @@ def get_dot_product_of_largest_clusters(transient_spectrum_text,database_spectru
     ##print(transient_spectrum_text)
     #print(database_spectrum_text)
 
-    #we send a list because thats what the util function expects, whoops.
-    candidate_spectrum=parse_text_spectra_return_pairs(
-        [transient_spectrum_text.split('@')[0]]
-    )
-    database_spectrum=parse_text_spectra_return_pairs(
-        [database_spectrum_text.split('@')[0]]
-    )
+    #we keep a list of one because thats what the util function used to return, whoops.
+    #split_stored_spectrum_clusters takes either the text or the binary format
+    candidate_spectrum=split_stored_spectrum_clusters(transient_spectrum_text)[0:1]
+    database_spectrum=split_stored_spectrum_clusters(database_spectrum_text)[0:1]
 
 
     #print(database_spectrum[0])
@@ -269,11 +370,18 @@ def get_dot_product_of_largest_clusters(transient_spectrum_text,database_spectru
     return dot_product,reverse_dot_product
 
 def read_pycutter_step_1_input(pycutter_autocurated_input_address,inserted_columns):
-    input_panda=pd.read_csv(pycutter_autocurated_input_address,sep='\t')
-    # Define 5th row as column header
-    input_panda.columns = input_panda.iloc[3]
-    #temporarily lose the top rows. we will reattach them at the end with a concatenation
-    input_panda.drop(input_panda.index[0:4], inplace=True)
+    '''
+    the features of the pycutter step 1 output with the inserted columns added.
+    an .arrow step 1 output keeps its run metadata apart, so there are no top rows to lose
+    '''
+    if is_alignment_arrow(pycutter_autocurated_input_address):
+        input_panda=read_alignment_arrow(pycutter_autocurated_input_address)[0]
+    else:
+        input_panda=pd.read_csv(pycutter_autocurated_input_address,sep='\t')
+        # Define 5th row as column header
+        input_panda.columns = input_panda.iloc[3]
+        #temporarily lose the top rows. we will reattach them at the end with a concatenation
+        input_panda.drop(input_panda.index[0:4], inplace=True)
     #print(input_panda)
     #print(input_panda.columns)
     inchikey_location=input_panda.columns.get_loc('Adduct type')
@@ -289,40 +397,18 @@ def read_pycutter_step_1_input(pycutter_autocurated_input_address,inserted_colum
     #input_panda.insert()
     return input_panda
 
-def insert_autocurations_into_pycutter_input(pycutter_input,transient_database_auto_curated_as_df,pycutter_step_1_output_address,inserted_columns):
+def insert_autocurations_into_pycutter_input(pycutter_input,transient_database_auto_curated_as_df):
     '''
-    attach the results form the transient database autocuration
-    then, attach the top 3 rows of the original pycutter step 1 output
+    attach the results form the transient database autocuration.
+    the top rows of the original pycutter step 1 output are put back when it is written (write_alignment_tables,
+    with the run metadata of the step 1 output)
 
     '''
     pycutter_input['bin_id']=transient_database_auto_curated_as_df['top_match_bin_id']
     pycutter_input['english_name']=transient_database_auto_curated_as_df['top_match_english_name']
     pycutter_input['curation_text']=transient_database_auto_curated_as_df['matching_bins_text']
 
-    temp=pd.read_csv(pycutter_step_1_output_address,sep='\t',nrows=5,header=None)
-    #print(temp)
-    #print(temp.iloc[4])
-    temp.columns = temp.iloc[4]
-    
-    
-    pycutter_input.rename({'english_name':'english_name_top_match'},axis='columns',inplace=True)
-    
-    temp.drop(list(range(5,temp.index.stop)),inplace=True,axis='index')
-    inchikey_location=temp.columns.get_loc('Adduct type')
-    for i in range(len(inserted_columns)-1,-1,-1):
-        temp.insert(loc=inchikey_location+1,column=inserted_columns[i],value=np.nan)
-    temp.rename({'english_name':'english_name_top_match'},axis='columns',inplace=True)
-    temp.iloc[4]=temp.columns
-    # print(temp.english_name)
-    # print(pycutter_input.english_name)
-    # print(temp.english_name_top_match)
-    # print(pycutter_input.english_name_top_match)
-    #print(temp.columns)
-    #print(pycutter_input.columns)
-    #hold=input('just before conczt ')
-    final_result=pd.concat([temp,pycutter_input],axis='index',ignore_index=True)
-
-    return final_result
+    return pycutter_input.rename({'english_name':'english_name_top_match'},axis='columns')
 
 if __name__=="__main__":
 
@@ -381,7 +467,13 @@ if __name__=="__main__":
     database_engine.dispose()
 
     #print(pycutter_input)
-    final_result=insert_autocurations_into_pycutter_input(pycutter_input,transient_database_auto_curated_as_df,pycutter_autocurated_input_address,inserted_columns)
-    final_result.to_csv(pycutter_autocurated_output_address,sep='\t',index=False,header=False)
+    final_result=insert_autocurations_into_pycutter_input(pycutter_input,transient_database_auto_curated_as_df)
+    #an .arrow output address is written as an .arrow directory, any other as the sheet, whichever the input was
+    write_alignment_tables(
+        final_result,
+        read_alignment_run_metadata(pycutter_autocurated_input_address),
+        pycutter_autocurated_output_address,
+        header_row_values=pycutter_header_row_values
+    )
     print(final_result)
     #we now need to merge the autocurated transient DB panda with the pycutter input panda
\ No newline at end of file
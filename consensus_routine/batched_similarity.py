@@ -0,0 +1,269 @@
+import numpy as np
+
+'''
+all-pairs dot product for the spectra of one bin, computed in a handful of numpy calls
+rather than one spectral_entropy.similarity call per pair.
+
+spectral_entropy matches peaks with a two-pointer walk (tools.match_peaks_in_spectra). walking it by hand,
+a peak b of the library spectrum is added onto the first query peak a (lowest mz) for which a-b>=-ms2_da,
+provided that a-b<=ms2_da as well. otherwise b ends up on its own. that rule only looks at one query peak and
+the one before it, so we can evaluate it for every (query peak, library peak) pair at once:
+sort every peak of the bin by mz, take all pairs inside the tolerance window, and keep a pair
+if the previous peak of the query spectrum is too far below the library peak.
+
+the dot product is then
+    sum(p*q)/sqrt(sum(p^2)*sum(q^2))
+where q of a matched query peak is the sum of every library peak that landed on it
+'''
+
+
+def flatten_spectra(spectra):
+    '''
+    receives a list of paired spectra (n_peaks x 2) and returns flat mz, intensity and spectrum index arrays
+    peaks are sorted by mz inside each spectrum, which is what the matching rule assumes.
+
+    spectral_entropy does its matching in float32, so we do the same with mz to get the same matches
+    '''
+    peak_counts=np.array([len(temp_spectrum) for temp_spectrum in spectra],dtype=np.int64)
+    spectrum_index=np.repeat(np.arange(len(spectra)),peak_counts)
+    if peak_counts.sum()==0:
+        return np.zeros(0,dtype=np.float32),np.zeros(0,dtype=np.float64),spectrum_index
+
+    all_peaks=np.concatenate(
+        [np.asarray(temp_spectrum,dtype=np.float32).reshape(-1,2) for temp_spectrum in spectra]
+    )
+    all_mz=all_peaks[:,0]
+    all_intensity=all_peaks[:,1].astype(np.float64)
+
+    within_spectrum_order=np.lexsort((all_mz,spectrum_index))
+    return all_mz[within_spectrum_order],all_intensity[within_spectrum_order],spectrum_index[within_spectrum_order]
+
+
+def accumulate_matched_peak_products(
+    all_mz,
+    all_intensity,
+    spectrum_index,
+    spectrum_count,
+    ms2_tolerance,
+    max_peak_pairs_per_chunk=5000000
+):
+    '''
+    generator. for each chunk of query peaks it yields
+        pair_keys: query_spectrum*spectrum_count+library_spectrum, one per matched peak pair
+        products: p*q of that matched peak pair, summing these per key gives the numerator
+        correction_keys,corrections: the amount that sum(q^2) changes by, for the (rare) pairs of spectra
+        where more than one library peak lands on the same query peak
+    keys repeat, the caller sums them. only pairs with query_spectrum<library_spectrum are produced,
+    which is the upper triangle that make_distance_matrix has always filled
+    '''
+    if len(all_mz)==0:
+        return
+
+    #the neighbouring peaks of the same spectrum decide whether a library peak can still land on a query peak
+    spectrum_starts=np.ones(len(all_mz),dtype=bool)
+    spectrum_starts[1:]=spectrum_index[1:]!=spectrum_index[:-1]
+    spectrum_ends=np.roll(spectrum_starts,-1)
+    previous_mz=np.roll(all_mz,1)
+    previous_mz[spectrum_starts]=-np.inf
+    next_mz=np.roll(all_mz,-1)
+    next_mz[spectrum_ends]=np.inf
+
+    global_order=np.argsort(all_mz,kind='stable')
+    globally_sorted_mz=all_mz[global_order]
+
+    #a little slack so that float32 rounding never drops a candidate. the exact test is done below
+    search_tolerance=ms2_tolerance+1e-3
+    window_starts=np.searchsorted(globally_sorted_mz,all_mz-search_tolerance,side='left')
+    window_ends=np.searchsorted(globally_sorted_mz,all_mz+search_tolerance,side='right')
+    window_sizes=window_ends-window_starts
+
+    #split the query peaks so that no chunk expands into more than max_peak_pairs_per_chunk pairs
+    cumulative_sizes=np.cumsum(window_sizes)
+    chunk_boundaries=np.searchsorted(
+        cumulative_sizes,
+        np.arange(max_peak_pairs_per_chunk,cumulative_sizes[-1],max_peak_pairs_per_chunk),
+        side='left'
+    )
+    chunk_boundaries=np.unique(np.concatenate([[0],chunk_boundaries+1,[len(all_mz)]]))
+
+    for chunk_start,chunk_end in zip(chunk_boundaries[:-1],chunk_boundaries[1:]):
+        chunk_sizes=window_sizes[chunk_start:chunk_end]
+        query_peaks=np.repeat(np.arange(chunk_start,chunk_end),chunk_sizes)
+        offsets_in_window=np.arange(chunk_sizes.sum())-np.repeat(np.cumsum(chunk_sizes)-chunk_sizes,chunk_sizes)
+        library_peaks=global_order[np.repeat(window_starts[chunk_start:chunk_end],chunk_sizes)+offsets_in_window]
+
+        query_spectra=spectrum_index[query_peaks]
+        library_spectra=spectrum_index[library_peaks]
+        query_mz=all_mz[query_peaks]
+        previous_query_mz=previous_mz[query_peaks]
+        #same comparisons, in the same precision, as match_peaks_in_spectra
+        mass_delta=query_mz-all_mz[library_peaks]
+        keep=(
+            (query_spectra<library_spectra) &
+            (mass_delta>=-ms2_tolerance) &
+            (mass_delta<=ms2_tolerance) &
+            ((previous_query_mz-all_mz[library_peaks])<-ms2_tolerance)
+        )
+        if not keep.any():
+            continue
+        query_peaks=query_peaks[keep]
+        library_peaks=library_peaks[keep]
+        query_mz=query_mz[keep]
+        previous_query_mz=previous_query_mz[keep]
+        pair_keys=query_spectra[keep]*spectrum_count+library_spectra[keep]
+        library_intensity=all_intensity[library_peaks]
+
+        #does the neighbouring library peak land on the same query peak as well
+        #(-inf minus -inf at the start of two spectra is nan, which correctly compares false)
+        with np.errstate(invalid='ignore'):
+            shares_with_previous=(
+                ((query_mz-previous_mz[library_peaks])<=ms2_tolerance) &
+                ((previous_query_mz-previous_mz[library_peaks])<-ms2_tolerance)
+            )
+        shares_with_next=(query_mz-next_mz[library_peaks])>=-ms2_tolerance
+        shared=shares_with_previous|shares_with_next
+
+        #every library peak landing on the same query peak is summed before squaring
+        merged_keys,merged_inverse=np.unique(
+            query_peaks[shared]*spectrum_count+spectrum_index[library_peaks[shared]],
+            return_inverse=True
+        )
+        merged_intensity=np.bincount(merged_inverse,weights=library_intensity[shared])
+        correction_keys=np.concatenate([
+            pair_keys[shared],
+            spectrum_index[merged_keys//spectrum_count]*spectrum_count+merged_keys%spectrum_count
+        ])
+        corrections=np.concatenate([-library_intensity[shared]**2,merged_intensity**2])
+
+        yield pair_keys,all_intensity[query_peaks]*library_intensity,correction_keys,corrections
+
+
+def make_dot_product_matrix_batched(spectra,ms2_tolerance,max_peak_pairs_per_chunk=5000000):
+    '''
+    returns the symmetric dot product matrix of a list of paired spectra.
+    entry [i][j] (i<j) is spectral_entropy.similarity(spectra[i],spectra[j],method='dot_product',...)
+    and the lower triangle is a mirror of it, exactly like the loop in make_distance_matrix.
+    the diagonal is left for the caller to set
+    '''
+    spectrum_count=len(spectra)
+    all_mz,all_intensity,spectrum_index=flatten_spectra(spectra)
+
+    numerator=np.zeros(spectrum_count*spectrum_count)
+    q_squared_correction=np.zeros(spectrum_count*spectrum_count)
+    for pair_keys,products,correction_keys,corrections in accumulate_matched_peak_products(
+        all_mz,all_intensity,spectrum_index,spectrum_count,ms2_tolerance,max_peak_pairs_per_chunk
+    ):
+        np.add.at(numerator,pair_keys,products)
+        np.add.at(q_squared_correction,correction_keys,corrections)
+
+    numerator=numerator.reshape(spectrum_count,spectrum_count)
+    q_squared_correction=q_squared_correction.reshape(spectrum_count,spectrum_count)
+    squared_norms=np.bincount(spectrum_index,weights=all_intensity**2,minlength=spectrum_count)
+
+    #row is the query spectrum, column is the library spectrum
+    denominator=np.sqrt(
+        squared_norms[:,np.newaxis]*(squared_norms[np.newaxis,:]+q_squared_correction)
+    )
+    similarity_matrix=np.zeros((spectrum_count,spectrum_count))
+    np.divide(numerator,denominator,out=similarity_matrix,where=(numerator>0)&(denominator>0))
+
+    similarity_matrix=np.triu(similarity_matrix,k=1)
+    return similarity_matrix+similarity_matrix.T
+
+
+def make_dot_products_for_pairs(
+    spectra,
+    query_spectra,
+    library_spectra,
+    ms2_tolerance,
+    max_peak_pairs_per_chunk=5000000
+):
+    '''
+    the dot product of only the requested pairs of spectra, for when scoring every pair of a bin is too much.
+    entry k is spectral_entropy.similarity(spectra[query_spectra[k]],spectra[library_spectra[k]],method='dot_product',...)
+    and agrees with make_dot_product_matrix_batched (up to the order that the products are added in).
+
+    by the matching rule a library peak can only land on one query peak, the first one at or above mz-ms2_tolerance,
+    so instead of lining up every peak against every peak we look that one up with a single searchsorted
+    (every spectrum gets its own stretch of the number line so that one search covers all of the pairs).
+    library peaks are done in chunks of at most max_peak_pairs_per_chunk, which caps the memory
+    '''
+    query_spectra=np.asarray(query_spectra,dtype=np.int64)
+    library_spectra=np.asarray(library_spectra,dtype=np.int64)
+    spectrum_count=len(spectra)
+    all_mz,all_intensity,spectrum_index=flatten_spectra(spectra)
+    dot_products=np.zeros(len(query_spectra))
+    if len(all_mz)==0 or len(query_spectra)==0:
+        return dot_products
+
+    peak_counts=np.bincount(spectrum_index,minlength=spectrum_count)
+    spectrum_starts=np.cumsum(peak_counts)-peak_counts
+    spectrum_ends=spectrum_starts+peak_counts
+    squared_norms=np.bincount(spectrum_index,weights=all_intensity**2,minlength=spectrum_count)
+
+    #mz of spectrum s lives at s*stride+mz, which is sorted because the peaks are sorted inside each spectrum.
+    #the search is done with a little slack and the exact float32 rule is checked from there on,
+    #so the right peak is the one found or at most a step or two after it
+    search_slack=1e-3
+    stride=float(all_mz.max())+2*(ms2_tolerance+search_slack)+1
+    search_keys=spectrum_index*stride+all_mz.astype(np.float64)
+
+    library_peaks_per_pair=peak_counts[library_spectra]
+    cumulative_library_peaks=np.cumsum(library_peaks_per_pair)
+    chunk_boundaries=np.searchsorted(
+        cumulative_library_peaks,
+        np.arange(max_peak_pairs_per_chunk,cumulative_library_peaks[-1],max_peak_pairs_per_chunk),
+        side='left'
+    )
+    chunk_boundaries=np.unique(np.concatenate([[0],chunk_boundaries+1,[len(query_spectra)]]))
+
+    for chunk_start,chunk_end in zip(chunk_boundaries[:-1],chunk_boundaries[1:]):
+        chunk_sizes=library_peaks_per_pair[chunk_start:chunk_end]
+        pair_ids=np.repeat(np.arange(chunk_start,chunk_end),chunk_sizes)
+        offsets_in_pair=np.arange(chunk_sizes.sum())-np.repeat(np.cumsum(chunk_sizes)-chunk_sizes,chunk_sizes)
+        library_peaks=spectrum_starts[library_spectra[pair_ids]]+offsets_in_pair
+        library_mz=all_mz[library_peaks]
+        pair_query_spectra=query_spectra[pair_ids]
+        query_ends=spectrum_ends[pair_query_spectra]
+
+        first_candidates=np.searchsorted(
+            search_keys,
+            pair_query_spectra*stride+(library_mz.astype(np.float64)-ms2_tolerance-search_slack),
+            side='left'
+        )
+        #the first query peak that passes a-b>=-ms2_tolerance, in the same precision as match_peaks_in_spectra.
+        #peaks that are still failing move one peak on, until they pass or run out of query spectrum
+        query_peaks=first_candidates
+        unresolved=np.flatnonzero(query_peaks<query_ends)
+        while len(unresolved)>0:
+            temp_fails=(all_mz[query_peaks[unresolved]]-library_mz[unresolved])<-ms2_tolerance
+            unresolved=unresolved[temp_fails]
+            query_peaks[unresolved]+=1
+            unresolved=unresolved[query_peaks[unresolved]<query_ends[unresolved]]
+
+        keep=query_peaks<query_ends
+        keep[keep]=(all_mz[query_peaks[keep]]-library_mz[keep])<=ms2_tolerance
+        pair_ids=pair_ids[keep]
+        query_peaks=query_peaks[keep]
+        library_intensity=all_intensity[library_peaks[keep]]
+
+        numerator=np.bincount(
+            pair_ids-chunk_start,weights=all_intensity[query_peaks]*library_intensity,minlength=chunk_end-chunk_start
+        )
+        #every library peak that landed on the same query peak is summed before squaring
+        merged_keys,merged_inverse=np.unique(pair_ids*len(all_mz)+query_peaks,return_inverse=True)
+        merged_intensity=np.bincount(merged_inverse,weights=library_intensity)
+        q_squared_correction=(
+            np.bincount(merged_keys//len(all_mz)-chunk_start,weights=merged_intensity**2,minlength=chunk_end-chunk_start)-
+            np.bincount(pair_ids-chunk_start,weights=library_intensity**2,minlength=chunk_end-chunk_start)
+        )
+
+        denominator=np.sqrt(
+            squared_norms[query_spectra[chunk_start:chunk_end]]*
+            (squared_norms[library_spectra[chunk_start:chunk_end]]+q_squared_correction)
+        )
+        np.divide(
+            numerator,denominator,out=dot_products[chunk_start:chunk_end],where=(numerator>0)&(denominator>0)
+        )
+
+    return dot_products
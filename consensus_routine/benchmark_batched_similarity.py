@@ -0,0 +1,92 @@
+import numpy as np
+import spectral_entropy
+import sys
+import time
+from batched_similarity import make_dot_product_matrix_batched
+
+'''
+times the looped and batched dot product matrices on synthetic bins and checks that they agree.
+the looped version is only run up to max_looped_spectra. above that its time is extrapolated
+from the time per pair, because 5000 spectra is 12.5 million similarity calls
+
+usage: python benchmark_batched_similarity.py [max_looped_spectra]
+'''
+
+
+def make_similarity_matrix_looped(spectra,ms2_tolerance):
+    '''
+    the dot product matrix the way make_distance_matrix used to make it, one spectral_entropy.similarity
+    call per pair (https://github.com/czbiohub/bucketbase/issues/16). only used here, to check and time
+    make_dot_product_matrix_batched against it
+    '''
+    similarity_matrix=np.zeros(
+        shape=(len(spectra),len(spectra))
+    )
+    for i in range(len(spectra)):
+        for j in range(i,len(spectra)):
+            similarity_matrix[i][j]=spectral_entropy.similarity(
+                spectra[i], spectra[j], 
+                method='dot_product',
+                ms2_da=ms2_tolerance,
+                need_clean_spectra=False,
+            )    
+    
+    similarity_matrix=np.triu(similarity_matrix)
+    similarity_matrix=similarity_matrix+similarity_matrix.T-np.diag(np.diag(similarity_matrix))
+    return similarity_matrix
+
+
+def make_synthetic_bin_spectra(spectrum_count,ms2_tolerance,seed=0):
+    '''
+    spectra that look like one bin: peaks drawn from a shared set of fragments with some mz jitter
+    and a few noise peaks. normalized to sum 1 and sorted by mz like clean_spectrum output
+    '''
+    rng=np.random.default_rng(seed)
+    fragment_mzs=np.sort(rng.uniform(50,500,size=40))
+    spectra=list()
+    for i in range(spectrum_count):
+        chosen_fragments=rng.choice(fragment_mzs,size=rng.integers(5,25),replace=False)
+        noise_peaks=rng.uniform(50,500,size=rng.integers(0,5))
+        temp_mz=np.concatenate([
+            chosen_fragments+rng.normal(0,ms2_tolerance/3,size=len(chosen_fragments)),
+            noise_peaks
+        ])
+        temp_intensity=rng.uniform(0.01,1,size=len(temp_mz))
+        temp_spectrum=np.column_stack([temp_mz,temp_intensity/temp_intensity.sum()]).astype(np.float32)
+        spectra.append(temp_spectrum[np.argsort(temp_spectrum[:,0])])
+    return spectra
+
+
+if __name__=="__main__":
+
+    ms2_tolerance=0.015
+    max_looped_spectra=500
+    if len(sys.argv)>1:
+        max_looped_spectra=int(sys.argv[1])
+
+    for spectrum_count in [50,500,5000]:
+        spectra=make_synthetic_bin_spectra(spectrum_count,ms2_tolerance)
+        pair_count=spectrum_count*(spectrum_count+1)/2
+
+        start=time.perf_counter()
+        batched_matrix=make_dot_product_matrix_batched(spectra,ms2_tolerance)
+        batched_time=time.perf_counter()-start
+
+        if spectrum_count<=max_looped_spectra:
+            start=time.perf_counter()
+            looped_matrix=make_similarity_matrix_looped(spectra,ms2_tolerance)
+            looped_time=time.perf_counter()-start
+            seconds_per_pair=looped_time/pair_count
+            np.fill_diagonal(looped_matrix,0)
+            max_difference=np.abs(looped_matrix-batched_matrix).max()
+            looped_label=f'{looped_time:.3f}s'
+        else:
+            #time per pair from the last size that we actually looped over
+            looped_time=seconds_per_pair*pair_count
+            max_difference=np.nan
+            looped_label=f'{looped_time:.3f}s (extrapolated)'
+
+        print(
+            f'{spectrum_count} spectra: looped {looped_label} batched {batched_time:.3f}s '
+            f'speedup {looped_time/batched_time:.1f}x max abs difference {max_difference}'
+        )
@@ -0,0 +1,47 @@
+import numpy as np
+import time
+from generate_consensus_spectra import generate_bin_groups
+from generate_consensus_spectra import find_bin_identities_with_x_percent_present
+from check_bin_groups import generate_bin_groups_looped
+
+'''
+times generate_bin_groups against the quadratic loop it replaced on the meaningful bins of high resolution spectra.
+that both give the same groups is checked by check_bin_groups.py
+
+usage: python benchmark_bin_groups.py
+'''
+
+
+def make_high_resolution_bin_identities(fragment_count,spectrum_count,ms2_tolerance,seed=0):
+    '''
+    bin identities (np.digitize output, like generate_consensus_spectrum) of spectra that share
+    fragment_count fragments, binned at a fine ms2_tolerance so that every fragment spreads over a few bins
+    '''
+    rng=np.random.default_rng(seed)
+    fragment_mzs=np.sort(rng.uniform(50,2000,size=fragment_count))
+    all_mz=np.concatenate([
+        np.sort(fragment_mzs+rng.normal(0,ms2_tolerance,size=fragment_count)) for i in range(spectrum_count)
+    ])
+    bins=np.arange(all_mz.min(),all_mz.max()+ms2_tolerance,ms2_tolerance)
+    return np.digitize(all_mz,bins)
+
+
+if __name__=="__main__":
+
+    bin_space_tolerance=3
+    for fragment_count in [500,2000,5000]:
+        bin_identities=make_high_resolution_bin_identities(fragment_count,20,0.001)
+        meaningful_bin_identities=find_bin_identities_with_x_percent_present(bin_identities,0.3,20)
+
+        start=time.perf_counter()
+        looped_groups=generate_bin_groups_looped(meaningful_bin_identities,bin_space_tolerance)
+        looped_time=time.perf_counter()-start
+
+        start=time.perf_counter()
+        new_groups=generate_bin_groups(meaningful_bin_identities,bin_space_tolerance)
+        new_time=time.perf_counter()-start
+
+        print(
+            f'{len(meaningful_bin_identities)} meaningful bins: looped {looped_time:.3f}s new {new_time:.4f}s '
+            f'speedup {looped_time/new_time:.0f}x same groups {list(looped_groups.items())==list(new_groups.items())}'
+        )
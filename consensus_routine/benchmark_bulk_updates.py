@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import sqlalchemy
+import sys
+import os
+import tempfile
+import time
+sys.path.insert(0, '../utils/')
+from utils import bulk_set_column_for_keys
+from utils import bulk_update_from_panda
+
+'''
+times the temp-table bulk updates (member_of_consensus on annotations, spectra on bins)
+at 10k, 100k and 1M rows on a scratch sqlite file, to check that write time grows linearly.
+the rows per second should stay roughly flat from one size to the next
+
+usage: python benchmark_bulk_updates.py [largest_size]
+'''
+
+
+def make_scratch_database(database_address,row_count):
+    '''
+    an annotations table and a bins table with row_count rows each and only the columns that we update
+    '''
+    database_engine=sqlalchemy.create_engine(f"sqlite:///{database_address}")
+    database_connection=database_engine.connect()
+    database_connection.execute('create table annotations (annotation_id INTEGER PRIMARY KEY, member_of_consensus INTEGER)')
+    database_connection.execute('create table bins (bin_id INTEGER PRIMARY KEY, valid_for_autocuration INTEGER, consensus_spectrum TEXT)')
+    with database_connection.begin():
+        database_connection.execute(
+            'insert into annotations values (?,0)',
+            [(i,) for i in range(row_count)]
+        )
+        database_connection.execute(
+            'insert into bins values (?,null,null)',
+            [(i,) for i in range(row_count)]
+        )
+    return database_engine,database_connection
+
+
+if __name__=="__main__":
+
+    largest_size=1000000
+    if len(sys.argv)>1:
+        largest_size=int(sys.argv[1])
+
+    for row_count in [size for size in [10000,100000,1000000] if size<=largest_size]:
+        database_address=os.path.join(tempfile.mkdtemp(),'benchmark_bulk_updates.db')
+        database_engine,database_connection=make_scratch_database(database_address,row_count)
+
+        #every other annotation, shuffled, like the ids that come out of many bins
+        rng=np.random.default_rng(0)
+        annotation_ids=rng.permutation(np.arange(0,row_count,2))
+        start=time.perf_counter()
+        bulk_set_column_for_keys(database_connection,'annotations','annotation_id','member_of_consensus',1,annotation_ids)
+        member_time=time.perf_counter()-start
+
+        #a quote in every spectrum, which used to break the string-built statement
+        spectra_panda=pd.DataFrame({
+            'bin_id':np.arange(row_count),
+            'valid_for_autocuration':rng.integers(0,2,row_count),
+            'consensus_spectrum':['100.0:1.0 it\'s 200.5:0.25']*row_count
+        })
+        start=time.perf_counter()
+        bulk_update_from_panda(database_connection,'bins','bin_id',spectra_panda)
+        spectra_time=time.perf_counter()-start
+
+        check=database_connection.execute(
+            'select (select sum(member_of_consensus) from annotations), (select count(*) from bins where consensus_spectrum is not null)'
+        ).fetchall()[0]
+        database_connection.close()
+        database_engine.dispose()
+        os.remove(database_address)
+
+        print(
+            f'{row_count} rows: member_of_consensus {len(annotation_ids)/member_time:.0f} rows/s '
+            f'consensus spectra {row_count/spectra_time:.0f} rows/s '
+            f'updated {check[0]} annotations and {check[1]} bins'
+        )
@@ -0,0 +1,101 @@
+import numpy as np
+import sys
+import time
+from scipy.stats import entropy
+from benchmark_batched_similarity import make_synthetic_bin_spectra
+from valid_for_autocuration_test import get_mz_range_of_bin_spectra
+from valid_for_autocuration_test import get_bin_entropy
+from generate_consensus_spectra import *
+
+'''
+per-bin time of the consensus data path (mz range, entropy and consensus spectrum of one bin)
+with the object-dtype peak arrays that we used to build, and with the float64 arrays of get_cleaned_spectra.
+the object-dtype versions below are the previous code, kept here only to time against
+
+usage: python benchmark_consensus_dtypes.py [repeats]
+'''
+
+
+def get_mz_range_of_bin_spectra_object_dtype(temp_spectra_paired):
+    temp_spectra_parallel=[np.stack(temp_spectrum,axis=1) for temp_spectrum in temp_spectra_paired]
+    all_mz_list=[spectrum[0] for spectrum in temp_spectra_parallel]
+    all_mz=np.concatenate(all_mz_list,dtype=object)
+    return all_mz.max()-all_mz.min()
+
+
+def get_bin_entropy_object_dtype(temp_spectra_paired,use_ceiling,ms2_tolerance):
+    spectra=[np.stack(temp_spectrum,axis=1) for temp_spectrum in temp_spectra_paired]
+    spectrum_count=len(spectra)
+    all_mz=np.concatenate([spectrum[0] for spectrum in spectra],dtype=object)
+    all_intensity=np.concatenate([spectrum[1] for spectrum in spectra],dtype=object)
+    bins=np.arange(all_mz.min(),all_mz.max()+ms2_tolerance,(all_mz.max()-all_mz.min())/100)
+    bin_identities=np.digitize(all_mz,bins)
+    output_intensity_list=list()
+    for i in range(len(bins)):
+        interesting_indexes=[j for j, element in enumerate(bin_identities) if (element==i)]
+        output_intensity_list.append((all_intensity[interesting_indexes].sum())/spectrum_count)
+    output_intensity_list=np.nan_to_num(output_intensity_list)
+    if use_ceiling==False:
+        return np.exp(entropy(output_intensity_list))
+    elif use_ceiling==True:
+        return np.exp(entropy(np.ceil(output_intensity_list)))
+
+
+def generate_consensus_spectrum_object_dtype(temp_spectra_paired_cleaned,ms2_tolerance,minimum_percent_present,bin_space_tolerance):
+    spectra=[np.stack(temp_spectrum,axis=1) for temp_spectrum in temp_spectra_paired_cleaned]
+    spectrum_count=len(spectra)
+    all_mz=np.concatenate([spectrum[0] for spectrum in spectra],dtype=object)
+    all_intensity=np.concatenate([spectrum[1] for spectrum in spectra],dtype=object)
+    bins=np.arange(all_mz.min(),all_mz.max()+ms2_tolerance,ms2_tolerance)
+    bin_identities=np.digitize(all_mz,bins)
+    meaningful_bin_identities=find_bin_identities_with_x_percent_present(bin_identities,minimum_percent_present,spectrum_count)
+    meaningful_bin_groupings=generate_bin_groups(meaningful_bin_identities,bin_space_tolerance)
+    average_mz_list,average_intensity_list=find_average_mz_and_intensity(
+        bin_identities,all_mz,all_intensity,meaningful_bin_groupings
+    )
+    consensus_spectrum_rennormalized=normalize_spectrum(np.array([average_mz_list,average_intensity_list]))
+    return convert_paired_spectrum_to_text(np.stack(consensus_spectrum_rennormalized,axis=1))
+
+
+def time_one_bin(spectra,ms2_tolerance,repeats,mz_range_function,entropy_function,consensus_function):
+    '''
+    the best of repeats timings of the three per-bin steps, and their outputs
+    '''
+    best_time=np.inf
+    for i in range(repeats):
+        start=time.perf_counter()
+        mz_range=mz_range_function(spectra)
+        bin_entropy=entropy_function(spectra,False,ms2_tolerance)
+        consensus_text=consensus_function(spectra,ms2_tolerance,0.3,3)
+        best_time=min(best_time,time.perf_counter()-start)
+    return best_time,(mz_range,bin_entropy,consensus_text)
+
+
+if __name__=="__main__":
+
+    repeats=3
+    if len(sys.argv)>1:
+        repeats=int(sys.argv[1])
+
+    ms2_tolerance=0.015
+    for spectrum_count in [20,100,500]:
+        #clean_spectrum hands back float32, get_cleaned_spectra widens it to float64
+        spectra_float32=make_synthetic_bin_spectra(spectrum_count,ms2_tolerance)
+        spectra_float64=[np.ascontiguousarray(temp_spectrum,dtype=np.float64) for temp_spectrum in spectra_float32]
+
+        object_time,object_output=time_one_bin(
+            spectra_float32,ms2_tolerance,repeats,
+            get_mz_range_of_bin_spectra_object_dtype,get_bin_entropy_object_dtype,generate_consensus_spectrum_object_dtype
+        )
+        float64_time,float64_output=time_one_bin(
+            spectra_float64,ms2_tolerance,repeats,
+            get_mz_range_of_bin_spectra,get_bin_entropy,generate_consensus_spectrum
+        )
+
+        print(
+            f'{spectrum_count} spectra per bin: object dtype {1000*object_time:.1f}ms float64 {1000*float64_time:.1f}ms '
+            f'speedup {object_time/float64_time:.1f}x '
+            f'same mz range {object_output[0]==float64_output[0]} '
+            f'entropy difference {abs(object_output[1]-float64_output[1]):.1e} '
+            f'same consensus {object_output[2]==float64_output[2]}'
+        )
@@ -0,0 +1,97 @@
+import numpy as np
+import sys
+import time
+from valid_for_autocuration_test import perform_hierarchical_clustering_routine
+from sparse_clustering import perform_sparse_clustering_routine
+
+'''
+compares the sparse clustering backend against the dense one (every pair scored, scipys average linkage)
+on synthetic bins made of a few compounds, then times the sparse backend on bins that are too big for the dense one.
+two clusterings agree when they split the spectra the same way (the cluster numbers themselves can differ)
+
+usage: python benchmark_sparse_clustering.py [largest_sparse_bin]
+'''
+
+
+def make_compound_bin_spectra(spectrum_count,ms2_tolerance,compound_count=6,seed=0):
+    '''
+    spectra of one bin that come from compound_count different compounds (fragment patterns),
+    with mz jitter, intensity jitter, some weak fragments missing and a few noise peaks.
+    normalized to sum 1 and sorted by mz like clean_spectrum output
+    '''
+    rng=np.random.default_rng(seed)
+    compounds=list()
+    for i in range(compound_count):
+        fragment_count=rng.integers(8,25)
+        compounds.append((
+            np.sort(rng.uniform(50,500,size=fragment_count)),
+            rng.uniform(0.05,1,size=fragment_count)**2
+        ))
+    compound_weights=rng.dirichlet(np.ones(compound_count)*2)
+
+    spectra=list()
+    for i in range(spectrum_count):
+        fragment_mzs,fragment_intensities=compounds[rng.choice(compound_count,p=compound_weights)]
+        kept=rng.random(len(fragment_mzs))>0.15*(fragment_intensities<0.2)
+        noise_count=rng.integers(0,4)
+        temp_mz=np.concatenate([
+            fragment_mzs[kept]+rng.normal(0,ms2_tolerance/4,size=kept.sum()),
+            rng.uniform(50,500,size=noise_count)
+        ])
+        temp_intensity=np.concatenate([
+            fragment_intensities[kept]*rng.uniform(0.7,1.3,size=kept.sum()),
+            rng.uniform(0.01,0.1,size=noise_count)
+        ])
+        temp_spectrum=np.column_stack([temp_mz,temp_intensity/temp_intensity.sum()])
+        spectra.append(temp_spectrum[np.argsort(temp_spectrum[:,0])])
+    return spectra
+
+
+def same_clusters(cluster_identities,other_cluster_identities):
+    '''
+    true if the two assignments put the same spectra together
+    '''
+    identity_pairs=set(zip(np.asarray(cluster_identities).tolist(),np.asarray(other_cluster_identities).tolist()))
+    return len(identity_pairs)==len(set(cluster_identities))==len(set(other_cluster_identities))
+
+
+if __name__=="__main__":
+
+    ms2_tolerance=0.015
+    mutual_distance_for_cluster=0.2
+    largest_sparse_bin=20000
+    if len(sys.argv)>1:
+        largest_sparse_bin=int(sys.argv[1])
+
+    for spectrum_count in [300,2000]:
+        agreeing_bins=0
+        for seed in range(5):
+            spectra=make_compound_bin_spectra(spectrum_count,ms2_tolerance,seed=seed)
+
+            start=time.perf_counter()
+            dense_clusters=perform_hierarchical_clustering_routine(
+                spectra,'dot_product',ms2_tolerance,mutual_distance_for_cluster,clustering_backend='dense'
+            )
+            dense_time=time.perf_counter()-start
+
+            start=time.perf_counter()
+            sparse_clusters=perform_sparse_clustering_routine(spectra,ms2_tolerance,mutual_distance_for_cluster)
+            sparse_time=time.perf_counter()-start
+
+            agreeing_bins+=same_clusters(dense_clusters,sparse_clusters)
+        print(
+            f'{spectrum_count} spectra: dense {dense_time:.2f}s sparse {sparse_time:.2f}s '
+            f'same clusters in {agreeing_bins}/5 bins'
+        )
+
+    for spectrum_count in [size for size in [10000,20000,50000] if size<=largest_sparse_bin]:
+        spectra=make_compound_bin_spectra(spectrum_count,ms2_tolerance)
+        for sparse_linkage in ['average','connected_components']:
+            start=time.perf_counter()
+            sparse_clusters=perform_sparse_clustering_routine(
+                spectra,ms2_tolerance,mutual_distance_for_cluster,sparse_linkage=sparse_linkage
+            )
+            print(
+                f'{spectrum_count} spectra: sparse {sparse_linkage} {time.perf_counter()-start:.2f}s '
+                f'{len(set(sparse_clusters))} clusters'
+            )
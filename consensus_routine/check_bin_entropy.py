@@ -0,0 +1,99 @@
+import numpy as np
+import sys
+from scipy.stats import entropy
+from generate_consensus_spectra import stack_spectra_peaks
+from spectral_features import get_intensity_histogram_of_bin_spectra
+from spectral_features import get_histogram_entropy
+
+'''
+checks that the bin entropy from the shared intensity histogram (what get_bin_entropy returns) is the value
+of the loop it replaced, with and without the ceiling, on many random bins.
+exits with an AssertionError on the first bin where they differ
+
+usage: python check_bin_entropy.py [number_of_random_cases]
+'''
+
+
+def get_bin_entropy_looped(temp_spectra_paired,use_ceiling,ms2_tolerance):
+    '''
+    first portion is same strategy as generate_consensus_spectrum
+    the second half is from find_average_mz_and_intensity
+    
+    the strategy, unlike making a consensus spectrum, is that we sum a bin and then normlize by count
+
+    if use_ceiling is true then the strategy doesnt matter
+
+    the loop that get_bin_entropy replaced. scans every peak once per histogram slice
+    '''
+    
+    spectrum_count=len(temp_spectra_paired)
+    all_mz,all_intensity=stack_spectra_peaks(temp_spectra_paired)
+    
+    bins=np.arange(all_mz.min(),
+                   all_mz.max()+ms2_tolerance,
+                  (all_mz.max()-all_mz.min())/100
+                  )
+    
+    bin_identities=np.digitize(
+        all_mz,
+        bins
+    ) 
+
+    output_intensity_list=list()
+    for i in range(len(bins)):
+        interesting_indexes=[
+            j for j, element in enumerate(bin_identities) if (element==i)
+        ]
+        interesting_intensities=all_intensity[interesting_indexes]
+        ####output_intensity_list.append(interesting_intensities.mean())
+        output_intensity_list.append((interesting_intensities.sum())/spectrum_count)
+
+    output_intensity_list=np.nan_to_num(output_intensity_list)
+    if use_ceiling==False:
+        return np.exp(entropy(output_intensity_list))
+    elif use_ceiling==True:
+        return np.exp(entropy(np.ceil(output_intensity_list)))
+
+
+def make_random_bin_spectra(rng):
+    '''
+    1-40 paired spectra sorted by mz, peaks spread over a random mz span.
+    every spectrum has at least 2 peaks so that the mz span, and the histogram step, is never 0
+    '''
+    mz_low=rng.uniform(50,500)
+    mz_span=rng.choice([0.5,20,800])
+    spectra=list()
+    for i in range(rng.integers(1,41)):
+        peak_count=rng.integers(2,30)
+        temp_spectrum=np.column_stack([
+            np.sort(rng.uniform(mz_low,mz_low+mz_span,size=peak_count)),
+            rng.uniform(0,1,size=peak_count)
+        ])
+        spectra.append(temp_spectrum)
+    return spectra
+
+
+def check_bin_entropy(number_of_random_cases,ms2_tolerance=0.015,seed=0):
+    '''
+    asserts that get_histogram_entropy(get_intensity_histogram_of_bin_spectra(...)) and get_bin_entropy_looped
+    agree on number_of_random_cases random bins
+    '''
+    rng=np.random.default_rng(seed)
+    for i in range(number_of_random_cases):
+        spectra=make_random_bin_spectra(rng)
+        for use_ceiling in [False,True]:
+            looped_entropy=get_bin_entropy_looped(spectra,use_ceiling,ms2_tolerance)
+            new_entropy=get_histogram_entropy(get_intensity_histogram_of_bin_spectra(spectra,ms2_tolerance),use_ceiling)
+            np.testing.assert_allclose(
+                new_entropy,looped_entropy,rtol=1e-12,err_msg=f'entropy differs in case {i} with use_ceiling {use_ceiling}'
+            )
+
+
+if __name__=="__main__":
+
+    number_of_random_cases=1000
+    if len(sys.argv)>1:
+        number_of_random_cases=int(sys.argv[1])
+
+    check_bin_entropy(number_of_random_cases)
+    print(f'{number_of_random_cases} random bins: same entropy')
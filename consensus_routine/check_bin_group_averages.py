@@ -0,0 +1,82 @@
+import numpy as np
+import sys
+from generate_consensus_spectra import generate_bin_groups
+from generate_consensus_spectra import find_average_mz_and_intensity
+
+'''
+checks that find_average_mz_and_intensity gives the same group means as the loop it replaced
+on many random sets of peaks and bin groups (groups overlap, and some have no peaks).
+exits with an AssertionError on the first case where they differ
+
+usage: python check_bin_group_averages.py [number_of_random_cases]
+'''
+
+
+def find_average_mz_and_intensity_looped(
+    bin_identities,
+    all_mz,
+    all_intensities,
+    meaningful_bin_groupings
+):
+    '''
+    the loop that find_average_mz_and_intensity replaced. scans every peak once per group
+    '''
+    output_mz_list=list()
+    output_intensity_list=list()
+
+    for temp_key in meaningful_bin_groupings.keys():
+        #we get a set of bin identities that we want
+        temp_bins_of_interest=meaningful_bin_groupings[temp_key]
+        #we map those bin identities to the indexes of bin_identities
+        interesting_indexes=[
+            i for i,element in enumerate(bin_identities) if (element in temp_bins_of_interest)
+        ]
+        interesting_mz=all_mz[interesting_indexes]
+        interesting_intensities=all_intensities[interesting_indexes]
+        output_mz_list.append(interesting_mz.mean())
+        output_intensity_list.append(interesting_intensities.mean())
+        
+    return output_mz_list,output_intensity_list
+
+
+def make_random_binned_peaks(rng):
+    '''
+    (bin identities, mz, intensities, bin groupings) like generate_consensus_spectrum_from_peaks has them.
+    the groupings come from a random subset of the bins, so some groups reach bins without peaks
+    '''
+    peak_count=rng.integers(1,300)
+    bin_identities=rng.integers(0,rng.integers(2,120),size=peak_count)
+    all_mz=100+bin_identities*0.01+rng.uniform(0,0.01,size=peak_count)
+    all_intensities=rng.uniform(0,1,size=peak_count)
+    meaningful_bins=rng.choice(np.unique(bin_identities),size=rng.integers(1,len(np.unique(bin_identities))+1),replace=False)
+    meaningful_bin_groupings=generate_bin_groups(meaningful_bins.tolist(),rng.choice([0,1,2,3]))
+    return bin_identities,all_mz,all_intensities,meaningful_bin_groupings
+
+
+def check_bin_group_averages(number_of_random_cases,seed=0):
+    '''
+    asserts that find_average_mz_and_intensity and find_average_mz_and_intensity_looped agree
+    (to rounding, the sums are added up in a different order) on number_of_random_cases random cases
+    '''
+    rng=np.random.default_rng(seed)
+    for i in range(number_of_random_cases):
+        bin_identities,all_mz,all_intensities,meaningful_bin_groupings=make_random_binned_peaks(rng)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            looped_mz,looped_intensities=find_average_mz_and_intensity_looped(
+                bin_identities,all_mz,all_intensities,meaningful_bin_groupings
+            )
+        new_mz,new_intensities=find_average_mz_and_intensity(
+            bin_identities,all_mz,all_intensities,meaningful_bin_groupings
+        )
+        np.testing.assert_allclose(new_mz,looped_mz,rtol=1e-12,err_msg=f'mz means differ in case {i}')
+        np.testing.assert_allclose(new_intensities,looped_intensities,rtol=1e-12,err_msg=f'intensity means differ in case {i}')
+
+
+if __name__=="__main__":
+
+    number_of_random_cases=2000
+    if len(sys.argv)>1:
+        number_of_random_cases=int(sys.argv[1])
+
+    check_bin_group_averages(number_of_random_cases)
+    print(f'{number_of_random_cases} random cases: same group means')
@@ -0,0 +1,84 @@
+import numpy as np
+import sys
+from generate_consensus_spectra import generate_bin_groups
+
+'''
+checks that generate_bin_groups gives the same groups as the loop it replaced
+(same keys in the same order, same sets) on many random bin lists.
+exits with an AssertionError on the first bin list where they differ
+
+usage: python check_bin_groups.py [number_of_random_cases]
+'''
+
+
+def generate_bin_groups_looped(bins, bin_space_tolerance):
+    '''
+    the idea is that we want to group together small clusters of bins (in case there)
+    is a spread of mz. to do this, we iterate over all of the bins. for each bin,
+    if it is very lcose to an already encountered bin, we group them. else, they are
+    put in a new, separate bin.
+    
+    #an m/z can be assigned to multiple m/z groups
+
+    the loop that generate_bin_groups replaced. compares each bin against every value of every group, so quadratic
+    '''
+    output_dict=dict()
+    for temp_bin in bins:
+        found_match=False
+        for temp_key in output_dict.keys():
+            for temp_value in output_dict[temp_key].copy():
+                if (abs(temp_bin-temp_value)<=bin_space_tolerance):
+                    output_dict[temp_key].add(temp_bin)
+                    found_match=True
+        if found_match==False:
+            output_dict[temp_bin]={temp_bin}
+    
+    for temp_key in output_dict.keys():
+        for temp_value in output_dict[temp_key].copy():
+            output_dict[temp_key].add(temp_value+1)
+            output_dict[temp_key].add(temp_value-1)
+    
+    return output_dict
+
+
+def make_random_bins(rng):
+    '''
+    a random list of bin identities: a few dense clumps plus scattered bins, in a random order,
+    sometimes with repeats and sometimes as numpy ints like np.digitize gives
+    '''
+    clump_centers=rng.integers(0,300,size=rng.integers(1,8))
+    bins=np.concatenate([
+        clump_center+rng.integers(-6,7,size=rng.integers(1,12)) for clump_center in clump_centers
+    ]+[rng.integers(0,300,size=rng.integers(0,20))])
+    if rng.random()<0.5:
+        bins=np.unique(bins)
+    if rng.random()<0.7:
+        rng.shuffle(bins)
+    if rng.random()<0.5:
+        return bins.tolist()
+    return list(bins)
+
+
+def check_bin_groups(number_of_random_cases,seed=0):
+    '''
+    asserts that generate_bin_groups and generate_bin_groups_looped agree on number_of_random_cases random bin lists
+    '''
+    rng=np.random.default_rng(seed)
+    for i in range(number_of_random_cases):
+        bins=make_random_bins(rng)
+        bin_space_tolerance=rng.choice([0,1,2,3,2.5])
+        looped_groups=generate_bin_groups_looped(bins,bin_space_tolerance)
+        new_groups=generate_bin_groups(bins,bin_space_tolerance)
+        assert list(looped_groups.items())==list(new_groups.items()),(
+            f'groupings differ for bins {bins} with bin_space_tolerance {bin_space_tolerance}'
+        )
+
+
+if __name__=="__main__":
+
+    number_of_random_cases=2000
+    if len(sys.argv)>1:
+        number_of_random_cases=int(sys.argv[1])
+
+    check_bin_groups(number_of_random_cases)
+    print(f'{number_of_random_cases} random bin lists: same groupings')
@@ -0,0 +1,187 @@
+import numpy as np
+import sqlalchemy
+import sys
+import os
+import tempfile
+import contextlib
+from consensus_wrapper import update_consensus_for_bins
+from incremental_consensus import fold_new_annotations_for_bins
+
+'''
+checks that an incremental update gives the same database as a full recluster of the same annotations.
+a scratch database gets a first study and a full update, then a second study and an incremental update.
+a second scratch database gets both studies at once and a full update. the consensus spectra, watermarks,
+sampling records and member_of_consensus of the two have to be identical.
+the bins of the second study are a mix of
+    new spectra of the compounds that the bin already has (folded)
+    a new compound, bins that go past max_consensus_contributers, bins that were sampled already (reclustered)
+    no new spectra (left alone)
+exits with an AssertionError on the first difference
+
+usage: python check_incremental_consensus.py [bin_count]
+'''
+
+max_consensus_contributers=40
+noise_level=0.03
+ms2_tolerance=0.015
+similarity_metric='dot_product'
+mutual_distance_for_cluster=0.2
+minimum_percent_present=0.3
+bin_space_tolerance=3
+sampling_strategy='stratified_by_run'
+sampling_seed=0
+
+bin_kinds=['fold','new_compound','past_the_limit','sampled_already','no_new_spectra']
+
+
+def make_scratch_database(database_address):
+    '''
+    the runs, bins and annotations tables with only the columns that the consensus update reads and writes
+    '''
+    database_engine=sqlalchemy.create_engine(f"sqlite:///{database_address}")
+    database_connection=database_engine.connect()
+    database_connection.execute('create table runs (run_id TEXT PRIMARY KEY, run_type TEXT)')
+    database_connection.execute('create table bins (bin_id INTEGER PRIMARY KEY, valid_for_autocuration INTEGER, consensus_spectrum TEXT)')
+    database_connection.execute(
+        'create table annotations (annotation_id INTEGER PRIMARY KEY, spectrum TEXT, bin_id INTEGER, member_of_consensus INTEGER, run_id TEXT)'
+    )
+    return database_engine,database_connection
+
+
+def make_compound_peaks(rng):
+    '''
+    (mz, relative intensity) of 4-12 fragments, far enough apart that no two fall in the same ms2_tolerance window
+    '''
+    peak_count=rng.integers(4,13)
+    peak_mz=np.sort(rng.choice(np.arange(50,500),size=peak_count,replace=False)+rng.uniform(0,0.5,size=peak_count))
+    return np.column_stack([peak_mz,rng.uniform(0.05,1,size=peak_count)])
+
+
+def make_spectrum_text(compound_peaks,rng):
+    '''
+    one measured spectrum of a compound: jittered mz, noisy intensities and a few peaks under the noise level
+    '''
+    peaks=compound_peaks.copy()
+    peaks[:,0]+=rng.normal(0,0.002,size=len(peaks))
+    peaks[:,1]*=rng.lognormal(0,0.15,size=len(peaks))
+    noise_peaks=np.column_stack([rng.uniform(50,500,size=3),rng.uniform(0,0.01,size=3)*peaks[:,1].max()])
+    peaks=np.concatenate([peaks,noise_peaks])
+    peaks=peaks[np.argsort(peaks[:,0])]
+    return ' '.join([f'{temp_mz:.4f}:{temp_intensity:.1f}' for temp_mz,temp_intensity in zip(peaks[:,0],peaks[:,1]*1e4)])
+
+
+def make_studies(bin_count,seed=0):
+    '''
+    the bins, runs and annotations of two studies, the annotation ids of the second above those of the first.
+    annotations are (annotation_id, spectrum, bin_id, run_id), runs are (run_id, run_type)
+    '''
+    rng=np.random.default_rng(seed)
+    runs=[[(f'study_{i}_run_{j}',('Blank' if j==0 else 'Sample')) for j in range(6)] for i in range(2)]
+    annotations=[list(),list()]
+    kinds=rng.choice(bin_kinds,size=bin_count,p=[0.6,0.1,0.1,0.1,0.1])
+    for temp_bin,temp_kind in enumerate(kinds.tolist()):
+        compounds=[make_compound_peaks(rng) for i in range(rng.integers(1,4))]
+        first_count=rng.integers(5,max_consensus_contributers//2)
+        second_count=rng.integers(1,max_consensus_contributers//2-2)
+        if temp_kind=='past_the_limit':
+            second_count=max_consensus_contributers
+        elif temp_kind=='sampled_already':
+            first_count=max_consensus_contributers+10
+        elif temp_kind=='no_new_spectra':
+            second_count=0
+
+        first_compounds=[compounds[temp_position] for temp_position in rng.integers(0,len(compounds),size=first_count)]
+        second_compounds=[compounds[temp_position] for temp_position in rng.integers(0,len(compounds),size=second_count)]
+        if temp_kind=='new_compound':
+            #enough spectra of the new compound to make a cluster of their own
+            second_compounds=second_compounds+[make_compound_peaks(rng)]*5
+
+        for i,temp_compounds in enumerate([first_compounds,second_compounds]):
+            annotations[i].extend([
+                (make_spectrum_text(temp_compound,rng),temp_bin,runs[i][rng.integers(0,6)][0]) for temp_compound in temp_compounds
+            ])
+
+    first_annotations=[(i,)+element for i,element in enumerate(annotations[0])]
+    second_annotations=[(len(first_annotations)+i,)+element for i,element in enumerate(annotations[1])]
+    return list(range(bin_count)),runs[0]+runs[1],first_annotations,second_annotations
+
+
+def insert_study(database_connection,bin_list,runs,annotations):
+    '''
+    annotations come in with member_of_consensus 0, like prepare_annotation_table_upload makes them
+    '''
+    with database_connection.begin():
+        database_connection.execute('insert or ignore into bins values (?,null,null)',[(temp_bin,) for temp_bin in bin_list])
+        database_connection.execute('insert or ignore into runs values (?,?)',runs)
+        database_connection.execute('insert into annotations values (?,?,?,0,?)',annotations)
+
+
+def update_consensus(database_connection,bin_list,incremental):
+    #the per-bin spectrum counts of the update are not what we are checking
+    with contextlib.redirect_stdout(open(os.devnull,'w')):
+        update_consensus_for_bins(
+            database_connection,bin_list,max_consensus_contributers,
+            noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance,
+            sampling_strategy=sampling_strategy,sampling_seed=sampling_seed,incremental=incremental
+        )
+
+
+def read_consensus_tables(database_connection):
+    '''
+    everything that a consensus update writes
+    '''
+    return {
+        temp_table:database_connection.execute(query).fetchall() for temp_table,query in {
+            'bins':'select * from bins order by bin_id',
+            'consensus_watermark':'select * from consensus_watermark order by bin_id',
+            'consensus_sampling':'select * from consensus_sampling order by bin_id',
+            'member_of_consensus':'select annotation_id, member_of_consensus from annotations order by annotation_id'
+        }.items()
+    }
+
+
+def check_incremental_consensus(bin_count,seed=0):
+    '''
+    asserts that the incremental update of the second study gives the same tables as a recluster of both studies.
+    returns the number of bins that were folded and the number that were reclustered
+    '''
+    bin_list,runs,first_annotations,second_annotations=make_studies(bin_count,seed)
+    scratch_directory=tempfile.mkdtemp()
+
+    incremental_engine,incremental_connection=make_scratch_database(os.path.join(scratch_directory,'incremental.db'))
+    insert_study(incremental_connection,bin_list,runs,first_annotations)
+    update_consensus(incremental_connection,bin_list,False)
+    insert_study(incremental_connection,bin_list,runs,second_annotations)
+    folded_rows,folded_watermark_rows,folded_bin_contributors,bins_to_recluster=fold_new_annotations_for_bins(
+        incremental_connection,bin_list,max_consensus_contributers,
+        noise_level,ms2_tolerance,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance,
+        sampling_strategy,sampling_seed
+    )
+    update_consensus(incremental_connection,bin_list,True)
+
+    recluster_engine,recluster_connection=make_scratch_database(os.path.join(scratch_directory,'recluster.db'))
+    insert_study(recluster_connection,bin_list,runs,first_annotations+second_annotations)
+    update_consensus(recluster_connection,bin_list,False)
+
+    incremental_tables=read_consensus_tables(incremental_connection)
+    recluster_tables=read_consensus_tables(recluster_connection)
+    for temp_table in incremental_tables.keys():
+        for incremental_row,recluster_row in zip(incremental_tables[temp_table],recluster_tables[temp_table]):
+            assert incremental_row==recluster_row,f'{temp_table} differs: {incremental_row} after the fold, {recluster_row} after the recluster'
+        assert len(incremental_tables[temp_table])==len(recluster_tables[temp_table]),f'{temp_table} has a different number of rows'
+
+    for temp_connection,temp_engine in [(incremental_connection,incremental_engine),(recluster_connection,recluster_engine)]:
+        temp_connection.close()
+        temp_engine.dispose()
+    assert len(folded_rows)>0,'no bin was folded, so nothing was checked'
+    return len(folded_rows),len(bins_to_recluster)
+
+
+if __name__=="__main__":
+
+    bin_count=200
+    if len(sys.argv)>1:
+        bin_count=int(sys.argv[1])
+
+    folded_count,reclustered_count=check_incremental_consensus(bin_count)
+    print(f'{bin_count} bins ({folded_count} folded, {reclustered_count} reclustered): same tables as a full recluster')
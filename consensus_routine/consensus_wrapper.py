@@ -3,9 +3,20 @@ import pandas as pd
 import sys
 sys.path.insert(0, '../utils/')
 from utils import execute_query_connection_established
+from utils import bulk_set_column_for_keys
+from utils import bulk_update_from_panda
+sys.path.insert(0, '../pre_db_pipeline/pycutter_step_1/')
+from alignment_tables import read_alignment_feature_rows
 from valid_for_autocuration_test import *
 from generate_mzrt_consensus import *
-import random
+from contributor_sampling import read_recorded_sampling
+from contributor_sampling import select_contributors_for_bins
+from contributor_sampling import select_spectra_for_contributors_streaming
+from contributor_sampling import record_contributor_sampling
+from incremental_consensus import fold_new_annotations_for_bins
+from incremental_consensus import make_consensus_of_clusters
+from incremental_consensus import read_last_annotation_ids
+from incremental_consensus import record_consensus_watermarks
 import sys
 
 def aquire_bin_ids_without_autocuration_status(database_connection):
@@ -41,103 +52,53 @@ def aquire_bin_ids_and_spectrum_count_without_autocuration(database_connection):
     #print(len(execute_query_connection_established(database_connection,query)))
     return [element for element in execute_query_connection_established(database_connection,query)]
    
-def set_mzrt_only(bins,value):
+def set_member_of_consensus_for_bins(database_connection,bins,value):
     '''
-    receives a set or list of bins and a 0 or 1.
+    sets member_of_consensus on every annotation of the bins, through a temp table of the bin ids
     '''
-    #actually not terible approach
-    #https://stackoverflow.com/questions/38199080/efficient-sqlite-query-based-on-list-of-primary-keys
-    #maybe a faster way would be making a table on the fly?
-    #https://stackoverflow.com/questions/51760204/unnest-or-similar-in-sqlite
-    bins_as_strings=[str(element) for element in bins]
-    total_string='\', \''.join(bins_as_strings)
-    total_string='(\''+total_string+'\')'
-
-    query=f'''UPDATE bins
-    set mzrt_only = {value}
-    where bin_id IN '''+total_string
-
-    execute_query_connection_established(database_connection,query,returns_rows=False)
-
+    bulk_set_column_for_keys(database_connection,'annotations','bin_id','member_of_consensus',value,bins)
 
-def set_autocurate_valid(bins,value):
+def set_mzrt_only(database_connection,bins,value):
     '''
     receives a set or list of bins and a 0 or 1.
     '''
-    #actually not terible approach
+    #the bins go into a temp table instead of a giant IN (...) list
     #https://stackoverflow.com/questions/38199080/efficient-sqlite-query-based-on-list-of-primary-keys
-    #maybe a faster way would be making a table on the fly?
-    #https://stackoverflow.com/questions/51760204/unnest-or-similar-in-sqlite
-    bins_as_strings=[str(element) for element in bins]
-    total_string='\', \''.join(bins_as_strings)
-    total_string='(\''+total_string+'\')'
+    bulk_set_column_for_keys(database_connection,'bins','bin_id','mzrt_only',value,bins)
 
-    query=f'''UPDATE bins
-    set valid_for_autocuration = {value}
-    where bin_id IN '''+total_string
 
-    execute_query_connection_established(database_connection,query,returns_rows=False)
+def set_autocurate_valid(database_connection,bins,value):
+    '''
+    receives a set or list of bins and a 0 or 1.
+    '''
+    bulk_set_column_for_keys(database_connection,'bins','bin_id','valid_for_autocuration',value,bins)
 
 def update_bins_with_spectra(
+    database_connection,
     dataframe
 ):
-    values_text_list='('+dataframe.bin_id.astype(str)+', '+dataframe.valid_for_autocuration.astype(str)+', \''+dataframe.consensus_spectrum+'\')'
-    values_text=',\n'.join(values_text_list.values)
-    print(values_text)
-
-    #for the life of me, i tried to rename the columns in temp table. could not get the syntax to work
-    query_string='''
-    update bins set
-        consensus_spectrum = temp_table.column3,
-        valid_for_autocuration = temp_table.column2
-    from (values
-    '''+values_text+'''
-    )as temp_table
-    where bin_id=temp_table.column1'''
-
-    execute_query_connection_established(database_connection,query_string,returns_rows=False)
-
-    # engine=sqlalchemy.create_engine(f"sqlite:///{database_connection}")
-    # connection=engine.connect()
-
-    # temp_cursor=connection.execute(query_string)
-
-    # connection.close()
-    # engine.dispose()
+    #the rows are bound as parameters through a temp table, so quotes in the spectra
+    #and binary spectra are no problem and nothing is pasted into the query text
+    bulk_update_from_panda(
+        database_connection,
+        'bins',
+        'bin_id',
+        dataframe.loc[:,['bin_id','valid_for_autocuration','consensus_spectrum']]
+    )
 
 
 def update_bins_with_mzrt(
+    database_connection,
     dataframe
 ):
-    values_text_list='('+dataframe.bin_id.astype(str)+', '+dataframe.consensus_mz.astype(str)+', '+dataframe.consensus_rt.astype(str)+')'
-    values_text=',\n'.join(values_text_list.values)
-    print(values_text)
-    # print('-----------------------------------------')
-    # print(database_connection)
-    
-
-    #for the life of me, i tried to rename the columns in temp table. could not get the syntax to work
-    query_string='''
-    update bins set
-        consensus_mz = temp_table.column2,
-        consensus_rt = temp_table.column3
-    from (values
-    '''+values_text+'''
-    )as temp_table
-    where bin_id=temp_table.column1'''
-
-
-    execute_query_connection_established(database_connection,query_string,returns_rows=False)
-    #hold=input('inspect db connect')
-    # engine=sqlalchemy.create_engine(f"sqlite:///{database_connection}")
-    # connection=engine.connect()
-
-    # temp_cursor=connection.execute(query_string)
-
-    # connection.close()
-    # engine.dispose()
+    bulk_update_from_panda(
+        database_connection,
+        'bins',
+        'bin_id',
+        dataframe.loc[:,['bin_id','consensus_mz','consensus_rt']]
+    )
 
-def guide_consensus_routine_generate(database_connection,spectrum_cutoff):
+def guide_consensus_routine_generate(database_connection,spectrum_cutoff,n_workers=1):
     
     ########get bin numbers that are new (need to be curated/checked for curation)#########
     bins_without_autocuration_status=aquire_bin_ids_without_autocuration_status(database_connection)
@@ -153,11 +114,12 @@ def guide_consensus_routine_generate(database_connection,spectrum_cutoff):
 
     ############set mzrt only property###################################################
     set_mzrt_only(
+        database_connection,
         [element[0] for element in bins_without_autocuration_non_zero_spectrum_count],
         0
     )
-    set_mzrt_only(bins_mzrt_only,1)
-    set_autocurate_valid(bins_mzrt_only,0)
+    set_mzrt_only(database_connection,bins_mzrt_only,1)
+    set_autocurate_valid(database_connection,bins_mzrt_only,0)
     ######################################################################################
 
     ####################do auto-curation################################################
@@ -177,11 +139,13 @@ def guide_consensus_routine_generate(database_connection,spectrum_cutoff):
         0.9,
         20,
         0.3,
-        3
+        3,
+        n_workers=n_workers
     )
     ######################################################################################
     
     update_bins_with_spectra(
+        database_connection,
         bins_panda_spectra
     )
 
@@ -191,27 +155,44 @@ def guide_consensus_routine_generate(database_connection,spectrum_cutoff):
     )
 
     update_bins_with_mzrt(
+        database_connection,
         bins_panda_mzrt
     )
 
-def guide_consensus_routine_update(database_connection,final_alignment_address,max_consensus_contributers,
-noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance):
+def recluster_consensus_for_bins(database_connection,bin_list,max_consensus_contributers,
+noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance,
+clustering_backend='dense',sampling_strategy='reservoir',sampling_seed=0,reuse_recorded_sampling=False):
     '''
+    clusters the (sampled) spectra of every bin in bin_list from scratch and makes their consensus spectra.
+    sets member_of_consensus and records the sampling.
+    returns (bin_id, 1, consensus spectrum) rows and (bin_id, last_annotation_id, [annotation ids of each cluster]) watermark rows
     '''
-    alignment_panda=pd.read_csv(final_alignment_address,sep='\t',skiprows=3)
-    bins_for_updating=alignment_panda['bin_id'].loc[
-        #alignment_panda['bin_id'].notna()
-            alignment_panda.bin_id.astype(str).str.isdigit()==True
-        ].astype(int).to_list()
-    print(bins_for_updating)
+    result_rows=list()
+    watermark_rows=list()
+
+    #choose up to max_consensus_contributers per bin
+    #we do this because getting the clusters from a large number of spectra (could be come 10k+)
+    #is slow. and the consensus spectra probably asymptote
+    #the choice only reads annotation and run ids, the spectra are fetched for the chosen annotations afterwards
+    recorded_sampling=None
+    if reuse_recorded_sampling==True:
+        recorded_sampling=read_recorded_sampling(database_connection,bin_list)
+    bin_contributors=select_contributors_for_bins(
+        database_connection,
+        bin_list,
+        max_consensus_contributers,
+        sampling_strategy,
+        sampling_seed,
+        recorded_sampling
+    )
+    contributor_ids=[temp_id for element in bin_contributors for temp_id in element[5]]
+    last_annotation_ids=read_last_annotation_ids(database_connection,bin_list)
 
-    result_dict={
-        'bin_id':[],
-        'valid_for_autocuration':[],
-        'consensus_spectrum':[]
-    }
+    set_member_of_consensus_for_bins(database_connection,bin_list,0)
+    update_member_of_consensus(database_connection,contributor_ids,1)
+    record_contributor_sampling(database_connection,bin_contributors)
 
-    for temp_bin in bins_for_updating:
+    for temp_bin,annotations_and_spectra in select_spectra_for_contributors_streaming(database_connection,bin_list,contributor_ids):
         #a lot of this code is borrowed form valid_for_autocurations_test
         #the difference in this method is taht we dont check whether the autocuration is valid
         #the reason for this is that we made the automatic annotation based on whether the main DB
@@ -220,70 +201,121 @@ noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_
         #frozen in time
         #so we proceed directly to clustering and consensussing
 
-
-        annotations_and_spectra=select_spectra_for_bin(database_connection,temp_bin)
-
-        # query='select * from bins limit 10'
-        # junk_test=execute_query_connection_established(database_connection,query)
-        # print(junk_test)
-        # hold=input('junk test')
-
-        temp_annotation_ids=[element[0] for element in annotations_and_spectra]
         temp_spectra_text=[element[1] for element in annotations_and_spectra]
 
-        print(len(temp_annotation_ids))
-        print('temp annotations ids length')
-
-        update_member_of_consensus(database_connection,temp_annotation_ids,0)
-
-        
-        #choose up to max_consensus_contributers randomly
-        #we do this because getting the clusters from a large number of spectra (could be come 10k+)
-        #is slow. and the consensus spectra probably asymptote
-        if len(annotations_and_spectra)>max_consensus_contributers:
-            random.shuffle(annotations_and_spectra)
-            annotations_and_spectra=annotations_and_spectra[0:max_consensus_contributers]
-            temp_annotation_ids=[element[0] for element in annotations_and_spectra]
-            temp_spectra_text=[element[1] for element in annotations_and_spectra]
-
-
         print(f'{len(temp_spectra_text)} spectra') #len(temp_spectra_text))
-        temp_spectra_paired=parse_text_spectra_return_pairs(temp_spectra_text)
-        temp_spectra_paired_cleaned=get_cleaned_spectra(temp_spectra_paired,noise_level,ms2_tolerance)
+        prepared_spectra=prepare_bin_spectra(temp_spectra_text,noise_level,ms2_tolerance)
 
+        cluster_assignments=perform_hierarchical_clustering_routine(
+            prepared_spectra.spectra,similarity_metric,ms2_tolerance,mutual_distance_for_cluster,clustering_backend
+        )
+        #count membership and make the consensus spectrum of every cluster
+        temp_result_row,temp_watermark_row=make_consensus_of_clusters(
+            temp_bin,
+            [element[0] for element in annotations_and_spectra],
+            prepared_spectra,
+            cluster_assignments,
+            last_annotation_ids[temp_bin],
+            minimum_percent_present,
+            bin_space_tolerance
+        )
+        result_rows.append(temp_result_row)
+        watermark_rows.append(temp_watermark_row)
 
-        update_member_of_consensus(database_connection,temp_annotation_ids,1)
-
+    return result_rows,watermark_rows
 
-        cluster_assignments=perform_hierarchical_clustering_routine(temp_spectra_paired_cleaned,similarity_metric,ms2_tolerance,mutual_distance_for_cluster)
-        #count membership and get cluster percent
-        cluster_assignments_sorted_by_membership,biggest_cluster_percent=get_cluster_membership_ordering(cluster_assignments)   
 
-        consensus_spectra_text=generate_consensus_spectra_text_wrapper(
-            temp_spectra_paired_cleaned,
-            cluster_assignments,
-            cluster_assignments_sorted_by_membership,
+def update_consensus_for_bins(database_connection,bins_for_updating,max_consensus_contributers,
+noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance,
+clustering_backend='dense',sampling_strategy='reservoir',sampling_seed=0,reuse_recorded_sampling=False,incremental=False):
+    '''
+    remakes the consensus spectra of bins_for_updating (see guide_consensus_routine_update) and writes them,
+    their watermarks, their sampling and member_of_consensus.
+    returns the bins whose consensus spectrum was written
+    '''
+    if incremental==True:
+        folded_rows,folded_watermark_rows,folded_bin_contributors,bins_to_recluster=fold_new_annotations_for_bins(
+            database_connection,
+            bins_for_updating,
+            max_consensus_contributers,
+            noise_level,
             ms2_tolerance,
+            mutual_distance_for_cluster,
             minimum_percent_present,
-            bin_space_tolerance
+            bin_space_tolerance,
+            sampling_strategy,
+            sampling_seed,
+            reuse_recorded_sampling
         )
-        result_dict['bin_id'].append(temp_bin)
-        #its already valid for autocuration, this changes nothing
-        result_dict['valid_for_autocuration'].append(1)
-        result_dict['consensus_spectrum'].append(consensus_spectra_text)
+        #the same member_of_consensus as a recluster sets
+        set_member_of_consensus_for_bins(database_connection,[element[0] for element in folded_bin_contributors],0)
+        update_member_of_consensus(
+            database_connection,[temp_id for element in folded_bin_contributors for temp_id in element[5]],1
+        )
+        record_contributor_sampling(database_connection,folded_bin_contributors)
+        print(f'{len(folded_rows)} bins folded, {len(bins_to_recluster)} bins reclustered')
+    else:
+        folded_rows,folded_watermark_rows,bins_to_recluster=list(),list(),bins_for_updating
+
+    reclustered_rows,reclustered_watermark_rows=recluster_consensus_for_bins(
+        database_connection,bins_to_recluster,max_consensus_contributers,
+        noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance,
+        clustering_backend,sampling_strategy,sampling_seed,reuse_recorded_sampling
+    )
 
-    bins_panda_spectra=pd.DataFrame.from_dict(result_dict)
+    bins_panda_spectra=pd.DataFrame.from_records(
+        folded_rows+reclustered_rows,
+        columns=['bin_id','valid_for_autocuration','consensus_spectrum']
+    )
 
     update_bins_with_spectra(
+        database_connection,
         bins_panda_spectra
     )
+    record_consensus_watermarks(database_connection,folded_watermark_rows+reclustered_watermark_rows)
+    return bins_panda_spectra['bin_id'].to_list()
+
 
+def guide_consensus_routine_update(database_connection,final_alignment_address,max_consensus_contributers,
+noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance,
+clustering_backend='dense',sampling_strategy='reservoir',sampling_seed=0,reuse_recorded_sampling=False,incremental=False):
+    '''
+    max_consensus_contributers=None uses every spectrum of the bin. with clustering_backend='auto' big bins then go
+    to the approximate sparse clustering backend (see perform_hierarchical_clustering_routine) instead of
+    being sampled down. the default, dense, clusters every bin exactly.
+    otherwise the contributors are sampled with sampling_strategy and sampling_seed (contributor_sampling.py)
+    and both are recorded in consensus_sampling. with reuse_recorded_sampling, bins that were sampled before
+    are sampled again with their recorded strategy and seed, which gives back the same consensus
+    as long as the bin has the same annotations.
+    with incremental, bins without annotations since their last update are left alone and new spectra
+    are folded into the existing clusters where that gives what a recluster would (incremental_consensus.py).
+    the rest are reclustered.
+    final_alignment_address is the step 2 sheet or its .arrow directory
+    '''
+    alignment_panda=read_alignment_feature_rows(final_alignment_address,3)
+    bins_for_updating=alignment_panda['bin_id'].loc[
+        #alignment_panda['bin_id'].notna()
+            alignment_panda.bin_id.astype(str).str.isdigit()==True
+        ].astype(int).to_list()
+    print(bins_for_updating)
+
+    updated_bins=update_consensus_for_bins(
+        database_connection,bins_for_updating,max_consensus_contributers,
+        noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance,
+        clustering_backend,sampling_strategy,sampling_seed,reuse_recorded_sampling,incremental
+    )
+
+    #only the bins that changed need their mz and rt again
+    bins_for_mzrt=bins_for_updating
+    if incremental==True:
+        bins_for_mzrt=updated_bins
     bins_panda_mzrt=generate_mzrt_wrapper(
         database_connection,
-        bins_for_updating
+        bins_for_mzrt
     )
 
     update_bins_with_mzrt(
+        database_connection,
         bins_panda_mzrt
     )
 
@@ -296,11 +328,19 @@ if __name__=="__main__":
     
     to_transient_for_pycutter_pipeline=sys.argv[1]
     consensus_style=sys.argv[2]
+    #optional, the number of processes used for the per-bin consensus work
+    n_workers=1
+    if len(sys.argv)>3:
+        n_workers=int(sys.argv[3])
     
 
 
     #consensus_style='generate'
+    #None clusters every spectrum of a bin (pass clustering_backend='auto' so that big bins use the sparse backend)
     max_consensus_contributers=500
+    #reservoir or stratified_by_run, recorded per bin in consensus_sampling
+    sampling_strategy='stratified_by_run'
+    sampling_seed=0
 
     noise_level=0.03
     ms2_tolerance=0.015
@@ -324,8 +364,10 @@ if __name__=="__main__":
     
 
     if consensus_style=='generate':
-        guide_consensus_routine_generate(database_connection,minimum_count_for_auto_curation_possible)
-    elif consensus_style=='update':
+        guide_consensus_routine_generate(database_connection,minimum_count_for_auto_curation_possible,n_workers)
+    elif consensus_style in ['update','update_incremental']:
+        #update_incremental only touches bins that got annotations since their last update
         final_alignment_address='../../data/BRYU005_pipeline_test/step_2_final_alignment/py_cutter_step_2_output_auto_curated.tsv'
         guide_consensus_routine_update(database_connection,final_alignment_address,max_consensus_contributers,
-        noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance)
\ No newline at end of file
+        noise_level,ms2_tolerance,similarity_metric,mutual_distance_for_cluster,minimum_percent_present,bin_space_tolerance,
+        sampling_strategy=sampling_strategy,sampling_seed=sampling_seed,incremental=(consensus_style=='update_incremental'))
\ No newline at end of file
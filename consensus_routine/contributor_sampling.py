@@ -0,0 +1,222 @@
+import numpy as np
+import sys
+sys.path.insert(0, '../utils/')
+from utils import execute_query_connection_established
+from utils import load_keys_into_temp_table
+from utils import stream_rows_grouped_by_bin
+
+'''
+chooses which annotations of a bin contribute to its consensus spectrum when a bin has more than
+max_consensus_contributers of them.
+
+the choice is made on (annotation_id, run_id) rows only, the spectra are fetched afterwards for the
+chosen annotations alone. every bin gets its own random generator, seeded from (sampling_seed, bin_id),
+and the rows come in annotation_id order, so the same seed, strategy and annotations always give the
+same contributors no matter which other bins are in the same run.
+the strategies are
+    reservoir: a uniform sample of the annotations of the bin (algorithm R)
+    stratified_by_run: every run gets an equal share of the contributors, runs with fewer annotations
+        than their share give the rest to the bigger runs. within a run the sample is uniform
+    none: every annotation contributes
+the strategy and seed used for every bin are written to the consensus_sampling table
+'''
+
+sampling_strategies=['reservoir','stratified_by_run','none']
+
+
+def add_to_reservoir(reservoir,seen_count,row,sample_size,rng):
+    '''
+    one step of algorithm R. seen_count is the number of rows offered before this one.
+    after n rows the reservoir is a uniform sample of min(n,sample_size) of them
+    '''
+    if seen_count<sample_size:
+        reservoir.append(row)
+        return
+    replaced_position=rng.integers(0,seen_count+1)
+    if replaced_position<sample_size:
+        reservoir[replaced_position]=row
+
+
+def reservoir_sample(rows,sample_size,rng):
+    '''
+    a uniform sample of sample_size of the (annotation_id, run_id) rows, in annotation_id order
+    '''
+    reservoir=list()
+    for seen_count,row in enumerate(rows):
+        add_to_reservoir(reservoir,seen_count,row,sample_size,rng)
+    return sorted(reservoir)
+
+
+def allocate_run_quotas(run_counts,sample_size):
+    '''
+    splits sample_size between runs as evenly as their annotation counts allow.
+    the smallest runs are served first and what they cannot use is shared among the rest,
+    so the quotas add up to min(sample_size, total annotations)
+    '''
+    run_quotas=dict()
+    remaining=sample_size
+    runs_by_count=sorted(run_counts.items(),key=lambda element: (element[1],element[0]))
+    for i,(temp_run,temp_count) in enumerate(runs_by_count):
+        run_quotas[temp_run]=min(temp_count,remaining//(len(runs_by_count)-i))
+        remaining-=run_quotas[temp_run]
+    return run_quotas
+
+
+def stratified_by_run_sample(rows,sample_size,rng):
+    '''
+    a sample of sample_size of the (annotation_id, run_id) rows with the runs represented equally
+    (allocate_run_quotas), in annotation_id order.
+    every run keeps a reservoir of up to sample_size rows while streaming, and the quota of each run
+    is drawn from its reservoir at the end, once the run counts are known
+    '''
+    run_reservoirs=dict()
+    run_counts=dict()
+    for row in rows:
+        temp_run=row[1]
+        if temp_run not in run_reservoirs:
+            run_reservoirs[temp_run]=list()
+            run_counts[temp_run]=0
+        add_to_reservoir(run_reservoirs[temp_run],run_counts[temp_run],row,sample_size,rng)
+        run_counts[temp_run]+=1
+
+    run_quotas=allocate_run_quotas(run_counts,sample_size)
+    output_list=list()
+    for temp_run in sorted(run_reservoirs.keys()):
+        chosen_positions=rng.choice(len(run_reservoirs[temp_run]),size=run_quotas[temp_run],replace=False)
+        output_list.extend([run_reservoirs[temp_run][temp_position] for temp_position in np.sort(chosen_positions)])
+    return sorted(output_list)
+
+
+def sample_contributors_one_bin(bin_id,rows,sample_size,sampling_strategy,sampling_seed):
+    '''
+    the annotation ids chosen out of the (annotation_id, run_id) rows of one bin
+    '''
+    rng=np.random.default_rng([sampling_seed,bin_id])
+    if (sampling_strategy=='none') or (sample_size is None):
+        chosen_rows=list(rows)
+    elif sampling_strategy=='reservoir':
+        chosen_rows=reservoir_sample(rows,sample_size,rng)
+    elif sampling_strategy=='stratified_by_run':
+        chosen_rows=stratified_by_run_sample(rows,sample_size,rng)
+    else:
+        raise ValueError(f'unknown sampling strategy {sampling_strategy}, expected one of {sampling_strategies}')
+    return [element[0] for element in chosen_rows]
+
+
+def read_recorded_sampling(database_connection,bin_list):
+    '''
+    {bin_id: (sampling_strategy, sampling_seed, max_consensus_contributers)} from the consensus_sampling table,
+    for the bins of bin_list that have been sampled before
+    '''
+    create_consensus_sampling_table(database_connection)
+    load_keys_into_temp_table(database_connection,'sampled_bins',bin_list)
+    query='''
+    select bin_id, sampling_strategy, sampling_seed, max_consensus_contributers
+    from consensus_sampling
+    inner join
+    sampled_bins
+    on consensus_sampling.bin_id=sampled_bins.key
+    '''
+    result=database_connection.execute(query).fetchall()
+    return {element[0]:(element[1],element[2],element[3]) for element in result}
+
+
+def select_contributors_for_bins(
+    database_connection,
+    bin_list,
+    max_consensus_contributers,
+    sampling_strategy='reservoir',
+    sampling_seed=0,
+    recorded_sampling=None
+):
+    '''
+    streams the (annotation_id, run_id) rows of every bin in bin_list (the same annotations as
+    select_spectra_for_bins_streaming, but without the spectra) and samples each bin.
+    recorded_sampling (see read_recorded_sampling) overrides strategy, seed and size for the bins in it,
+    which is how a rerun reproduces an earlier consensus.
+    returns a list of (bin_id, sampling_strategy, sampling_seed, max_consensus_contributers, annotation_count, chosen annotation ids)
+    '''
+    if recorded_sampling is None:
+        recorded_sampling=dict()
+
+    load_keys_into_temp_table(database_connection,'requested_bins',bin_list)
+    query=f'''
+    select annotations.bin_id, annotations.annotation_id, annotations.run_id
+    from requested_bins
+    inner join
+    annotations
+    on annotations.bin_id=requested_bins.key
+    inner join
+    runs
+    on annotations.run_id=runs.run_id
+    where (annotations.spectrum is not null) and (runs.run_type='Sample')
+    order by annotations.bin_id, annotations.annotation_id
+    '''
+    output_list=list()
+    for temp_bin,temp_rows in stream_rows_grouped_by_bin(database_connection,query,bin_list):
+        temp_strategy,temp_seed,temp_size=recorded_sampling.get(
+            temp_bin,(sampling_strategy,sampling_seed,max_consensus_contributers)
+        )
+        if temp_size is None:
+            temp_strategy='none'
+        #below the limit every strategy keeps every annotation
+        chosen_ids=sample_contributors_one_bin(temp_bin,temp_rows,temp_size,temp_strategy,temp_seed)
+        output_list.append((temp_bin,temp_strategy,temp_seed,temp_size,len(temp_rows),chosen_ids))
+    return output_list
+
+
+def select_spectra_for_contributors_streaming(database_connection,bin_list,annotation_ids):
+    '''
+    like select_spectra_for_bins_streaming, but only for the annotations in annotation_ids.
+    generator, yields (bin_id, [(annotation_id, spectrum), ...]) in ascending bin_id order
+    '''
+    load_keys_into_temp_table(database_connection,'contributor_annotations',annotation_ids)
+    query=f'''
+    select annotations.bin_id, annotations.annotation_id, annotations.spectrum
+    from contributor_annotations
+    inner join
+    annotations
+    on annotations.annotation_id=contributor_annotations.key
+    order by annotations.bin_id, annotations.annotation_id
+    '''
+    yield from stream_rows_grouped_by_bin(database_connection,query,bin_list)
+
+
+def create_consensus_sampling_table(database_connection):
+    '''
+    safe to run on a database that already has it
+    '''
+    execute_query_connection_established(
+        database_connection,
+        '''
+        CREATE TABLE IF NOT EXISTS consensus_sampling(
+            bin_id INTEGER PRIMARY KEY,
+            sampling_strategy TEXT,
+            sampling_seed INTEGER,
+            max_consensus_contributers INTEGER,
+            annotation_count INTEGER,
+            contributor_count INTEGER,
+            FOREIGN KEY (bin_id)
+                REFERENCES bins (bin_id)
+        )
+        ''',
+        returns_rows=False
+    )
+
+
+def record_contributor_sampling(database_connection,bin_contributors):
+    '''
+    writes the output of select_contributors_for_bins to the consensus_sampling table,
+    replacing whatever was recorded for those bins before
+    '''
+    create_consensus_sampling_table(database_connection)
+    if len(bin_contributors)==0:
+        return
+    with database_connection.begin():
+        database_connection.execute(
+            'insert or replace into consensus_sampling values (?,?,?,?,?,?)',
+            [
+                (int(temp_bin),temp_strategy,int(temp_seed),temp_size,temp_count,len(chosen_ids))
+                for temp_bin,temp_strategy,temp_seed,temp_size,temp_count,chosen_ids in bin_contributors
+            ]
+        )
@@ -2,6 +2,19 @@ import numpy as np
 import math
 from collections import Counter
 
+def stack_spectra_peaks(temp_spectra_paired):
+    '''
+    receives a list of paired spectra (n_peaks x 2) and returns every mz and every intensity
+    as two contiguous float64 arrays, in spectrum order.
+    this is the layout that the consensus and validity code works on (see get_cleaned_spectra)
+    '''
+    if len(temp_spectra_paired)==0:
+        return np.zeros(0),np.zeros(0)
+    all_peaks=np.concatenate(
+        [np.asarray(temp_spectrum,dtype=np.float64).reshape(-1,2) for temp_spectrum in temp_spectra_paired]
+    )
+    return np.ascontiguousarray(all_peaks[:,0]),np.ascontiguousarray(all_peaks[:,1])
+
 def generate_bin_groups(bins, bin_space_tolerance):
     '''
     the idea is that we want to group together small clusters of bins (in case there)
@@ -10,22 +23,37 @@ def generate_bin_groups(bins, bin_space_tolerance):
     put in a new, separate bin.
     
     #an m/z can be assigned to multiple m/z groups
+
+    same output as the quadratic loop it replaced (generate_bin_groups_looped in check_bin_groups.py), in linear time. bin identities are integers, so instead of
+    comparing a bin against every value of every group we look up the handful of integers within
+    bin_space_tolerance of it in a dict of {bin seen so far: keys of the groups it belongs to}.
+    a bin joins exactly the groups of its already-seen neighbours, which is what the loop does
+    (the result depends on the order of bins, so we keep that order rather than sorting)
     '''
     output_dict=dict()
+    groups_of_seen_bins=dict()
+    neighbour_offsets=range(-math.floor(bin_space_tolerance),math.floor(bin_space_tolerance)+1)
     for temp_bin in bins:
-        found_match=False
-        for temp_key in output_dict.keys():
-            for temp_value in output_dict[temp_key].copy():
-                if (abs(temp_bin-temp_value)<=bin_space_tolerance):
-                    output_dict[temp_key].add(temp_bin)
-                    found_match=True
-        if found_match==False:
+        temp_group_keys=list()
+        for temp_offset in neighbour_offsets:
+            for temp_key in groups_of_seen_bins.get(temp_bin+temp_offset,()):
+                if temp_key not in temp_group_keys:
+                    temp_group_keys.append(temp_key)
+        if len(temp_group_keys)==0:
             output_dict[temp_bin]={temp_bin}
+            temp_group_keys.append(temp_bin)
+        else:
+            for temp_key in temp_group_keys:
+                output_dict[temp_key].add(temp_bin)
+        #a repeated bin keeps its old groups (it is its own neighbour) and picks up any new ones
+        groups_of_seen_bins[temp_bin]=temp_group_keys
     
     for temp_key in output_dict.keys():
-        for temp_value in output_dict[temp_key].copy():
-            output_dict[temp_key].add(temp_value+1)
-            output_dict[temp_key].add(temp_value-1)
+        temp_group=output_dict[temp_key]
+        output_dict[temp_key]=temp_group.union(
+            [temp_value+1 for temp_value in temp_group],
+            [temp_value-1 for temp_value in temp_group]
+        )
     
     return output_dict
 
@@ -51,24 +79,52 @@ def find_average_mz_and_intensity(
     meaningful_bin_groupings
 ):
     '''
-    the idea is that we 
+    the mean mz and mean intensity of the peaks whose bin is in each group, in the key order of meaningful_bin_groupings.
+    same output as the scan per group it replaced (find_average_mz_and_intensity_looped in check_bin_group_averages.py).
+
+    groups can overlap (a bin can be in more than one group), so a bin maps to a list of groups. we keep those
+    lists in a lookup array: group_starts[bin] is where the groups of bin begin in groups_by_bin.
+    every peak is then expanded into one (peak, group) pair per group of its bin, and the sums per group are
+    a weighted bincount. the pairs stay in peak order, so each sum adds up the same numbers in the same order
+    as the mean over the subset did
     '''
-    output_mz_list=list()
-    output_intensity_list=list()
-
-    for temp_key in meaningful_bin_groupings.keys():
-        #we get a set of bin identities that we want
-        temp_bins_of_interest=meaningful_bin_groupings[temp_key]
-        #we map those bin identities to the indexes of bin_identities
-        interesting_indexes=[
-            i for i,element in enumerate(bin_identities) if (element in temp_bins_of_interest)
-        ]
-        interesting_mz=all_mz[interesting_indexes]
-        interesting_intensities=all_intensities[interesting_indexes]
-        output_mz_list.append(interesting_mz.mean())
-        output_intensity_list.append(interesting_intensities.mean())
-        
-    return output_mz_list,output_intensity_list
+    bin_identities=np.asarray(bin_identities,dtype=np.int64)
+    all_mz=np.asarray(all_mz,dtype=np.float64)
+    all_intensities=np.asarray(all_intensities,dtype=np.float64)
+    group_count=len(meaningful_bin_groupings)
+
+    #one row per (bin, group) membership
+    member_bins=np.array(
+        [temp_bin for temp_group in meaningful_bin_groupings.values() for temp_bin in temp_group],
+        dtype=np.int64
+    )
+    member_groups=np.repeat(
+        np.arange(group_count),
+        [len(temp_group) for temp_group in meaningful_bin_groupings.values()]
+    )
+    if len(member_bins)==0 or len(bin_identities)==0:
+        return [np.nan]*group_count,[np.nan]*group_count
+
+    #bins can be -1 (the +-1 widening of bin 0), so everything is shifted to start at 0
+    lowest_bin=min(member_bins.min(),bin_identities.min())
+    lookup_length=max(member_bins.max(),bin_identities.max())-lowest_bin+1
+    by_bin_order=np.argsort(member_bins,kind='stable')
+    groups_by_bin=member_groups[by_bin_order]
+    group_counts_by_bin=np.bincount(member_bins-lowest_bin,minlength=lookup_length)
+    group_starts=np.cumsum(group_counts_by_bin)-group_counts_by_bin
+
+    #expand every peak into its (peak, group) pairs
+    peak_group_counts=group_counts_by_bin[bin_identities-lowest_bin]
+    pair_peaks=np.repeat(np.arange(len(bin_identities)),peak_group_counts)
+    pair_offsets=np.arange(len(pair_peaks))-np.repeat(np.cumsum(peak_group_counts)-peak_group_counts,peak_group_counts)
+    pair_groups=groups_by_bin[np.repeat(group_starts[bin_identities-lowest_bin],peak_group_counts)+pair_offsets]
+
+    peak_counts=np.bincount(pair_groups,minlength=group_count)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        output_mz_list=np.bincount(pair_groups,weights=all_mz[pair_peaks],minlength=group_count)/peak_counts
+        output_intensity_list=np.bincount(pair_groups,weights=all_intensities[pair_peaks],minlength=group_count)/peak_counts
+
+    return output_mz_list.tolist(),output_intensity_list.tolist()
 
 def convert_paired_spectrum_to_text(spectrum_array):
     '''
@@ -94,14 +150,27 @@ def generate_consensus_spectrum(
     minimum_percent_present,
     bin_space_tolerance
 ):
-    spectra=[np.stack(temp_spectrum,axis=1) for temp_spectrum in temp_spectra_paired_cleaned]
-    
-    spectrum_count=len(spectra)
-    all_mz_list=[spectrum[0] for spectrum in spectra]
-    all_intensity_list=[spectrum[1] for spectrum in spectra]
-    all_mz=np.concatenate(all_mz_list,dtype=object)
-    all_intensity=np.concatenate(all_intensity_list,dtype=object)
-    
+    all_mz,all_intensity=stack_spectra_peaks(temp_spectra_paired_cleaned)
+    return generate_consensus_spectrum_from_peaks(
+        all_mz,
+        all_intensity,
+        len(temp_spectra_paired_cleaned),
+        ms2_tolerance,
+        minimum_percent_present,
+        bin_space_tolerance
+    )
+
+def generate_consensus_spectrum_from_peaks(
+    all_mz,
+    all_intensity,
+    spectrum_count,
+    ms2_tolerance,
+    minimum_percent_present,
+    bin_space_tolerance
+):
+    '''
+    generate_consensus_spectrum on peaks that are already stacked (stack_spectra_peaks, PreparedBinSpectra)
+    '''
     bins=np.arange(all_mz.min(),all_mz.max()+ms2_tolerance,ms2_tolerance)
     
     bin_identities=np.digitize(
@@ -1,5 +1,8 @@
+import numpy as np
 import pandas as pd
 from utils import execute_query_connection_established
+from utils import load_keys_into_temp_table
+from utils import stream_rows_grouped_by_bin
 
 def select_rts_for_bin(database_connection,bin_id):
     query=f'''
@@ -23,16 +26,143 @@ def select_mzs_for_bin(database_connection,bin_id):
     '''
     return [element[0] for element in execute_query_connection_established(database_connection,query)]
 
+def select_mzs_and_rts_for_bins_streaming(database_connection,bin_list):
+    '''
+    the same values as select_mzs_for_bin and select_rts_for_bin, but for every bin in bin_list with one query.
+    generator, yields (bin_id, mz_list, rt_list) in ascending bin_id order
+    '''
+    load_keys_into_temp_table(database_connection,'requested_bins',bin_list)
+
+    query=f'''
+    select annotations.bin_id, annotations.precursor_mz, annotations.retention_time
+    from requested_bins
+    inner join
+    annotations
+    on annotations.bin_id=requested_bins.key
+    inner join
+    runs
+    on annotations.run_id=runs.run_id
+    where (annotations.precursor_mz is not null) or (annotations.retention_time is not null)
+    order by annotations.bin_id, annotations.annotation_id
+    '''
+    for temp_bin,temp_rows in stream_rows_grouped_by_bin(database_connection,query,bin_list):
+        yield (
+            temp_bin,
+            [element[0] for element in temp_rows if element[0] is not None],
+            [element[1] for element in temp_rows if element[1] is not None]
+        )
+
+def iterate_mzs_and_rts(database_connection,bin_list,use_bulk_fetch):
+    '''
+    yields (bin_id, mz_list, rt_list) for every bin in bin_list, either from one streaming query
+    (ascending bin_id order) or from two queries per bin (bin_list order)
+    '''
+    if use_bulk_fetch==True:
+        yield from select_mzs_and_rts_for_bins_streaming(database_connection,bin_list)
+    else:
+        for temp_bin in bin_list:
+            yield temp_bin,select_mzs_for_bin(database_connection,temp_bin),select_rts_for_bin(database_connection,temp_bin)
+
+
+def summarize_column_for_bins_query(column_name,short_name):
+    '''
+    the two common table expressions that summarize one annotations column per requested bin.
+    the window functions give each value its rank, the count and the mean of its bin,
+    from which the median (middle one or two values) and the sample standard deviation follow
+    '''
+    return f'''
+    {short_name}_values as (
+        select annotations.bin_id as bin_id, annotations.{column_name} as value,
+        row_number() over (partition by annotations.bin_id order by annotations.{column_name}) as value_rank,
+        count(*) over (partition by annotations.bin_id) as value_count,
+        avg(annotations.{column_name}) over (partition by annotations.bin_id) as value_mean
+        from requested_bins
+        inner join
+        annotations
+        on annotations.bin_id=requested_bins.key
+        inner join
+        runs
+        on annotations.run_id=runs.run_id
+        where (annotations.{column_name} is not null)
+    ),
+    {short_name}_summary as (
+        select bin_id,
+        avg(value) as consensus_{short_name},
+        avg(case when value_rank in ((value_count+1)/2,(value_count+2)/2) then value end) as {short_name}_median,
+        sum((value-value_mean)*(value-value_mean))/(count(*)-1) as {short_name}_variance,
+        count(*) as {short_name}_count
+        from {short_name}_values
+        group by bin_id
+    )'''
+
+def select_mzrt_summary_for_bins(database_connection,bin_list,include_spread=False):
+    '''
+    the consensus mz and rt of every bin in bin_list, averaged by sqlite in a single statement.
+    with include_spread, the median, standard deviation and count of each are returned as well (for qc).
+    a bin with a single value gets a nan standard deviation, like pandas would give it
+    '''
+    load_keys_into_temp_table(database_connection,'requested_bins',bin_list)
+
+    if include_spread==False:
+        #avg ignores nulls, which is the same as filtering mz and rt separately
+        query='''
+        select annotations.bin_id, avg(annotations.precursor_mz), avg(annotations.retention_time)
+        from requested_bins
+        inner join
+        annotations
+        on annotations.bin_id=requested_bins.key
+        inner join
+        runs
+        on annotations.run_id=runs.run_id
+        group by annotations.bin_id
+        having count(annotations.precursor_mz)>0
+        order by annotations.bin_id
+        '''
+        columns=['bin_id','consensus_mz','consensus_rt']
+    elif include_spread==True:
+        query='''
+        with'''+summarize_column_for_bins_query('precursor_mz','mz')+','+summarize_column_for_bins_query('retention_time','rt')+'''
+        select mz_summary.bin_id,
+        consensus_mz, consensus_rt,
+        mz_median, mz_variance, mz_count,
+        rt_median, rt_variance, rt_count
+        from mz_summary
+        left join
+        rt_summary
+        on mz_summary.bin_id=rt_summary.bin_id
+        order by mz_summary.bin_id
+        '''
+        columns=[
+            'bin_id','consensus_mz','consensus_rt',
+            'mz_median','mz_std','mz_count',
+            'rt_median','rt_std','rt_count'
+        ]
+
+    temp_cursor=database_connection.execute(query)
+    summary_panda=pd.DataFrame.from_records(temp_cursor.fetchall(),columns=columns)
+
+    if include_spread==True:
+        #the variance came out of sql, sqlite does not always have sqrt
+        summary_panda['mz_std']=np.sqrt(summary_panda['mz_std'].astype(float))
+        summary_panda['rt_std']=np.sqrt(summary_panda['rt_std'].astype(float))
+    return summary_panda
+
 
 def generate_mzrt_wrapper(
         database_connection,
         bin_list,
-
+        use_bulk_fetch=True,
+        use_sql_aggregation=True,
+        include_spread=False
     ):
     '''
-    for each cluster, make a consensus spectra in text format,
-    then concatentate them and return that
+    for each bin, average the mz and rt of its annotations.
+    by default sqlite does the averaging for all bins in one statement (select_mzrt_summary_for_bins),
+    otherwise the values are pulled into python and averaged there
     '''
+    if use_sql_aggregation==True:
+        return select_mzrt_summary_for_bins(database_connection,bin_list,include_spread)
+
     result_dict={
         'bin_id':[],
         'consensus_mz':[],
@@ -40,11 +170,8 @@ def generate_mzrt_wrapper(
     }
 
 
-    for z,temp_bin in enumerate(bin_list):
+    for z,(temp_bin,temp_mz_list,temp_rt_list) in enumerate(iterate_mzs_and_rts(database_connection,bin_list,use_bulk_fetch)):
         print(f'bin number {temp_bin} iteration number {z}')
-        
-        temp_mz_list=select_mzs_for_bin(database_connection,temp_bin)
-        temp_rt_list=select_rts_for_bin(database_connection,temp_bin)
 
         result_dict['bin_id'].append(temp_bin)
 
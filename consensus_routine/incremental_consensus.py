@@ -0,0 +1,367 @@
+import numpy as np
+import sys
+sys.path.insert(0, '../utils/')
+from utils import execute_query_connection_established
+from utils import load_keys_into_temp_table
+from utils import stream_rows_grouped_by_bin
+from utils import split_stored_spectrum_clusters
+from batched_similarity import make_dot_products_for_pairs
+from valid_for_autocuration_test import get_cleaned_spectra
+from valid_for_autocuration_test import prepare_bin_spectra
+from valid_for_autocuration_test import get_cluster_membership_ordering
+from contributor_sampling import create_consensus_sampling_table
+from contributor_sampling import read_recorded_sampling
+from contributor_sampling import select_spectra_for_contributors_streaming
+
+'''
+incremental consensus updates, for adding a study to a database whose bins already have consensus spectra.
+
+the consensus_watermark table holds, for every bin whose consensus was made by the update routine,
+the highest annotation_id that the consensus has seen and the annotation ids of the members of each cluster
+(space separated, clusters '@' separated in the order of the clusters of bins.consensus_spectrum).
+annotations are numbered upward as studies are uploaded, so the annotations of a bin above its watermark
+are exactly the ones that arrived since.
+
+for every bin
+    no annotations above the watermark: nothing to do
+    new annotations that a recluster would not sample away (the consensus was made from every annotation of the bin
+    and there are still no more than max_consensus_contributers with the new ones), whose spectra each lie within
+    mutual_distance_for_cluster of exactly one of the existing consensus spectra: every new spectrum joins that cluster
+    and the consensus spectra of the bin are remade from the spectra of the members, like a recluster makes them.
+    this skips the clustering (every pair of spectra), not the consensus
+    anything else (no watermark yet, a consensus made from a sample, too many annotations for the sampling limit,
+    or a new spectrum that fits no cluster or more than one): the bin is reclustered from scratch
+so a folded bin ends up with the consensus, watermark, sampling record and member_of_consensus that a recluster
+of the same annotations gives whenever the recluster puts the new spectra in the clusters that they were folded into
+(check_incremental_consensus.py)
+'''
+
+
+def create_consensus_watermark_table(database_connection):
+    '''
+    safe to run on a database that already has it
+    '''
+    execute_query_connection_established(
+        database_connection,
+        '''
+        CREATE TABLE IF NOT EXISTS consensus_watermark(
+            bin_id INTEGER PRIMARY KEY,
+            last_annotation_id INTEGER,
+            cluster_members TEXT,
+            FOREIGN KEY (bin_id)
+                REFERENCES bins (bin_id)
+        )
+        ''',
+        returns_rows=False
+    )
+
+
+def read_consensus_watermarks(database_connection,bin_list):
+    '''
+    {bin_id: (last_annotation_id, [annotation ids of each cluster], stored consensus spectrum, annotation_count, contributor_count)}
+    for the bins of bin_list that have a watermark. the counts are the ones recorded in consensus_sampling
+    (None for a bin that was never recorded there)
+    '''
+    create_consensus_watermark_table(database_connection)
+    create_consensus_sampling_table(database_connection)
+    load_keys_into_temp_table(database_connection,'watermarked_bins',bin_list)
+    query='''
+    select consensus_watermark.bin_id, consensus_watermark.last_annotation_id,
+        consensus_watermark.cluster_members, bins.consensus_spectrum,
+        consensus_sampling.annotation_count, consensus_sampling.contributor_count
+    from watermarked_bins
+    inner join
+    consensus_watermark
+    on consensus_watermark.bin_id=watermarked_bins.key
+    inner join
+    bins
+    on bins.bin_id=watermarked_bins.key
+    left join
+    consensus_sampling
+    on consensus_sampling.bin_id=watermarked_bins.key
+    '''
+    result=database_connection.execute(query).fetchall()
+    return {
+        element[0]:(element[1],parse_cluster_members(element[2]),element[3],element[4],element[5]) for element in result
+    }
+
+
+def parse_cluster_members(cluster_members_text):
+    '''
+    [annotation ids of each cluster] from the cluster_members column
+    '''
+    return [
+        [int(temp_id) for temp_id in temp_cluster.split()] for temp_cluster in cluster_members_text.split('@')
+    ]
+
+
+def convert_cluster_members_to_text(cluster_members):
+    '''
+    the cluster_members column from [annotation ids of each cluster]
+    '''
+    return '@'.join([
+        ' '.join([str(int(temp_id)) for temp_id in temp_cluster]) for temp_cluster in cluster_members
+    ])
+
+
+def read_last_annotation_ids(database_connection,bin_list):
+    '''
+    {bin_id: highest annotation_id of the bin that a consensus can be made from (a Sample spectrum)},
+    the watermark of a bin whose consensus was just remade. annotations that no consensus uses do not move it,
+    so the watermark of a bin is the same whether it was folded or reclustered
+    '''
+    load_keys_into_temp_table(database_connection,'watermarked_bins',bin_list)
+    query='''
+    select annotations.bin_id, max(annotations.annotation_id)
+    from watermarked_bins
+    inner join
+    annotations
+    on annotations.bin_id=watermarked_bins.key
+    inner join
+    runs
+    on annotations.run_id=runs.run_id
+    where (annotations.spectrum is not null) and (runs.run_type='Sample')
+    group by annotations.bin_id
+    '''
+    return {element[0]:element[1] for element in database_connection.execute(query).fetchall()}
+
+
+def record_consensus_watermarks(database_connection,watermark_rows):
+    '''
+    watermark_rows is a list of (bin_id, last_annotation_id, [annotation ids of each cluster]).
+    replaces whatever was recorded for those bins before
+    '''
+    create_consensus_watermark_table(database_connection)
+    if len(watermark_rows)==0:
+        return
+    with database_connection.begin():
+        database_connection.execute(
+            'insert or replace into consensus_watermark values (?,?,?)',
+            [
+                (int(temp_bin),int(temp_last_id),convert_cluster_members_to_text(temp_cluster_members))
+                for temp_bin,temp_last_id,temp_cluster_members in watermark_rows
+            ]
+        )
+
+
+def select_new_annotations_for_bins_streaming(database_connection,bin_list):
+    '''
+    the same rows as select_spectra_for_bins_streaming, but only the annotations above the watermark of their bin
+    (all of them for a bin without one).
+    generator, yields (bin_id, [(annotation_id, spectrum), ...]) in ascending bin_id order
+    '''
+    create_consensus_watermark_table(database_connection)
+    load_keys_into_temp_table(database_connection,'requested_bins',bin_list)
+    query=f'''
+    select annotations.bin_id, annotations.annotation_id, annotations.spectrum
+    from requested_bins
+    inner join
+    annotations
+    on annotations.bin_id=requested_bins.key
+    inner join
+    runs
+    on annotations.run_id=runs.run_id
+    left join
+    consensus_watermark
+    on consensus_watermark.bin_id=requested_bins.key
+    where (annotations.spectrum is not null) and (runs.run_type='Sample')
+        and (annotations.annotation_id>coalesce(consensus_watermark.last_annotation_id,-1))
+    order by annotations.bin_id, annotations.annotation_id
+    '''
+    yield from stream_rows_grouped_by_bin(database_connection,query,bin_list)
+
+
+def assign_spectra_to_consensus_clusters(new_spectra_cleaned,consensus_spectra_cleaned,ms2_tolerance,mutual_distance_for_cluster):
+    '''
+    for every new spectrum, the position of the one consensus spectrum that is within mutual_distance_for_cluster of it,
+    or -1 if none is or if more than one is (it could pull clusters together, which only a recluster can tell)
+    '''
+    new_count=len(new_spectra_cleaned)
+    cluster_count=len(consensus_spectra_cleaned)
+    if cluster_count==0:
+        return np.full(new_count,-1)
+    query_spectra=np.repeat(np.arange(new_count),cluster_count)
+    library_spectra=np.tile(np.arange(new_count,new_count+cluster_count),new_count)
+    similarities=make_dot_products_for_pairs(
+        list(new_spectra_cleaned)+list(consensus_spectra_cleaned),query_spectra,library_spectra,ms2_tolerance
+    ).reshape(new_count,cluster_count)
+
+    close_enough=(1-similarities)<=mutual_distance_for_cluster
+    return np.where(close_enough.sum(axis=1)==1,close_enough.argmax(axis=1),-1)
+
+
+def make_consensus_of_clusters(
+    temp_bin,
+    annotation_ids,
+    prepared_spectra,
+    cluster_assignments,
+    last_annotation_id,
+    minimum_percent_present,
+    bin_space_tolerance
+):
+    '''
+    the (bin_id, 1, consensus spectrum) row and the (bin_id, last_annotation_id, [annotation ids of each cluster])
+    watermark row of a bin whose spectra (prepare_bin_spectra, in annotation_id order) are assigned to clusters.
+    the clusters go biggest first, like get_cluster_membership_ordering orders them.
+    both the recluster and the fold make their rows here
+    '''
+    cluster_assignments_sorted_by_membership,biggest_cluster_percent=get_cluster_membership_ordering(cluster_assignments)
+    consensus_spectra_text=prepared_spectra.consensus_spectra_text(
+        cluster_assignments,
+        cluster_assignments_sorted_by_membership,
+        minimum_percent_present,
+        bin_space_tolerance
+    )
+    cluster_assignments=np.asarray(cluster_assignments)
+    annotation_ids=np.asarray(annotation_ids)
+    cluster_members=[
+        annotation_ids[cluster_assignments==temp_cluster].tolist() for temp_cluster in cluster_assignments_sorted_by_membership
+    ]
+    #its already valid for autocuration, this changes nothing
+    return (temp_bin,1,consensus_spectra_text),(temp_bin,last_annotation_id,cluster_members)
+
+
+def can_fold_bin(watermark,new_annotation_count,sampling_limit):
+    '''
+    whether a recluster of the bin would use every annotation, old and new, so that folding can give the same consensus.
+    the stored consensus has to be made from every annotation up to the watermark (nothing sampled away),
+    and the new annotations must not take the bin past sampling_limit (None for no limit)
+    '''
+    temp_last_id,temp_cluster_members,temp_stored_consensus,temp_annotation_count,temp_contributor_count=watermark
+    if (temp_stored_consensus is None) or (temp_annotation_count is None):
+        return False
+    member_count=sum([len(temp_members) for temp_members in temp_cluster_members])
+    if (temp_annotation_count!=temp_contributor_count) or (member_count!=temp_contributor_count):
+        return False
+    if (sampling_limit is not None) and (member_count+new_annotation_count>sampling_limit):
+        return False
+    return True
+
+
+def fold_new_spectra_into_clusters(
+    stored_consensus_spectrum,
+    cluster_count,
+    new_spectra_text,
+    noise_level,
+    ms2_tolerance,
+    mutual_distance_for_cluster
+):
+    '''
+    the position of the cluster (in the order of the stored consensus spectrum) that every new spectrum joins,
+    or None if a new spectrum fits no cluster or more than one (the bin has to be reclustered)
+    '''
+    consensus_spectra_cleaned=get_cleaned_spectra(
+        split_stored_spectrum_clusters(stored_consensus_spectrum),noise_level,ms2_tolerance
+    )
+    if len(consensus_spectra_cleaned)!=cluster_count:
+        return None
+    new_prepared_spectra=prepare_bin_spectra(new_spectra_text,noise_level,ms2_tolerance)
+
+    cluster_assignments=assign_spectra_to_consensus_clusters(
+        new_prepared_spectra.spectra,consensus_spectra_cleaned,ms2_tolerance,mutual_distance_for_cluster
+    )
+    if (cluster_assignments==-1).any():
+        return None
+    return cluster_assignments
+
+
+def fold_new_annotations_for_bins(
+    database_connection,
+    bin_list,
+    max_consensus_contributers,
+    noise_level,
+    ms2_tolerance,
+    mutual_distance_for_cluster,
+    minimum_percent_present,
+    bin_space_tolerance,
+    sampling_strategy='reservoir',
+    sampling_seed=0,
+    reuse_recorded_sampling=False
+):
+    '''
+    goes through the annotations above the watermark of every bin in bin_list and folds them in where it can.
+    the sampling arguments are the ones that a recluster of the same bins would get, a folded bin is recorded
+    in consensus_sampling as that recluster would record it.
+    returns
+        result_rows: (bin_id, 1, consensus spectrum) for every folded bin
+        watermark_rows: (bin_id, last_annotation_id, [annotation ids of each cluster]) for every folded bin
+        bin_contributors: the select_contributors_for_bins row of every folded bin (every annotation contributes),
+            for member_of_consensus and record_contributor_sampling
+        bins_to_recluster: bins with new annotations that could not be folded
+    bins without new annotations are in none of them
+    '''
+    watermarks=read_consensus_watermarks(database_connection,bin_list)
+    recorded_sampling=dict()
+    if reuse_recorded_sampling==True:
+        recorded_sampling=read_recorded_sampling(database_connection,bin_list)
+
+    #first the new spectra are compared to the consensus spectra, bin by bin
+    folds=dict()
+    bins_to_recluster=list()
+    for temp_bin,annotations_and_spectra in select_new_annotations_for_bins_streaming(database_connection,bin_list):
+        if len(annotations_and_spectra)==0:
+            continue
+        temp_strategy,temp_seed,temp_size=recorded_sampling.get(
+            temp_bin,(sampling_strategy,sampling_seed,max_consensus_contributers)
+        )
+        if (temp_bin not in watermarks) or (not can_fold_bin(watermarks[temp_bin],len(annotations_and_spectra),temp_size)):
+            bins_to_recluster.append(temp_bin)
+            continue
+
+        temp_cluster_members=watermarks[temp_bin][1]
+        new_cluster_assignments=fold_new_spectra_into_clusters(
+            watermarks[temp_bin][2],
+            len(temp_cluster_members),
+            [element[1] for element in annotations_and_spectra],
+            noise_level,
+            ms2_tolerance,
+            mutual_distance_for_cluster
+        )
+        if new_cluster_assignments is None:
+            bins_to_recluster.append(temp_bin)
+            continue
+
+        if temp_size is None:
+            temp_strategy='none'
+        folds[temp_bin]=(
+            temp_cluster_members,
+            [element[0] for element in annotations_and_spectra],
+            new_cluster_assignments.tolist(),
+            temp_strategy,
+            temp_seed,
+            temp_size
+        )
+
+    #then the consensus spectra of the folded bins are remade from the spectra of all of their members
+    cluster_of_annotation=dict()
+    for temp_cluster_members,temp_new_ids,temp_new_assignments in [element[:3] for element in folds.values()]:
+        for temp_cluster,temp_members in enumerate(temp_cluster_members):
+            cluster_of_annotation.update({temp_id:temp_cluster for temp_id in temp_members})
+        cluster_of_annotation.update(dict(zip(temp_new_ids,temp_new_assignments)))
+    last_annotation_ids=read_last_annotation_ids(database_connection,list(folds.keys()))
+
+    result_rows=list()
+    watermark_rows=list()
+    bin_contributors=list()
+    for temp_bin,annotations_and_spectra in select_spectra_for_contributors_streaming(
+        database_connection,list(folds.keys()),list(cluster_of_annotation.keys())
+    ):
+        temp_annotation_ids=[element[0] for element in annotations_and_spectra]
+        prepared_spectra=prepare_bin_spectra([element[1] for element in annotations_and_spectra],noise_level,ms2_tolerance)
+        temp_result_row,temp_watermark_row=make_consensus_of_clusters(
+            temp_bin,
+            temp_annotation_ids,
+            prepared_spectra,
+            [cluster_of_annotation[temp_id] for temp_id in temp_annotation_ids],
+            last_annotation_ids[temp_bin],
+            minimum_percent_present,
+            bin_space_tolerance
+        )
+        result_rows.append(temp_result_row)
+        watermark_rows.append(temp_watermark_row)
+
+        temp_strategy,temp_seed,temp_size=folds[temp_bin][3:]
+        bin_contributors.append(
+            (temp_bin,temp_strategy,temp_seed,temp_size,len(temp_annotation_ids),temp_annotation_ids)
+        )
+    return result_rows,watermark_rows,bin_contributors,bins_to_recluster
@@ -0,0 +1,88 @@
+import numpy as np
+from generate_consensus_spectra import generate_consensus_spectrum_from_peaks
+from spectral_features import get_intensity_histogram_of_peaks
+from spectral_features import get_histogram_entropy
+
+
+class PreparedBinSpectra:
+    '''
+    the cleaned spectra of one bin, stacked once and shared by the validity tests and the consensus spectra.
+
+    all_peaks is every peak of every spectrum, (n_peaks x 2) float64, in spectrum order. spectra are views of it,
+    so they can go straight to the clustering, and all_mz/all_intensity are the contiguous columns that the
+    mz range, the entropy histogram and the consensus spectra work on.
+    the peaks of a group of spectra (a cluster) are picked out of all_mz/all_intensity with spectrum_index,
+    which keeps them in spectrum order, so every number comes out the same as stacking that group again
+    '''
+
+    def __init__(self,temp_spectra_paired_cleaned,ms2_tolerance):
+
+        self.ms2_tolerance=ms2_tolerance
+        self.spectrum_count=len(temp_spectra_paired_cleaned)
+        self.peak_counts=np.array([len(temp_spectrum) for temp_spectrum in temp_spectra_paired_cleaned],dtype=np.int64)
+
+        if self.spectrum_count==0:
+            self.all_peaks=np.zeros((0,2))
+        else:
+            self.all_peaks=np.ascontiguousarray(np.concatenate(
+                [np.asarray(temp_spectrum,dtype=np.float64).reshape(-1,2) for temp_spectrum in temp_spectra_paired_cleaned]
+            ))
+        self.all_mz=np.ascontiguousarray(self.all_peaks[:,0])
+        self.all_intensity=np.ascontiguousarray(self.all_peaks[:,1])
+        self.spectrum_index=np.repeat(np.arange(self.spectrum_count),self.peak_counts)
+
+        spectrum_ends=np.cumsum(self.peak_counts)
+        self.spectra=[
+            self.all_peaks[temp_end-temp_count:temp_end] for temp_end,temp_count in zip(spectrum_ends,self.peak_counts)
+        ]
+
+    def __len__(self):
+        return self.spectrum_count
+
+    def mz_range(self):
+        '''
+        same as get_mz_range_of_bin_spectra
+        '''
+        return self.all_mz.max()-self.all_mz.min()
+
+    def intensity_histogram(self,histogram_bin_count=100):
+        '''
+        same as get_intensity_histogram_of_bin_spectra
+        '''
+        return get_intensity_histogram_of_peaks(
+            self.all_mz,self.all_intensity,self.spectrum_count,self.ms2_tolerance,histogram_bin_count
+        )
+
+    def bin_entropy(self,use_ceiling):
+        '''
+        same as get_bin_entropy
+        '''
+        return get_histogram_entropy(self.intensity_histogram(),use_ceiling)
+
+    def consensus_spectra_text(
+        self,
+        cluster_assignments,
+        cluster_assignments_sorted_by_membership,
+        minimum_percent_present,
+        bin_space_tolerance
+    ):
+        '''
+        same as generate_consensus_spectra_text_wrapper: the consensus spectrum of every cluster,
+        biggest cluster first, joined by '@'
+        '''
+        cluster_assignments=np.asarray(cluster_assignments)
+        consensus_spectra_text_list=list()
+        for temp_cluster_identity in cluster_assignments_sorted_by_membership:
+            in_cluster=(cluster_assignments==temp_cluster_identity)
+            peaks_in_cluster=in_cluster[self.spectrum_index]
+            consensus_spectra_text_list.append(
+                generate_consensus_spectrum_from_peaks(
+                    self.all_mz[peaks_in_cluster],
+                    self.all_intensity[peaks_in_cluster],
+                    int(in_cluster.sum()),
+                    self.ms2_tolerance,
+                    minimum_percent_present,
+                    bin_space_tolerance
+                )
+            )
+        return '@'.join(consensus_spectra_text_list)
@@ -0,0 +1,194 @@
+import heapq
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from batched_similarity import flatten_spectra
+from batched_similarity import make_dot_products_for_pairs
+
+'''
+clustering for bins with too many spectra for a dense n x n similarity matrix.
+
+instead of scoring every pair we only score pairs that could plausibly be similar: every spectrum of a bin
+already shares the precursor (that is what a bin is), so the pairs are chosen by top-peak signature.
+two spectra are candidates if one of the top_peak_count most intense peaks of each is within ms2_tolerance
+of the other, and each signature peak is paired with at most max_neighbours of its closest signature peaks.
+so the candidates grow like n*top_peak_count*max_neighbours, not n^2, and are capped at max_candidate_pairs.
+
+the clusters are then either
+    connected_components: spectra joined by any scored pair with distance<=mutual_distance_for_cluster
+    average: average linkage over the scored pairs, cut at mutual_distance_for_cluster,
+        the same as hierarchy.linkage(method='average') plus fcluster(criterion='distance') when every pair is scored
+'''
+
+
+def find_candidate_pairs(
+    spectra,
+    ms2_tolerance,
+    top_peak_count=3,
+    max_neighbours=20,
+    max_candidate_pairs=5000000
+):
+    '''
+    returns two arrays (i, j), i<j, of the pairs of spectra that share a top-peak signature
+    '''
+    spectrum_count=len(spectra)
+    all_mz,all_intensity,spectrum_index=flatten_spectra(spectra)
+    if len(all_mz)==0:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+
+    #the top_peak_count most intense peaks of every spectrum
+    by_intensity=np.lexsort((-all_intensity,spectrum_index))
+    peak_counts=np.bincount(spectrum_index,minlength=spectrum_count)
+    rank_in_spectrum=np.arange(len(all_mz))-np.repeat(np.cumsum(peak_counts)-peak_counts,peak_counts)
+    signature_peaks=by_intensity[rank_in_spectrum<top_peak_count]
+
+    #walk the signature peaks in mz order, pairing each with the next few that are close enough
+    by_mz=np.argsort(all_mz[signature_peaks],kind='stable')
+    signature_mz=all_mz[signature_peaks][by_mz].astype(np.float64)
+    signature_spectra=spectrum_index[signature_peaks][by_mz]
+
+    pair_keys=list()
+    pair_gaps=list()
+    for temp_offset in range(1,max_neighbours+1):
+        if temp_offset>=len(signature_mz):
+            break
+        temp_gaps=signature_mz[temp_offset:]-signature_mz[:-temp_offset]
+        close_enough=temp_gaps<=ms2_tolerance
+        if not close_enough.any():
+            break
+        temp_i=signature_spectra[:-temp_offset][close_enough]
+        temp_j=signature_spectra[temp_offset:][close_enough]
+        different_spectra=temp_i!=temp_j
+        pair_keys.append(
+            np.minimum(temp_i,temp_j)[different_spectra]*spectrum_count+np.maximum(temp_i,temp_j)[different_spectra]
+        )
+        pair_gaps.append(temp_gaps[close_enough][different_spectra])
+
+    if len(pair_keys)==0:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+    pair_keys=np.concatenate(pair_keys)
+    pair_gaps=np.concatenate(pair_gaps)
+
+    #a pair can come up through more than one signature peak, keep its closest one
+    by_gap=np.lexsort((pair_gaps,pair_keys))
+    pair_keys=pair_keys[by_gap]
+    pair_gaps=pair_gaps[by_gap]
+    first_of_key=np.ones(len(pair_keys),dtype=bool)
+    first_of_key[1:]=pair_keys[1:]!=pair_keys[:-1]
+    pair_keys=pair_keys[first_of_key]
+    pair_gaps=pair_gaps[first_of_key]
+
+    #the memory ceiling. keep the pairs with the closest signatures
+    if len(pair_keys)>max_candidate_pairs:
+        pair_keys=np.sort(pair_keys[np.argpartition(pair_gaps,max_candidate_pairs)[:max_candidate_pairs]])
+
+    return pair_keys//spectrum_count,pair_keys%spectrum_count
+
+
+def cluster_connected_components(spectrum_count,pair_i,pair_j,pair_distances,mutual_distance_for_cluster):
+    '''
+    cluster identities (from 1, like fcluster) of the connected components of the pairs within mutual_distance_for_cluster
+    '''
+    close_pairs=pair_distances<=mutual_distance_for_cluster
+    adjacency=sparse.coo_matrix(
+        (np.ones(close_pairs.sum()),(pair_i[close_pairs],pair_j[close_pairs])),
+        shape=(spectrum_count,spectrum_count)
+    )
+    component_count,component_labels=connected_components(adjacency,directed=False)
+    return component_labels+1
+
+
+def cluster_sparse_average_linkage(spectrum_count,pair_i,pair_j,pair_similarities,mutual_distance_for_cluster):
+    '''
+    cluster identities (from 1, like fcluster) from average linkage cut at mutual_distance_for_cluster.
+
+    the distance between two clusters is 1-(mean similarity of the scored pairs between their members).
+    pairs that were never scored are left out of the mean rather than counted as 0, otherwise a big cluster
+    whose members were each only scored against a few of the others would look far apart from itself.
+    when every pair is scored this is exactly average linkage.
+    we merge the closest two clusters until the closest are further apart than mutual_distance_for_cluster,
+    only clusters that share a scored pair can be merged
+    '''
+    #pair_stats[a][b] is [sum of similarities, number of scored pairs] between the members of clusters a and b
+    pair_stats=dict()
+    for temp_spectrum in range(spectrum_count):
+        pair_stats[temp_spectrum]=dict()
+    for temp_i,temp_j,temp_similarity in zip(pair_i.tolist(),pair_j.tolist(),pair_similarities.tolist()):
+        if temp_j not in pair_stats[temp_i]:
+            pair_stats[temp_i][temp_j]=[0.0,0]
+            pair_stats[temp_j][temp_i]=pair_stats[temp_i][temp_j]
+        pair_stats[temp_i][temp_j][0]+=temp_similarity
+        pair_stats[temp_i][temp_j][1]+=1
+
+    candidate_merges=[
+        (1-temp_stats[0]/temp_stats[1],temp_a,temp_b)
+        for temp_a in pair_stats for temp_b,temp_stats in pair_stats[temp_a].items() if temp_a<temp_b
+    ]
+    heapq.heapify(candidate_merges)
+
+    #each spectrum points at the cluster it was merged into, followed to the end afterwards
+    merged_into=np.arange(spectrum_count)
+    while len(candidate_merges)>0:
+        temp_distance,temp_a,temp_b=heapq.heappop(candidate_merges)
+        if temp_distance>mutual_distance_for_cluster:
+            break
+        #stale entries: one of the clusters is gone, or the distance changed since this entry was pushed
+        if (temp_a not in pair_stats) or (temp_b not in pair_stats[temp_a]):
+            continue
+        temp_stats=pair_stats[temp_a][temp_b]
+        if temp_distance!=1-temp_stats[0]/temp_stats[1]:
+            continue
+
+        #merge the cluster with fewer neighbours into the other one
+        if len(pair_stats[temp_a])<len(pair_stats[temp_b]):
+            temp_a,temp_b=temp_b,temp_a
+        del pair_stats[temp_a][temp_b]
+        for temp_c,temp_stats in pair_stats.pop(temp_b).items():
+            if temp_c==temp_a:
+                continue
+            del pair_stats[temp_c][temp_b]
+            if temp_c in pair_stats[temp_a]:
+                pair_stats[temp_a][temp_c][0]+=temp_stats[0]
+                pair_stats[temp_a][temp_c][1]+=temp_stats[1]
+            else:
+                pair_stats[temp_a][temp_c]=temp_stats
+                pair_stats[temp_c][temp_a]=temp_stats
+            #only the distances to b's neighbours change, the mean to a cluster that only a touched stays the same
+            temp_stats=pair_stats[temp_a][temp_c]
+            heapq.heappush(
+                candidate_merges,
+                (1-temp_stats[0]/temp_stats[1],min(temp_a,temp_c),max(temp_a,temp_c))
+            )
+        merged_into[temp_b]=temp_a
+
+    #follow the merges to the surviving cluster of every spectrum
+    while True:
+        next_merged_into=merged_into[merged_into]
+        if np.array_equal(next_merged_into,merged_into):
+            break
+        merged_into=next_merged_into
+    surviving_clusters,cluster_identities=np.unique(merged_into,return_inverse=True)
+    return cluster_identities+1
+
+
+def perform_sparse_clustering_routine(
+    spectra,
+    ms2_tolerance,
+    mutual_distance_for_cluster,
+    sparse_linkage='average',
+    top_peak_count=3,
+    max_neighbours=20,
+    max_candidate_pairs=5000000,
+    max_peak_pairs_per_chunk=5000000
+):
+    '''
+    receives a list of spectra as mz-int pairs and outputs cluster assignments, scoring only the candidate pairs.
+    memory stays within max_candidate_pairs pairs and max_peak_pairs_per_chunk peak pairs at a time
+    '''
+    pair_i,pair_j=find_candidate_pairs(spectra,ms2_tolerance,top_peak_count,max_neighbours,max_candidate_pairs)
+    pair_similarities=make_dot_products_for_pairs(spectra,pair_i,pair_j,ms2_tolerance,max_peak_pairs_per_chunk)
+
+    if sparse_linkage=='connected_components':
+        return cluster_connected_components(len(spectra),pair_i,pair_j,1-pair_similarities,mutual_distance_for_cluster)
+    elif sparse_linkage=='average':
+        return cluster_sparse_average_linkage(len(spectra),pair_i,pair_j,pair_similarities,mutual_distance_for_cluster)
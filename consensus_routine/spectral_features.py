@@ -0,0 +1,54 @@
+import numpy as np
+from scipy.stats import entropy
+from generate_consensus_spectra import stack_spectra_peaks
+
+'''
+features of all of the spectra of a bin taken together, for the validity tests and other qc metrics.
+they share one histogram: the mz span of the bin cut into histogram_bin_count equal slices,
+with the intensity of every peak summed into its slice
+'''
+
+
+def get_intensity_histogram_of_bin_spectra(temp_spectra_paired,ms2_tolerance,histogram_bin_count=100):
+    '''
+    the summed intensity of each histogram slice divided by the number of spectra, as a float64 array.
+    the slices are the np.digitize identities of np.arange(min mz, max mz+ms2_tolerance, mz span/histogram_bin_count),
+    identity 0 (nothing falls below the min) up to, but not including, len(edges), which is where a peak
+    on or past the last edge lands. this is the histogram that get_bin_entropy has always used
+    '''
+    all_mz,all_intensity=stack_spectra_peaks(temp_spectra_paired)
+    return get_intensity_histogram_of_peaks(all_mz,all_intensity,len(temp_spectra_paired),ms2_tolerance,histogram_bin_count)
+
+
+def get_intensity_histogram_of_peaks(all_mz,all_intensity,spectrum_count,ms2_tolerance,histogram_bin_count=100):
+    '''
+    get_intensity_histogram_of_bin_spectra on peaks that are already stacked (stack_spectra_peaks, PreparedBinSpectra)
+    '''
+    histogram_edges=np.arange(all_mz.min(),
+                   all_mz.max()+ms2_tolerance,
+                  (all_mz.max()-all_mz.min())/histogram_bin_count
+                  )
+    bin_identities=np.digitize(
+        all_mz,
+        histogram_edges
+    )
+
+    #bincount adds the peaks up in order, like summing the peaks of each slice one by one
+    summed_intensities=np.bincount(
+        bin_identities,
+        weights=all_intensity,
+        minlength=len(histogram_edges)+1
+    )[:len(histogram_edges)]
+    return summed_intensities/spectrum_count
+
+
+def get_histogram_entropy(intensity_histogram,use_ceiling):
+    '''
+    exp of the shannon entropy of a histogram (the effective number of occupied slices).
+    with use_ceiling every occupied slice counts the same, whatever its intensity
+    '''
+    intensity_histogram=np.nan_to_num(intensity_histogram)
+    if use_ceiling==False:
+        return np.exp(entropy(intensity_histogram))
+    elif use_ceiling==True:
+        return np.exp(entropy(np.ceil(intensity_histogram)))
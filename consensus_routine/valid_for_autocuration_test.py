@@ -4,26 +4,28 @@ import sys
 sys.path.insert(0, '../utils/')
 from utils import execute_query_connection_established
 from utils import parse_text_spectra_return_pairs
+from utils import load_keys_into_temp_table
+from utils import bulk_set_column_for_keys
+from utils import stream_rows_grouped_by_bin
 import spectral_entropy
 from scipy.spatial import distance
 from scipy.cluster import hierarchy
 from collections import Counter
-from scipy.stats import entropy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from generate_consensus_spectra import *
+from batched_similarity import make_dot_product_matrix_batched
+from sparse_clustering import perform_sparse_clustering_routine
+from spectral_features import get_intensity_histogram_of_bin_spectra
+from spectral_features import get_histogram_entropy
+from prepared_bin_spectra import PreparedBinSpectra
 
 def update_member_of_consensus(database_connection,temp_annotation_ids,new_status):
-    
-    annotations_as_strings=[str(element) for element in temp_annotation_ids]
-    total_string='\', \''.join(annotations_as_strings)
-    total_string='(\''+total_string+'\')'
-
-    query=f'''update annotations
-    set member_of_consensus={new_status}
-    where annotation_id in '''+total_string
-
-    execute_query_connection_established(database_connection,query,returns_rows=False)
-
-
+    '''
+    sets member_of_consensus for a list of annotations, through a temp table of the ids
+    '''
+    bulk_set_column_for_keys(database_connection,'annotations','annotation_id','member_of_consensus',new_status,temp_annotation_ids)
 
 
 def select_spectra_for_bin(database_connection,bin_id):
@@ -39,29 +41,39 @@ def select_spectra_for_bin(database_connection,bin_id):
     return [(element[0],element[1]) for element in execute_query_connection_established(database_connection,query)]
 
 
+def select_spectra_for_bins_streaming(database_connection,bin_list):
+    '''
+    the same rows as select_spectra_for_bin, but for every bin in bin_list with one query.
+    generator, yields (bin_id, [(annotation_id, spectrum), ...]) in ascending bin_id order
+    '''
+    load_keys_into_temp_table(database_connection,'requested_bins',bin_list)
+
+    query=f'''
+    select annotations.bin_id, annotations.annotation_id, annotations.spectrum
+    from requested_bins
+    inner join
+    annotations
+    on annotations.bin_id=requested_bins.key
+    inner join
+    runs
+    on annotations.run_id=runs.run_id
+    where (annotations.spectrum is not null) and (runs.run_type='Sample')
+    order by annotations.bin_id, annotations.annotation_id
+    '''
+    yield from stream_rows_grouped_by_bin(database_connection,query,bin_list)
+
+
 def make_distance_matrix(spectra,similarity_metric,ms2_tolerance):
     '''
-    makes a distance matrix. currently very slow because of explicit for loops.
-    see this github issue https://github.com/czbiohub/bucketbase/issues/16
+    makes a distance matrix. every pair of the bin is scored in one go (batched_similarity.py)
+    instead of one spectral_entropy call per pair (https://github.com/czbiohub/bucketbase/issues/16)
     so, its clear that the dot product is assumed to be symmetric here even tho in ms
     the components of the dot product are calculated directionally
     '''
-    similarity_matrix=np.zeros(
-        shape=(len(spectra),len(spectra))
-    )
-    
     if similarity_metric=='dot_product':
-        for i in range(len(spectra)):
-            for j in range(i,len(spectra)):
-                similarity_matrix[i][j]=spectral_entropy.similarity(
-                    spectra[i], spectra[j], 
-                    method='dot_product',
-                    ms2_da=ms2_tolerance,
-                    need_clean_spectra=False,
-                )    
-    
-    similarity_matrix=np.triu(similarity_matrix)
-    similarity_matrix=similarity_matrix+similarity_matrix.T-np.diag(np.diag(similarity_matrix))
+        similarity_matrix=make_dot_product_matrix_batched(spectra,ms2_tolerance)
+    else:
+        raise ValueError(f'unknown similarity_metric {similarity_metric}, expected dot_product')
     
     ############DANGER##############
     #getting some error where 1 was being rep'd as 0.9999999
@@ -74,10 +86,30 @@ def make_distance_matrix(spectra,similarity_metric,ms2_tolerance):
     return similarity_matrix,distance_matrix_flattened
 
 
-def perform_hierarchical_clustering_routine(spectra,similarity_metric,ms2_tolerance,mutual_distance_for_cluster):
+def perform_hierarchical_clustering_routine(
+    spectra,
+    similarity_metric,
+    ms2_tolerance,
+    mutual_distance_for_cluster,
+    clustering_backend='dense',
+    dense_spectrum_limit=2000
+):
     '''
-    receives a list of spectra as mz-int pairs and outputs cluster assignments
+    receives a list of spectra as mz-int pairs and outputs cluster assignments.
+    the dense backend scores every pair and runs scipys average linkage, which is n^2 memory.
+    the sparse backend only scores pairs with close top-peak signatures (sparse_clustering.py).
+    auto uses dense up to dense_spectrum_limit spectra and sparse above that.
+    sparse is an approximation (pairs that are not scored are left out of the linkage averages),
+    so dense is the default and sparse/auto have to be asked for
     '''
+    if clustering_backend=='auto':
+        if len(spectra)<=dense_spectrum_limit:
+            clustering_backend='dense'
+        else:
+            clustering_backend='sparse'
+    if clustering_backend=='sparse':
+        return perform_sparse_clustering_routine(spectra,ms2_tolerance,mutual_distance_for_cluster)
+
     #generate the similarity matrix
     similarity_matrix,distance_matrix_flattened=make_distance_matrix(spectra,similarity_metric,ms2_tolerance)
 
@@ -120,68 +152,47 @@ def get_mz_range_of_bin_spectra(temp_spectra_paired):
     '''
     
     '''
-    temp_spectra_parallel=[np.stack(temp_spectrum,axis=1) for temp_spectrum in temp_spectra_paired]
-    all_mz_list=[spectrum[0] for spectrum in temp_spectra_parallel]
-    all_mz=np.concatenate(all_mz_list,dtype=object)
+    all_mz,all_intensity=stack_spectra_peaks(temp_spectra_paired)
     return all_mz.max()-all_mz.min()
 
 def get_cleaned_spectra(temp_spectra_paired,noise_level,ms2_tolerance):
     '''
+    the cleaned spectra are always C-contiguous float64 arrays of shape (n_peaks x 2), sorted by mz.
+    clean_spectrum hands back float32, which we widen once here (exactly, every float32 is a float64)
+    so that nothing downstream has to fall back to object arrays or mixed dtypes
     '''
-    cleaned_spectra=[spectral_entropy.tools.clean_spectrum(
-                        temp_spectrum,
-                        noise_removal=noise_level,
-                        ms2_da=ms2_tolerance
-                    ) for temp_spectrum in temp_spectra_paired]
+    cleaned_spectra=[np.ascontiguousarray(
+                        spectral_entropy.tools.clean_spectrum(
+                            temp_spectrum,
+                            noise_removal=noise_level,
+                            ms2_da=ms2_tolerance
+                        ),
+                        dtype=np.float64
+                    ).reshape(-1,2) for temp_spectrum in temp_spectra_paired]
     return cleaned_spectra
 
+def prepare_bin_spectra(temp_spectra_text,noise_level,ms2_tolerance):
+    '''
+    parses and cleans the spectra of a bin once, for every test and the consensus spectra
+    '''
+    temp_spectra_paired=parse_text_spectra_return_pairs(temp_spectra_text)
+    return PreparedBinSpectra(get_cleaned_spectra(temp_spectra_paired,noise_level,ms2_tolerance),ms2_tolerance)
+
 def get_bin_entropy(temp_spectra_paired,use_ceiling,ms2_tolerance):
     '''
-    first portion is same strategy as generate_consensus_spectrum
-    the second half is from find_average_mz_and_intensity
-    
     the strategy, unlike making a consensus spectrum, is that we sum a bin and then normlize by count
 
     if use_ceiling is true then the strategy doesnt matter
+
+    same value as the scan per histogram slice it replaced (get_bin_entropy_looped in check_bin_entropy.py),
+    from the shared intensity histogram in spectral_features
     '''
-    
-    spectra=[np.stack(temp_spectrum,axis=1) for temp_spectrum in temp_spectra_paired]
-    spectrum_count=len(spectra)
-    
-    all_mz_list=[spectrum[0] for spectrum in spectra]
-    all_intensity_list=[spectrum[1] for spectrum in spectra]
-    
-    all_mz=np.concatenate(all_mz_list,dtype=object)
-    all_intensity=np.concatenate(all_intensity_list,dtype=object)
-    
-    bins=np.arange(all_mz.min(),
-                   all_mz.max()+ms2_tolerance,
-                  (all_mz.max()-all_mz.min())/100
-                  )
-    
-    bin_identities=np.digitize(
-        all_mz,
-        bins
-    ) 
-
-    output_intensity_list=list()
-    for i in range(len(bins)):
-        interesting_indexes=[
-            j for j, element in enumerate(bin_identities) if (element==i)
-        ]
-        interesting_intensities=all_intensity[interesting_indexes]
-        ####output_intensity_list.append(interesting_intensities.mean())
-        output_intensity_list.append((interesting_intensities.sum())/spectrum_count)
-
-    output_intensity_list=np.nan_to_num(output_intensity_list)
-    if use_ceiling==False:
-        return np.exp(entropy(output_intensity_list))
-    elif use_ceiling==True:
-        return np.exp(entropy(np.ceil(output_intensity_list)))
+    intensity_histogram=get_intensity_histogram_of_bin_spectra(temp_spectra_paired,ms2_tolerance)
+    return get_histogram_entropy(intensity_histogram,use_ceiling)
 
-def valid_for_autocuration_test_wrapper(
-    database_connection,
-    bin_list,
+def valid_for_autocuration_test_one_bin(
+    temp_bin,
+    annotations_and_spectra,
     similarity_metric,
     ms2_tolerance,
     noise_level,
@@ -192,22 +203,114 @@ def valid_for_autocuration_test_wrapper(
     largest_cluster_membership_parameter_percent,
     bin_spectra_count_minimum_parameter,
     minimum_percent_present,
-    bin_space_tolerance
+    bin_space_tolerance,
+    clustering_backend='dense'
 ):
+    '''
+    the validity tests and consensus spectrum for one bin.
+    does not touch the database, so that it can run in a worker process.
+    returns (bin_id, valid_for_autocuration, consensus_spectrum)
+    '''
+    temp_spectra_text=[element[1] for element in annotations_and_spectra]
+    print(f'{len(temp_spectra_text)} spectra') #len(temp_spectra_text))
+
+    #there was a problem in that certain modules expect spectra as mz/rt pairs and some (the ones i wrote)
+    #expect parallel lists. fixing this would be an easy way to reduce code complexity
+    #but the main goal for the moment is a working version by next week
+    #we need to clean to make sure that subsequent stuff is homogenous
+    #the parsed, cleaned and stacked spectra are kept in one place and shared by every test and the consensus
+    prepared_spectra=prepare_bin_spectra(temp_spectra_text,noise_level,ms2_tolerance)
+    
+    #now, the general logic is to perform a series of tests
+    #the tests are all kind of different. at each place, if a test is failed, the procedure is the same.
+    #get the consensus spectrum for each cluster and set the auto_curate_valid to False
+    #the tests (order matters, for example, it doesnt make sense to do entropy test if mz range is very small
+    #1) membership percent of largest cluster
+    #2) total members of cluster
+    #3) spread of mz
+    #4) entropy
+    #whichever test decides, the consensus spectrum is made once at the end
+
+    #an aside: the reason for tangling "determine if something is valid for autocuration"
+    #and "generate the consensus spectrum" was that making the clusters is an expensive process
+    #and we wanted to do it once
+
+    #1)
+    #get the cluster assignments. if there is only one spectrum, then cheese it and assign the cluster membership manually
+    if len(prepared_spectra)==1:
+        cluster_assignments=np.array([1])
+        cluster_assignments_sorted_by_membership=np.array([1])
+        biggest_cluster_percent=1.0
+    else:
+        cluster_assignments=perform_hierarchical_clustering_routine(
+            prepared_spectra.spectra,similarity_metric,ms2_tolerance,mutual_distance_for_cluster,clustering_backend
+        )
+        #count membership and get cluster percent
+        cluster_assignments_sorted_by_membership,biggest_cluster_percent=get_cluster_membership_ordering(cluster_assignments)       
+    if biggest_cluster_percent<largest_cluster_membership_parameter_percent:
+        valid_for_autocuration=0
+
+    #2)
+    elif len(cluster_assignments)<bin_spectra_count_minimum_parameter:
+        valid_for_autocuration=0
+
+    #3
+    elif prepared_spectra.mz_range()<min_mz_range_parameter:
+        #Note that a fail here still means we curate with it
+        valid_for_autocuration=1
+
+    #4
+    else:
+        bin_entropy=prepared_spectra.bin_entropy(False)
+        if bin_entropy>max_entropy_parameter:
+            valid_for_autocuration=0
+        elif bin_entropy<max_entropy_parameter:
+            valid_for_autocuration=1
+        else:
+            #an entropy exactly equal to max_entropy_parameter has never produced a row
+            return None
+
+    consensus_spectra_text=prepared_spectra.consensus_spectra_text(
+        cluster_assignments,
+        cluster_assignments_sorted_by_membership,
+        minimum_percent_present,
+        bin_space_tolerance
+    )
+    return temp_bin,valid_for_autocuration,consensus_spectra_text
 
-    result_dict={
-        'bin_id':[],
-        'valid_for_autocuration':[],
-        'consensus_spectrum':[]
-    }
 
-    for z,temp_bin in enumerate(bin_list):
-        #print(result_dict)
-        #hold=input('hold')
-        #if temp_bin !=42:
-        #    continue
+def valid_for_autocuration_test_chunk(bins_and_spectra,test_parameters):
+    '''
+    runs valid_for_autocuration_test_one_bin over a chunk of (bin_id, annotations_and_spectra)
+    this is what gets sent to each worker process
+    '''
+    return [
+        valid_for_autocuration_test_one_bin(temp_bin,annotations_and_spectra,**test_parameters)
+        for temp_bin,annotations_and_spectra in bins_and_spectra
+    ]
+
+
+def iterate_bins_and_spectra(database_connection,bin_list,use_bulk_fetch):
+    '''
+    yields (bin_id, annotations_and_spectra) for every bin in bin_list.
+    the bulk fetch is a single streaming query (ascending bin_id order),
+    otherwise it is one select_spectra_for_bin per bin (bin_list order)
+    '''
+    if use_bulk_fetch==True:
+        yield from select_spectra_for_bins_streaming(database_connection,bin_list)
+    else:
+        for temp_bin in bin_list:
+            yield temp_bin,select_spectra_for_bin(database_connection,temp_bin)
+
 
-        print(f'bin number {temp_bin} iteration number {z}')
+def fetch_bins_and_spectra_for_chunk(database_connection,bins_and_spectra_iterator,bins_per_chunk,iteration_offset):
+    '''
+    the parent does all of the reading and the member_of_consensus writes,
+    the workers only ever see plain python lists
+    '''
+    bins_and_spectra=list()
+    for z,(temp_bin,annotations_and_spectra) in enumerate(islice(bins_and_spectra_iterator,bins_per_chunk)):
+        print(f'bin number {temp_bin} iteration number {iteration_offset+z}')
         #note that mz and rt are decided whether or not there is an associated spectrum for 
         #that individual annotation
         #however, it will not be equal to the number of runs for that study
@@ -215,119 +318,85 @@ def valid_for_autocuration_test_wrapper(
         #there is probably a more fine-grained way to do this, but we pass on it for now.
         #note that the annotaitons from blanks and qcs still go into the bin, but the bin is only
         #characterized based on samples
-        annotations_and_spectra=select_spectra_for_bin(database_connection,temp_bin)
         temp_annotation_ids=[element[0] for element in annotations_and_spectra]
-        temp_spectra_text=[element[1] for element in annotations_and_spectra]
-        print(f'{len(temp_spectra_text)} spectra') #len(temp_spectra_text))
-
-        #there was a problem in that certain modules expect spectra as mz/rt pairs and some (the ones i wrote)
-        #expect parallel lists. fixing this would be an easy way to reduce code complexity
-        #but the main goal for the moment is a working version by next week
-        temp_spectra_paired=parse_text_spectra_return_pairs(temp_spectra_text)
-        #we need to clean to make sure that subsequent stuff is homogenous
-        temp_spectra_paired_cleaned=get_cleaned_spectra(temp_spectra_paired,noise_level,ms2_tolerance)
-        
-        #now, the general logic is to perform a series of tests
-        #the tests are all kind of different. at each place, if a test is failed, the procedure is the same.
-        #get the consensus spectrum for each cluster and set the auto_curate_valid to False
-        #the tests (order matters, for example, it doesnt make sense to do entropy test if mz range is very small
-        #1) membership percent of largest cluster
-        #2) total members of cluster
-        #3) spread of mz
-        #4) entropy
-
-        #an aside: the reason for tangling "determine if something is valid for autocuration"
-        #and "generate the consensus spectrum" was that making the clusters is an expensive process
-        #and we wanted to do it once
-        
         update_member_of_consensus(database_connection,temp_annotation_ids,1)
-         
-        #1)
-        #get the cluster assignments. if there is only one spectrum, then cheese it and assign the cluster membership manually
-        if len(temp_spectra_paired_cleaned)==1:
-            cluster_assignments=np.array([1])
-            cluster_assignments_sorted_by_membership=np.array([1])
-            biggest_cluster_percent=1.0
-        else:
-            cluster_assignments=perform_hierarchical_clustering_routine(temp_spectra_paired_cleaned,similarity_metric,ms2_tolerance,mutual_distance_for_cluster)
-            #count membership and get cluster percent
-            cluster_assignments_sorted_by_membership,biggest_cluster_percent=get_cluster_membership_ordering(cluster_assignments)       
-        if biggest_cluster_percent<largest_cluster_membership_parameter_percent:
-            consensus_spectra_text=generate_consensus_spectra_text_wrapper(
-                temp_spectra_paired_cleaned,
-                cluster_assignments,
-                cluster_assignments_sorted_by_membership,
-                ms2_tolerance,
-                minimum_percent_present,
-                bin_space_tolerance
-            )
-            result_dict['bin_id'].append(temp_bin)
-            result_dict['valid_for_autocuration'].append(0)
-            result_dict['consensus_spectrum'].append(consensus_spectra_text)
-            continue
-
-        #2)
-        if len(cluster_assignments)<bin_spectra_count_minimum_parameter:
-            consensus_spectra_text=generate_consensus_spectra_text_wrapper(
-                temp_spectra_paired_cleaned,
-                cluster_assignments,
-                cluster_assignments_sorted_by_membership,
-                ms2_tolerance,
-                minimum_percent_present,
-                bin_space_tolerance
-            )
-            result_dict['bin_id'].append(temp_bin)
-            result_dict['valid_for_autocuration'].append(0)
-            result_dict['consensus_spectrum'].append(consensus_spectra_text)       
-            continue    
-
-        #3
-        mz_range=get_mz_range_of_bin_spectra(temp_spectra_paired_cleaned)
-        if mz_range<min_mz_range_parameter:
-            consensus_spectra_text=generate_consensus_spectra_text_wrapper(
-                temp_spectra_paired_cleaned,
-                cluster_assignments,
-                cluster_assignments_sorted_by_membership,
-                ms2_tolerance,
-                minimum_percent_present,
-                bin_space_tolerance
-            )
-            result_dict['bin_id'].append(temp_bin)
-            #Note that a fail here still means we curate with it
-            result_dict['valid_for_autocuration'].append(1)
-            result_dict['consensus_spectrum'].append(consensus_spectra_text)       
-            continue    
-
-        #4
-        bin_entropy=get_bin_entropy(temp_spectra_paired_cleaned,False,ms2_tolerance)
-        if bin_entropy>max_entropy_parameter:
-            consensus_spectra_text=generate_consensus_spectra_text_wrapper(
-                temp_spectra_paired_cleaned,
-                cluster_assignments,
-                cluster_assignments_sorted_by_membership,
-                ms2_tolerance,
-                minimum_percent_present,
-                bin_space_tolerance
-            )
-            result_dict['bin_id'].append(temp_bin)
-            result_dict['valid_for_autocuration'].append(0)
-            result_dict['consensus_spectrum'].append(consensus_spectra_text)       
-            continue  
-        elif bin_entropy<max_entropy_parameter:
-            consensus_spectra_text=generate_consensus_spectra_text_wrapper(
-                temp_spectra_paired_cleaned,
-                cluster_assignments,
-                cluster_assignments_sorted_by_membership,
-                ms2_tolerance,
-                minimum_percent_present,
-                bin_space_tolerance
-            )
-            result_dict['bin_id'].append(temp_bin)
-            result_dict['valid_for_autocuration'].append(1)
-            result_dict['consensus_spectrum'].append(consensus_spectra_text)       
-            continue  
+        bins_and_spectra.append((temp_bin,annotations_and_spectra))
+    return bins_and_spectra
+
 
+def valid_for_autocuration_test_wrapper(
+    database_connection,
+    bin_list,
+    similarity_metric,
+    ms2_tolerance,
+    noise_level,
+    mutual_distance_for_cluster,
+    use_ceiling,
+    max_entropy_parameter,
+    min_mz_range_parameter,
+    largest_cluster_membership_parameter_percent,
+    bin_spectra_count_minimum_parameter,
+    minimum_percent_present,
+    bin_space_tolerance,
+    n_workers=1,
+    bins_per_chunk=50,
+    use_bulk_fetch=True,
+    clustering_backend='dense'
+):
+    '''
+    with use_bulk_fetch the spectra of all bins come from one streaming query
+    (select_spectra_for_bins_streaming) instead of one query per bin.
+    with n_workers>1 the bins are tested in a process pool, bins_per_chunk bins at a time.
+    the spectra for a chunk are fetched by the parent right before it is submitted and at most
+    2*n_workers chunks are in flight, so memory stays bounded.
+    results are collected in submission order, so the dataframe comes out in the order that the bins
+    were fetched (ascending bin_id with use_bulk_fetch, bin_list order without) regardless of n_workers
+    '''
+    test_parameters={
+        'similarity_metric':similarity_metric,
+        'ms2_tolerance':ms2_tolerance,
+        'noise_level':noise_level,
+        'mutual_distance_for_cluster':mutual_distance_for_cluster,
+        'use_ceiling':use_ceiling,
+        'max_entropy_parameter':max_entropy_parameter,
+        'min_mz_range_parameter':min_mz_range_parameter,
+        'largest_cluster_membership_parameter_percent':largest_cluster_membership_parameter_percent,
+        'bin_spectra_count_minimum_parameter':bin_spectra_count_minimum_parameter,
+        'minimum_percent_present':minimum_percent_present,
+        'bin_space_tolerance':bin_space_tolerance,
+        'clustering_backend':clustering_backend
+    }
 
+    bins_and_spectra_iterator=iterate_bins_and_spectra(database_connection,bin_list,use_bulk_fetch)
+
+    result_rows=list()
+    if n_workers==1:
+        bins_fetched=0
+        while True:
+            bins_and_spectra=fetch_bins_and_spectra_for_chunk(database_connection,bins_and_spectra_iterator,bins_per_chunk,bins_fetched)
+            if len(bins_and_spectra)==0:
+                break
+            bins_fetched+=len(bins_and_spectra)
+            result_rows.extend(valid_for_autocuration_test_chunk(bins_and_spectra,test_parameters))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures_in_flight=deque()
+            bins_fetched=0
+            while True:
+                bins_and_spectra=fetch_bins_and_spectra_for_chunk(database_connection,bins_and_spectra_iterator,bins_per_chunk,bins_fetched)
+                if len(bins_and_spectra)==0:
+                    break
+                bins_fetched+=len(bins_and_spectra)
+                futures_in_flight.append(
+                    executor.submit(valid_for_autocuration_test_chunk,bins_and_spectra,test_parameters)
+                )
+                if len(futures_in_flight)>=2*n_workers:
+                    result_rows.extend(futures_in_flight.popleft().result())
+            while len(futures_in_flight)>0:
+                result_rows.extend(futures_in_flight.popleft().result())
 
     #after going through all bins, we convert to panda and return
-    return pd.DataFrame.from_dict(result_dict)
\ No newline at end of file
+    return pd.DataFrame.from_records(
+        [element for element in result_rows if element is not None],
+        columns=['bin_id','valid_for_autocuration','consensus_spectrum']
+    )
@@ -1,6 +1,18 @@
 import os, sys, subprocess, time
+import heapq, pickle, tempfile
 import pandas as pd
 import numpy as np
+from alignment_tables import metadata_row_count
+from alignment_tables import read_alignment_header
+from alignment_tables import feature_table_dtypes
+from alignment_tables import read_alignment_tables
+from alignment_tables import run_columns
+from alignment_tables import summary_columns
+from alignment_tables import assemble_alignment_sheet
+from alignment_tables import feature_sheet_values
+from alignment_tables import write_alignment_tables
+from alignment_tables import is_alignment_arrow
+from alignment_tables import pycutter_header_row_values
 
 class PyCutterProcessing:
 
@@ -8,35 +20,398 @@ class PyCutterProcessing:
     Class for processing raw MS-DIAL alignment export for metabolomics data curation readiness
     """
 
+    # Step 1 column order, these go before MS/MS assigned
+    columns_to_rearrange = ["MSI", "Alignment ID", "Average Rt(min)", "Average Mz", "Reference RT", "deltaRT",
+                            "Metabolite name", "INCHIKEY", "Adduct type", "Algorithm", "Weighted MS2 Score",
+                            "Sample Average", "MS2Score", "Dot product", "Reverse dot product", "SAmax/BKavg",
+                            "Percent CV", "Spectrum reference file name", "Post curation result", "Fill %"]
+
+    # Step 1 columns reported as integers
+    columns_to_round = ["Sample Average", "SAmax/BKavg", "Percent CV", "Weighted MS2 Score", "MS2Score",
+                        "Dot product", "Reverse dot product"]
+
     def __init__(self):
 
         self.deleted = 0
         self.log = []
 
 
-    def process_alignment(self, raw_alignment_file, metadata_file=''):
+    def process_alignment(self, raw_alignment_file, metadata_file='', intensity_dtype=np.float64, as_tables=False):
 
         """
         Step 1: processes raw MS-DIAL alignment file for metabolomics data curation readiness
+        With as_tables, Raw and Reduced are (feature table, run metadata) pairs for write_alignment_tables
+        instead of sheets
         """
 
         self.log = []
         self.write_to_log('Initiated PyCutter processing for ' + os.path.basename(raw_alignment_file))
 
-        # Convert files into pandas DataFrames
-        df = pd.read_table(raw_alignment_file, header=None, index_col=False)
-
-        # Define 5th row as column header
-        df.columns = df.iloc[4]
-        df = df.drop(df.index[4])
+        # Read features and run metadata (Class, File type, Injection order, Batch ID) as separate typed tables
+        df, run_metadata = read_alignment_tables(raw_alignment_file, intensity_dtype=intensity_dtype)
 
         # Check whether data is positive or negative mode
+        _mode = self.find_ion_mode(df)
+
+        df = self.add_feature_columns(df, run_metadata)
+
+        self.write_to_log('Added columns: MSI, deltaRT, MS2Score, Weighted MS2Score, SAmax/BKavg, Percent CV, Sample Average, Sample Max')
+
+        # Rearrange columns
+        df = self.movecol(df, cols_to_move=self.columns_to_rearrange, ref_col='MS/MS assigned', place='Before')
+
+        self.write_to_log('Rearranged columns successfully.')
+
+        # Fill sample ID's from BulkLoader metadata into alignment
+        if metadata_file != '':
+            run_metadata = self.fill_sample_ids(run_metadata, metadata_file, _mode)
+
+        self.write_to_log('Filled sample ID''s from BulkLoader metadata file successfully')
+
+        # Copy data to second sheet
+        df2 = df.copy()
+
+        self.write_to_log('Created Reduced sheet.')
+
+        df2 = self.categorize_and_filter_features(df2)
+
+        # Remove MS-DIAL summary stats
+        df2 = df2.drop(columns=summary_columns(run_metadata))
+        reduced_run_metadata = run_metadata.drop(index=summary_columns(run_metadata))
+        reduced_run_metadata.attrs['header_row_values'] = pycutter_header_row_values
+
+        self.write_to_log('Removed MS-DIAL summary stats in Reduced sheet')
+
+        # Move all duplicate features to new DataFrame
+        df2_metabolites = df2[df2['Feature Index'] == 3]
+        duplicates = df2_metabolites[df2_metabolites.duplicated(subset=['INCHIKEY'], keep=False)]
+
+        self.log_duplicates(duplicates)
+
+        rectified_duplicates = self.rectify_duplicates(duplicates)
+
+        # Re-append duplicates to Reduced sheet
+        metabolites_no_duplicates = df2_metabolites[
+            ~(df2_metabolites.duplicated(subset=['INCHIKEY'], keep=False))]
+        internal_standards = df2[df2['Feature Index'] == 2]
+        unknowns = df2[df2['Feature Index'] == 4]
+
+        reduced_sheet = pd.concat([metabolites_no_duplicates, unknowns])
+        reduced_sheet.sort_values(by=['Feature Index', 'SAmax/BKavg'], inplace=True)
+
+        df2 = pd.concat([internal_standards, rectified_duplicates, reduced_sheet], ignore_index=True)
+
+        self.write_to_log('Rectified ' + str(len(rectified_duplicates)) + ' duplicates')
+        self.write_to_log('Sorted metabolites by SAmax/BKavg')
+
+        # Report columns as integers
+        df2 = self.round_report_columns(df2)
+
+        # Header formatting
+        df = self.alignment_output(df, run_metadata, as_tables)
+        df2 = self.alignment_output(df2, reduced_run_metadata, as_tables)
+
+        # Final save of formatted spreadsheet
+        # plb - redundant with other saves?
+        # filename = 'Project_ID.tsv'
+        # df2.to_csv(filename, sep='\t', header=False, index=False)
+
+        # Final log updates
+        raw_size = len(df[0]) + len(run_metadata.columns) + 1 if as_tables else len(df)
+        reduced_size = len(df2[0]) + len(reduced_run_metadata.columns) + 1 if as_tables else len(df2)
+        expected = raw_size - self.deleted
+        self.write_to_log('Raw sheet size: ' + str(raw_size))
+        self.write_to_log('Reduced sheet size: ' + str(reduced_size))
+        self.write_to_log('Expected Reduced sheet size: ' + str(expected))
+        self.write_to_log('Processing complete')
+        step_one_log = self.log.copy()
+
+        return {
+            "Raw": df,
+            "Reduced": df2,
+            "Log": step_one_log
+        }
+
+    def process_alignment_streaming(self, raw_alignment_file, reduced_output_file, metadata_file='',
+                                    chunk_size=50000, intensity_dtype=np.float64, raw_output_file=None):
+
+        """
+        Step 1 for alignments too large to hold in memory: writes the same Reduced sheet as process_alignment
+        (as saved with header=None) to reduced_output_file, reading the alignment chunk_size features at a time.
+        Raw is written to raw_output_file if one is given.
+        Internal standards are written as they come. The rest of every chunk is filtered, sorted and spilled to a
+        temporary run file, and only the INCHIKEYs of its metabolites are kept. At the end the duplicated
+        metabolites, the only features held in memory, are rectified and written, and the runs are merged into
+        the sorted rest of the sheet. The filter messages are logged once per chunk
+        The output is written as it goes, so it is always a sheet, not an .arrow alignment
+        """
+
+        if is_alignment_arrow(reduced_output_file) or (raw_output_file is not None and is_alignment_arrow(raw_output_file)):
+            raise ValueError('process_alignment_streaming writes sheets, use process_alignment(as_tables=True) for .arrow output')
+
+        self.log = []
+        self.write_to_log('Initiated PyCutter processing for ' + os.path.basename(raw_alignment_file))
+
+        column_names, run_positions, run_metadata = read_alignment_header(raw_alignment_file)
+
+        # Check whether data is positive or negative mode, from the adducts alone
+        adducts = pd.read_csv(raw_alignment_file, sep='\t', header=None, index_col=False,
+                              skiprows=metadata_row_count + 1, usecols=[column_names.index('Adduct type')], dtype=object)
+        _mode = self.find_ion_mode(adducts.set_axis(['Adduct type'], axis='columns'))
+
+        # Fill sample ID's from BulkLoader metadata into alignment
+        if metadata_file != '':
+            run_metadata = self.fill_sample_ids(run_metadata, metadata_file, _mode)
+
+        reduced_run_metadata = run_metadata.drop(index=summary_columns(run_metadata))
+        chunks = pd.read_csv(raw_alignment_file, sep='\t', header=None, index_col=False, skiprows=metadata_row_count + 1,
+                             dtype=feature_table_dtypes(column_names, run_positions, intensity_dtype), chunksize=chunk_size)
+
+        raw_size = 0
+        reduced_size = 0
+        inchikey_counts = dict()
+        run_addresses = []
+
+        with tempfile.TemporaryDirectory() as run_directory:
+
+            for chunk_number, df in enumerate(chunks):
+
+                # The index of every chunk continues from the last one, so it keeps the order of the features
+                df.columns = column_names
+                df = self.add_feature_columns(df, run_metadata)
+                df = self.movecol(df, cols_to_move=self.columns_to_rearrange, ref_col='MS/MS assigned', place='Before')
+
+                if chunk_number == 0:
+                    self.write_to_log('Added columns: MSI, deltaRT, MS2Score, Weighted MS2Score, SAmax/BKavg, Percent CV, Sample Average, Sample Max')
+                    self.write_to_log('Rearranged columns successfully.')
+                    self.write_to_log('Filled sample ID''s from BulkLoader metadata file successfully')
+
+                if raw_output_file is not None:
+                    if chunk_number == 0:
+                        self.write_sheet_rows(assemble_alignment_sheet(df[0:0], run_metadata), raw_output_file, 'w')
+                    self.write_sheet_rows(df, raw_output_file, run_metadata=run_metadata)
+                raw_size = raw_size + len(df)
+
+                if chunk_number == 0:
+                    self.write_to_log('Created Reduced sheet.')
+                df2 = self.categorize_and_filter_features(df)
+
+                # Remove MS-DIAL summary stats
+                df2 = df2.drop(columns=summary_columns(run_metadata))
+
+                if chunk_number == 0:
+                    reduced_columns = df2.columns
+                    self.write_sheet_rows(assemble_alignment_sheet(
+                        df2[0:0], reduced_run_metadata, header_row_values=pycutter_header_row_values), reduced_output_file, 'w')
+
+                # Internal standards come first in the Reduced sheet, in alignment order
+                internal_standards = df2[df2['Feature Index'] == 2]
+                self.write_sheet_rows(self.round_report_columns(internal_standards), reduced_output_file, run_metadata=reduced_run_metadata)
+                reduced_size = reduced_size + len(internal_standards)
+
+                # Count INCHIKEYs for the duplicate pass
+                df2_metabolites = df2[df2['Feature Index'] == 3]
+                for inchikey, count in df2_metabolites['INCHIKEY'].value_counts(dropna=False).items():
+                    inchikey = None if pd.isnull(inchikey) else inchikey
+                    inchikey_counts[inchikey] = inchikey_counts.get(inchikey, 0) + count
+
+                # Metabolites and unknowns wait on disk, sorted the way the Reduced sheet is
+                run = pd.concat([df2_metabolites, df2[df2['Feature Index'] == 4]])
+                run_addresses.append(os.path.join(run_directory, 'run_' + str(chunk_number) + '.pkl'))
+                self.write_run(run.sort_values(by=['Feature Index', 'SAmax/BKavg']), run_addresses[-1])
+
+            self.write_to_log('Removed MS-DIAL summary stats in Reduced sheet')
+
+            # Move all duplicate features to new DataFrame, one run at a time
+            duplicated_inchikeys = set(inchikey for inchikey, count in inchikey_counts.items() if count > 1)
+            duplicates = [run[self.find_duplicates(run, duplicated_inchikeys)]
+                          for run_address in run_addresses for run in self.read_run(run_address)]
+            duplicates = pd.concat(duplicates).sort_index() if len(duplicates) > 0 else pd.DataFrame(columns=reduced_columns)
+
+            self.log_duplicates(duplicates)
+
+            rectified_duplicates = self.rectify_duplicates(duplicates)
+            self.write_sheet_rows(self.round_report_columns(rectified_duplicates), reduced_output_file, run_metadata=reduced_run_metadata)
+            reduced_size = reduced_size + len(rectified_duplicates)
+
+            self.write_to_log('Rectified ' + str(len(rectified_duplicates)) + ' duplicates')
+
+            # Merge the runs, without the duplicates, into the rest of the Reduced sheet
+            for reduced_batch in self.merge_runs(run_addresses, duplicated_inchikeys, reduced_columns):
+                self.write_sheet_rows(self.round_report_columns(reduced_batch), reduced_output_file, run_metadata=reduced_run_metadata)
+                reduced_size = reduced_size + len(reduced_batch)
+
+            self.write_to_log('Sorted metabolites by SAmax/BKavg')
+
+        # Final log updates, counting the metadata and header rows like process_alignment
+        expected = raw_size + 5 - self.deleted
+        self.write_to_log('Raw sheet size: ' + str(raw_size + 5))
+        self.write_to_log('Reduced sheet size: ' + str(reduced_size + 5))
+        self.write_to_log('Expected Reduced sheet size: ' + str(expected))
+        self.write_to_log('Processing complete')
+        step_one_log = self.log.copy()
+
+        return {
+            "Raw": raw_output_file,
+            "Reduced": reduced_output_file,
+            "Log": step_one_log
+        }
+
+    def write_sheet_rows(self, df, output_file, mode='a', run_metadata=None):
+
+        """
+        Writes rows of a sheet the way the step 1 sheets are saved (tab separated, no header, no index)
+        Feature rows come with their run_metadata, to be written like assemble_alignment_sheet writes them
+        """
+
+        if run_metadata is not None:
+            df = pd.DataFrame(feature_sheet_values(df, run_metadata))
+        df.to_csv(output_file, mode=mode, sep='\t', header=False, index=False)
+
+    def write_run(self, run, run_address, batch_size=10000):
+
+        """
+        Spills a sorted run of features to disk, in batches that can be read back one at a time
+        """
+
+        with open(run_address, 'wb') as run_file:
+            for start in range(0, len(run), batch_size):
+                pickle.dump(run[start:start + batch_size], run_file)
+
+    def read_run(self, run_address):
+
+        """
+        Generator, yields the batches of a run written by write_run
+        """
+
+        with open(run_address, 'rb') as run_file:
+            while True:
+                try:
+                    yield pickle.load(run_file)
+                except EOFError:
+                    return
+
+    def find_duplicates(self, run, duplicated_inchikeys):
+
+        """
+        Which metabolites of a run have an INCHIKEY that was seen more than once (None stands for a missing one)
+        """
+
+        inchikeys = run['INCHIKEY']
+        duplicated = inchikeys.isin([inchikey for inchikey in duplicated_inchikeys if inchikey is not None])
+        if None in duplicated_inchikeys:
+            duplicated = duplicated | inchikeys.isnull()
+        return (run['Feature Index'] == 3) & duplicated
+
+    def merge_runs(self, run_addresses, duplicated_inchikeys, reduced_columns, batch_size=10000):
+
+        """
+        Generator, merges the sorted runs of process_alignment_streaming, without the duplicates, and yields the
+        result in batches of batch_size features. The order is the one of sorting all of them at once by
+        Feature Index and SAmax/BKavg (missing last), ties in alignment order
+        """
+
+        def run_rows(run_address):
+            for run in self.read_run(run_address):
+                run = run[~self.find_duplicates(run, duplicated_inchikeys)]
+                sort_keys = zip(run['Feature Index'].tolist(), run['SAmax/BKavg'].isnull().tolist(),
+                                run['SAmax/BKavg'].fillna(0).tolist(), run.index.tolist())
+                yield from zip(sort_keys, run.itertuples(index=False, name=None))
+
+        merged_rows = []
+        for sort_key, row in heapq.merge(*[run_rows(run_address) for run_address in run_addresses], key=lambda element: element[0]):
+            merged_rows.append(row)
+            if len(merged_rows) == batch_size:
+                yield pd.DataFrame(merged_rows, columns=reduced_columns)
+                merged_rows = []
+        if len(merged_rows) > 0:
+            yield pd.DataFrame(merged_rows, columns=reduced_columns)
+
+    def log_duplicates(self, duplicates):
+
+        """
+        Logs the duplicate features about to be rectified
+        """
+
+        duplicates_list = duplicates.copy()
+        duplicates_list['Alignment ID'] = duplicates_list['Alignment ID'].astype(str)
+        duplicates_list = duplicates_list[['Alignment ID', 'Metabolite name']].values.tolist()
+        self.write_to_log('Capturing ' + str(len(duplicates)) + ' duplicates...')
+        self.write_to_log('\n'.join(' '.join(metabo) for metabo in duplicates_list))
+
+    def round_report_columns(self, df2):
+
+        """
+        Reports the score and ratio columns as integers
+        """
+
+        df2 = df2.copy()
+        for column in self.columns_to_round:
+            df2[column] = df2[column].astype(float).round()
+        return df2
+
+    def rectify_duplicates(self, duplicates):
+
+        """
+        Labels the features that share an INCHIKEY: within each group, the [M+H]+/[M-H]- adducts whose
+        Weighted MS2 Score is within 5 of the best one compete, the highest Sample Average among them is 'Correct'
+        and all other features of the group are 'Duplicate'. Returns the groups in INCHIKEY order, the competing
+        features of each group first, and the features without an INCHIKEY unlabelled at the end.
+        Same output as the per-INCHIKEY loop it replaced (rectify_duplicates_looped in benchmark_duplicate_rectification.py)
+        """
+
+        # Sort duplicates
+        duplicates = duplicates.sort_values(by=['INCHIKEY', 'Metabolite name', 'Weighted MS2 Score', 'Sample Average'],
+                                            ascending=[True, True, False, False])
+
+        inchikeys = duplicates['INCHIKEY']
+        score = duplicates['Weighted MS2 Score']
+        sample_average = duplicates['Sample Average']
+        adducts = duplicates['Adduct type'].isin(['[M+H]+', '[M-H]-'])
+
+        # Features without an INCHIKEY go to the end, 'null' ones stay in place, both unlabelled
+        no_inchikey = inchikeys.isnull().to_numpy()
+        null_inchikey = (inchikeys == 'null').to_numpy()
+
+        # Threshold, winner and labels of every group, broadcast back to its features
+        threshold_score = score.where(adducts).groupby(inchikeys).transform('max') - 5
+        above_threshold = adducts & (score >= threshold_score)
+        below_threshold = ((score >= threshold_score) & ~adducts) | (score < threshold_score)
+        group_has_above = above_threshold.groupby(inchikeys).transform('any').astype(bool)
+        greatest_sample_average = sample_average.where(above_threshold).groupby(inchikeys).transform('max')
+
+        algorithm = np.where(above_threshold & (sample_average == greatest_sample_average), 'Correct', 'Duplicate').astype(object)
+        algorithm[null_inchikey] = duplicates['Algorithm'].to_numpy(dtype=object)[null_inchikey]
+
+        # A group with competing features lists them first and keeps the others only if they are below the threshold
+        kept = ((~group_has_above | above_threshold | below_threshold).to_numpy() | null_inchikey) & ~no_inchikey
+        group_part = np.where(group_has_above & ~above_threshold & ~null_inchikey, 1, 0)[kept]
+        group_order = pd.factorize(inchikeys)[0][kept]
+        row_order = np.lexsort((np.arange(len(group_order)), group_part, group_order))
+
+        labelled_duplicates = duplicates[kept].copy()
+        labelled_duplicates['Algorithm'] = pd.Series(algorithm[kept], index=labelled_duplicates.index, dtype=object)
+
+        return pd.concat([labelled_duplicates.iloc[row_order], duplicates[no_inchikey]], ignore_index=True)
+
+    def find_ion_mode(self, df):
+
+        """
+        Positive or Negative from the adducts of the features, Error if neither is found
+        """
+
         if '[M+H]+' in df['Adduct type'].astype(str).values:
-            _mode = 'Positive'
+            return 'Positive'
         elif '[M-H]-' in df['Adduct type'].astype(str).values:
-            _mode = 'Negative'
+            return 'Negative'
         else:
-            _mode = 'Error'
+            return 'Error'
+
+    def add_feature_columns(self, df, run_metadata):
+
+        """
+        Adds the PyCutter columns to a typed feature table (see alignment_tables.read_alignment_tables)
+        """
 
         # Add Algorithm column
         df['Algorithm'] = None
@@ -45,86 +420,69 @@ class PyCutterProcessing:
         df['MSI'] = None
 
         # Add Delta RT column
-        df['deltaRT'] = df['Reference RT'].astype(float) - df['Average Rt(min)'].astype(float)
+        df['deltaRT'] = df['Reference RT'] - df['Average Rt(min)']
 
         # Add MS2Score column
         df['Dot product'] = df['Dot product'].fillna(0)
         df['Reverse dot product'] = df['Reverse dot product'].fillna(0)
-        df.loc[0:4, 'Dot product'] = np.nan
-        df.loc[0:4, 'Reverse dot product'] = np.nan
-        df['MS2Score'] = (df['Dot product'].astype(float) + df['Reverse dot product'].astype(float)) / 2
+        df['MS2Score'] = (df['Dot product'] + df['Reverse dot product']) / 2
 
         # Fill NaN values in Fragment presence column
         df['Fragment presence %'] = df['Fragment presence %'].fillna(0)
-        df.loc[0:4, 'Fragment presence %'] = np.nan
 
         # Add SAmax/BKavg column
-        sample_cols = np.array(df.iloc[1] == 'Sample')  # Indices of columns of samples
-        blank_cols = np.array(df.iloc[1] == 'Blank')  # Indices of columns of blanks
+        sample_intensities = df[run_columns(run_metadata, 'Sample')].astype(float)
+        blank_intensities = df[run_columns(run_metadata, 'Blank')].astype(float)
+        pool_intensities = df[run_columns(run_metadata, 'QC')].astype(float)
 
-        sample_max = df.iloc[4:, sample_cols].astype(float).max(axis=1)  # Maximum value over sample columns
-        blank_average = df.iloc[4:, blank_cols].astype(float).mean(axis=1)  # Average value over blank columns
+        sample_max = sample_intensities.max(axis=1)  # Maximum value over sample columns
+        blank_average = blank_intensities.mean(axis=1)  # Average value over blank columns
 
         df['Sample Max'] = sample_max
         df['SAmax/BKavg'] = sample_max / blank_average
         df['SAmax/BKavg'] = np.where(df['SAmax/BKavg'] == np.inf, df['Sample Max'], df['SAmax/BKavg'])
 
         # Add Percent CV column for duplicates
-        pool_cols = np.array(df.iloc[1] == 'QC')  # Indices of columns of samples
-        pool_std = df.iloc[4:, pool_cols].astype(float).std(axis=1)  # Standard deviation over sample columns
-        pool_average = df.iloc[4:, pool_cols].astype(float).mean(axis=1)  # Average value over sample columns
-        df['Percent CV'] = (pool_std / pool_average) * 100
+        df['Percent CV'] = (pool_intensities.std(axis=1) / pool_intensities.mean(axis=1)) * 100
 
         # Add Sample Average column for duplicates
-        sample_cols = np.array(df.iloc[1] == 'Sample')  # Indices of columns of samples
-        sample_average = df.iloc[4:, sample_cols].astype(float).mean(axis=1)  # Average value over sample columns
-        df['Sample Average'] = sample_average
+        df['Sample Average'] = sample_intensities.mean(axis=1)
 
         # Calculate weighted MS2 score for duplicate handling
-        r = 0.5 * df['Reverse dot product'].astype(float)
-        d = 0.3 * df['Dot product'].astype(float)
-        f = 0.2 * df['Fragment presence %'].astype(float)
+        r = 0.5 * df['Reverse dot product']
+        d = 0.3 * df['Dot product']
+        f = 0.2 * df['Fragment presence %']
         df['Weighted MS2 Score'] = r + d + f
 
-        self.write_to_log('Added columns: MSI, deltaRT, MS2Score, Weighted MS2Score, SAmax/BKavg, Percent CV, Sample Average, Sample Max')
-
-        # Rearrange columns
-        columns_to_rearrange = ["MSI", "Alignment ID", "Average Rt(min)", "Average Mz", "Reference RT", "deltaRT",
-                                "Metabolite name", "INCHIKEY", "Adduct type", "Algorithm", "Weighted MS2 Score",
-                                "Sample Average", "MS2Score", "Dot product", "Reverse dot product", "SAmax/BKavg",
-                                "Percent CV", "Spectrum reference file name", "Post curation result", "Fill %"]
-
-        df = self.movecol(df, cols_to_move=columns_to_rearrange, ref_col='MS/MS assigned', place='Before')
-
-        self.write_to_log('Rearranged columns successfully.')
-
-        # Fill sample ID's from BulkLoader metadata into alignment
-        if metadata_file != '':
+        return df
 
-            mdf = pd.read_csv(metadata_file)
+    def fill_sample_ids(self, run_metadata, metadata_file, _mode):
 
-            if _mode == 'Positive':
+        """
+        Writes the sample ID's of the BulkLoader metadata file (second column, files of the other polarity left out)
+        into the Batch ID of the first run columns, one per sample
+        """
 
-                negatives = mdf.loc[mdf['Filename'].str.contains(r'Neg', na=False)]
-                mdf['Filename'].drop(negatives.index, inplace=True)
+        mdf = pd.read_csv(metadata_file)
 
-            elif _mode == 'Negative':
+        if _mode == 'Positive':
+            mdf = mdf.loc[~mdf['Filename'].str.contains(r'Neg', na=False)]
 
-                positives = mdf.loc[mdf['Filename'].str.contains(r'Pos', na=False)]
-                mdf['Filename'].drop(positives.index, inplace=True)
+        elif _mode == 'Negative':
+            mdf = mdf.loc[~mdf['Filename'].str.contains(r'Pos', na=False)]
 
-            mdf = mdf.transpose()
-            sample_index = 40 + np.count_nonzero(sample_cols)
-            df.iloc[3:4, 40:sample_index] = mdf[1:2]
+        sample_count = len(run_columns(run_metadata, 'Sample'))
+        run_metadata = run_metadata.copy()
+        run_metadata.iloc[0:sample_count, run_metadata.columns.get_loc('Batch ID')] = mdf.iloc[0:sample_count, 1].values
 
-        self.write_to_log('Filled sample ID''s from BulkLoader metadata file successfully')
+        return run_metadata
 
-        # Copy data to second sheet
-        df2 = df.copy()
-        df2 = df2.reset_index()
-        df2.drop('index', 1, inplace=True)
+    def categorize_and_filter_features(self, df2):
 
-        self.write_to_log('Created Reduced sheet.')
+        """
+        Types every feature (Internal Standard, Metabolite, Unknown), drops the ones below the SAmax/BKavg limits
+        and marks poorly matched annotations as Unknown. Works on any subset of the features
+        """
 
         # Identify annotated features, unknowns, and features without MS2
         df2.loc[(df2['Metabolite name'] != 'Unknown'), 'Feature Type'] = 'Metabolite'
@@ -212,131 +570,7 @@ class PyCutterProcessing:
         self.write_to_log('Deleting ' + str(len(about_to_drop)) + ' unknowns in Reduced sheet with SAmax/BKavg < 5...')
         self.write_to_log(', '.join(' '.join(metabo) for metabo in dropped_list))
 
-        # Remove MS-DIAL summary stats
-        df2 = df2.drop(columns=df2.columns[(df2 == 'Average').any()])
-        df2 = df2.drop(columns=df2.columns[(df2 == 'Stdev').any()])
-
-        self.write_to_log('Removed MS-DIAL summary stats in Reduced sheet')
-
-        # Move all duplicate features to new DataFrame
-        df3 = df2[0:4]
-        df2_metabolites = df2[df2['Feature Index'] == 3]
-        duplicates = df2_metabolites[df2_metabolites.duplicated(subset=['INCHIKEY'], keep=False)]
-
-        duplicates_list = duplicates.copy()
-        duplicates_list['Alignment ID'] = duplicates_list['Alignment ID'].astype(str)
-        duplicates_list = duplicates_list[['Alignment ID', 'Metabolite name']].values.tolist()
-        self.write_to_log('Capturing ' + str(len(duplicates)) + ' duplicates...')
-        self.write_to_log('\n'.join(' '.join(metabo) for metabo in duplicates_list))
-
-        # Sort duplicates
-        duplicates.sort_values(by=['INCHIKEY', 'Metabolite name', 'Weighted MS2 Score', 'Sample Average'],
-                               ascending=[True, True, False, False], inplace=True)
-
-        # Grabs list of all unique InChIKeys
-        entries = duplicates[~duplicates.duplicated(subset=['INCHIKEY'])]
-        entries['INCHIKEY'] = entries['INCHIKEY'].fillna('null')
-        entries = entries['INCHIKEY'].tolist()
-
-        # For each unique metabolite,
-        for entry in entries:
-
-            loopdf = duplicates[duplicates['INCHIKEY'] == entry]
-
-            if entry != 'null':
-                # If the difference in Weighted MS2 Score < 5 between duplicate [M+H]+ adducts,
-                adducts_only = loopdf[(loopdf['Adduct type'] == '[M+H]+') | (loopdf['Adduct type'] == '[M-H]-')]
-
-                threshold_score = adducts_only['Weighted MS2 Score'].max() - 5
-
-                entries_above_threshold = loopdf[(loopdf['Weighted MS2 Score'] >= threshold_score) &
-                                                 ((loopdf['Adduct type'] == '[M+H]+') | (
-                                                             loopdf['Adduct type'] == '[M-H]-'))]
-
-                entries_below_threshold = loopdf[((loopdf['Weighted MS2 Score'] >= threshold_score) &
-                                                  (loopdf['Adduct type'] != '[M+H]+') & (loopdf['Adduct type'] != '[M-H]-'))
-                                                 | (loopdf['Weighted MS2 Score'] < threshold_score)]
-
-                if not entries_above_threshold.empty:
-                    # Choose the duplicate with the highest sample average
-                    greatest_sample_average = entries_above_threshold['Sample Average'].max()
-                    entries_above_threshold.loc[
-                        (entries_above_threshold['Sample Average'] == greatest_sample_average), 'Algorithm'] = 'Correct'
-
-                    # Mark duplicates for machine learning
-                    entries_above_threshold.loc[
-                        (entries_above_threshold['Sample Average'] != greatest_sample_average), 'Algorithm'] = 'Duplicate'
-                    entries_below_threshold['Algorithm'] = 'Duplicate'
-
-                    metabolite = entries_above_threshold.append(entries_below_threshold)
-
-                    # Append set of duplicates to sheet
-                    df3 = df3.append(metabolite, ignore_index=True)
-
-                else:
-                    loopdf['Algorithm'] = 'Duplicate'
-
-                    # Append set of duplicates to sheet
-                    df3 = df3.append(loopdf, ignore_index=True)
-
-            else:
-
-                df3 = df3.append(loopdf, ignore_index=True)
-
-            # After duplicate has been rectified, drop it from DataFrame
-            duplicates = duplicates.drop(duplicates[duplicates['INCHIKEY'] == entry].index)
-
-        # If duplicate rectifying algorithm misses any duplicates for any reason,
-        # they will still be re-appended to df3, the DataFrame containing rectified duplicates
-        df3 = df3.append(duplicates, ignore_index=True)
-        rectified_duplicates = df3.drop([0, 1, 2, 3])
-
-        # Re-append duplicates to Reduced sheet
-        reduced_header = df2[0:4]
-        metabolites_no_duplicates = df2_metabolites[
-            ~(df2_metabolites.duplicated(subset=['INCHIKEY'], keep=False))]
-        internal_standards = df2[df2['Feature Index'] == 2]
-        unknowns = df2[df2['Feature Index'] == 4]
-
-        reduced_sheet = pd.concat([metabolites_no_duplicates, unknowns])
-        reduced_sheet.sort_values(by=['Feature Index', 'SAmax/BKavg'], inplace=True)
-
-        df2 = pd.concat([reduced_header, internal_standards, rectified_duplicates, reduced_sheet])
-
-        self.write_to_log('Rectified ' + str(len(rectified_duplicates)) + ' duplicates')
-        self.write_to_log('Sorted metabolites by SAmax/BKavg')
-
-        # Report columns as integers
-        for column in ["Sample Average", "SAmax/BKavg", "Percent CV", "Weighted MS2 Score", "MS2Score",
-                       "Dot product", "Reverse dot product"]:
-            df2[column] = df2[column].astype(float).round()
-
-        # Reset index
-        new_index = pd.Index(range(0, len(df2)))
-        df2 = df2.set_index(new_index)
-
-        # Header formatting
-        df = self.insert_row(4, df, list(df.columns))
-        df2 = self.insert_row(4, df2, list(df2.columns))
-
-        # Final save of formatted spreadsheet
-        # plb - redundant with other saves?
-        # filename = 'Project_ID.tsv'
-        # df2.to_csv(filename, sep='\t', header=False, index=False)
-
-        # Final log updates
-        expected = len(df) - self.deleted
-        self.write_to_log('Raw sheet size: ' + str(len(df)))
-        self.write_to_log('Reduced sheet size: ' + str(len(df2)))
-        self.write_to_log('Expected Reduced sheet size: ' + str(expected))
-        self.write_to_log('Processing complete')
-        step_one_log = self.log.copy()
-
-        return {
-            "Raw": df,
-            "Reduced": df2,
-            "Log": step_one_log
-        }
+        return df2
 
     def do_things_for_one_alignment_polarity(
         self,
@@ -346,51 +580,36 @@ class PyCutterProcessing:
         temp_polarity
     ):
         '''
+        reads one (curated) step 1 sheet and returns its (feature table, run metadata),
+        with the step 2 columns added and the unneeded ones removed
         '''
-        if '.xlsx' in one_polarity_alignment_address:
-            one_polarity_alignment_panda = pd.read_excel(one_polarity_alignment_address, sheet_name='Reduced', header=None, index_col=False)
-        else:
-            one_polarity_alignment_panda =pd.read_csv(one_polarity_alignment_address,sep='\t',header=None,index_col=False)
-            print(one_polarity_alignment_panda)
-            #hold=input('hold')
-        # Define 5th row as column header
-        one_polarity_alignment_panda.columns = one_polarity_alignment_panda.iloc[4]
-        one_polarity_alignment_panda.drop(one_polarity_alignment_panda.index[4], inplace=True)
-
-        print(one_polarity_alignment_panda)
-        #hold=input('hold')
-
-        for column in columns_to_remove:
-            if column in one_polarity_alignment_panda.columns:
-                one_polarity_alignment_panda.drop(column, inplace=True, axis=1)
+        one_polarity_alignment_panda, run_metadata = read_alignment_tables(one_polarity_alignment_address)
 
-        print(one_polarity_alignment_panda.INCHIKEY)
-        #hold=input('inchikey?')
+        one_polarity_alignment_panda = one_polarity_alignment_panda.drop(
+            columns=[column for column in columns_to_remove if column in one_polarity_alignment_panda.columns]
+        )
 
         one_polarity_alignment_panda['Polarity'] = temp_polarity
-        one_polarity_alignment_panda.loc[0:4, 'Polarity'] = np.nan
 
         # Add Pearson's correlation coefficient column
         one_polarity_alignment_panda['Pearson'] = 0
-        one_polarity_alignment_panda.loc[0:4, 'Pearson'] = np.nan
-        one_polarity_alignment_panda = self.movecol(one_polarity_alignment_panda, cols_to_move=rearranged_columns, ref_col='MSI', place='After')
+        one_polarity_alignment_panda = self.movecol(one_polarity_alignment_panda, cols_to_move=columns_to_rearrange, ref_col='MSI', place='After')
 
         # Mark leftover unknowns
         one_polarity_alignment_panda['MSI'] = one_polarity_alignment_panda['MSI'].fillna('')
         # one_polarity_alignment_panda[5:].loc[one_polarity_alignment_panda['MSI'] == '', ['Metabolite name', 'INCHIKEY',
         #                                      'Feature Type', 'Feature Index']] = ['Unknown', 'null', 'Unknown', 4]
 
-        # Save copies of pos/neg alignments
-        one_polarity_alignment_panda_final = one_polarity_alignment_panda.copy()
-        return one_polarity_alignment_panda_final
+        return one_polarity_alignment_panda, run_metadata
 
 
-    def combine_annotations(self, columns_to_remove,columns_to_rearrange,pos_alignment=None, neg_alignment=None):
+    def combine_annotations(self, columns_to_remove,columns_to_rearrange,pos_alignment=None, neg_alignment=None, as_tables=False):
 
         """
         Step 2: 
         a) remove many columns from either positive or negative
         b) if both are present, combine annotations from positive/negative alignments into a single uniform dataset
+        With as_tables, the sheets are (feature table, run metadata) pairs for write_alignment_tables
         """
 
         #this function returns a dict, where each of these are values
@@ -410,14 +629,14 @@ class PyCutterProcessing:
         #self.write_to_log("Marked leftover unknowns as INCHIKEY = null and MSI = 4")
 
         if pos_alignment !=None:
-            df_pos_final=self.do_things_for_one_alignment_polarity(
+            df_pos_final, pos_run_metadata =self.do_things_for_one_alignment_polarity(
                 pos_alignment,
                 columns_to_remove,
                 columns_to_rearrange,
                 'pos')
 
         if neg_alignment !=None:
-            df_neg_final =self.do_things_for_one_alignment_polarity(
+            df_neg_final, neg_run_metadata =self.do_things_for_one_alignment_polarity(
                 neg_alignment,
                 columns_to_remove,
                 columns_to_rearrange,
@@ -425,230 +644,206 @@ class PyCutterProcessing:
 
         if pos_alignment!=None and neg_alignment!=None:
             # Move filenames from negative alignment into positive alignment
-            sample_cols = np.array(df_neg.iloc[1] == 'Sample')
-            sample_index = 10 + np.count_nonzero(sample_cols)
-            df_pos.iloc[2:3, 10:sample_index] = df_neg.columns.values.tolist()[10:sample_index]
+            combined_run_metadata = pos_run_metadata.copy()
+            combined_run_metadata['Injection order'] = neg_run_metadata.index.tolist()
 
-            blank_cols = np.array(df_neg.iloc[1] == 'Blank')
-            blank_index = sample_index + np.count_nonzero(blank_cols)
-            df_pos.iloc[2:3, sample_index:blank_index] = df_neg.columns.values.tolist()[sample_index:blank_index]
+            # Change columns in negative alignment for correct combining
+            df_unique, df_combined = self.merge_polarities(
+                df_pos_final,
+                df_neg_final.set_axis(df_pos_final.columns, axis='columns'),
+                run_columns(combined_run_metadata, 'Sample'),
+                run_columns(combined_run_metadata, 'Blank'),
+                run_columns(combined_run_metadata, 'QC')
+            )
 
-            qc_cols = np.array(df_neg.iloc[1] == 'QC')
-            qc_index = blank_index + np.count_nonzero(qc_cols)
-            df_pos.iloc[2:3, blank_index:qc_index] = df_neg.columns.values.tolist()[blank_index:qc_index]
 
-            # Change columns in negative alignment for correct combining
-            df_neg.columns = df_pos.columns
-
-            # Create Combined Annotated sheet
-            df_neg = df_neg[5:]
-            df_combined = df_pos.append(df_neg, ignore_index=True)
-
-            self.write_to_log("Size of Combined Annotated sheet: " + str(len(df_combined)))
-            self.write_to_log("Expected size: " + str(len(df_pos) + len(df_neg)))
-
-            # Initialize 'Unique Annotated' DataFrame
-            df_unique = df_combined[0:4]
-
-            # Remove unknowns
-            df_combined.drop(df_combined[df_combined['Feature Index'] == 4].index, inplace=True)
-
-            self.write_to_log("Removed unknowns from Combined Annotated sheet")
-
-            # Get features (inchikeys) that appear in both positive and negative mode
-            df_combined_features = df_combined[df_combined['Feature Index'] == 3]
-            duplicate_inchikeys = df_combined_features[df_combined_features.duplicated(subset=['INCHIKEY'], keep=False)]
 
-            # Get list of unique inchikeys
-            inchikeys = duplicate_inchikeys[~duplicate_inchikeys.duplicated(subset=['INCHIKEY'])]
-            inchikeys['INCHIKEY'] = inchikeys['INCHIKEY'].fillna('null')
-            inchikeys = inchikeys['INCHIKEY'].tolist()
+        #do some cleanup
+        if pos_alignment !=None:
+            df_pos_final = df_pos_final.drop(columns=['Feature Index', 'Feature Type', 'Pearson', 'Weighted MS2 Score'])
+            df_pos_final = df_pos_final.rename(columns={'Adduct type':'adduct','Polarity':'Polarity/Filename'})
+
+            # Injection order is left out, the other metadata rows are labelled in the Polarity/Filename column
+            pos_run_metadata = pos_run_metadata.iloc[:, [0, 1, 3]].rename_axis('Polarity/Filename')
+            pos_run_metadata.columns = ['Class', 'Sample Type', 'WRONG Name from collaborator']
+            #injected to fix output
+
+            df_pos_final = self.movecol(df_pos_final, 
+                cols_to_move=['adduct','comment','bin_id','english_name_top_match','curation_text','Polarity/Filename'],
+
+                ref_col='INCHIKEY', place='After')
+            df_pos_final = self.alignment_output(df_pos_final, pos_run_metadata, as_tables)
+            
+        if neg_alignment !=None:
+            df_neg_final = df_neg_final.drop(columns=['Feature Index', 'Feature Type', 'Pearson'])
+            df_neg_final = self.alignment_output(df_neg_final, neg_run_metadata, as_tables)
+
+        if pos_alignment!=None and neg_alignment!=None:
+            df_unique = self.alignment_output(df_unique.drop(columns=['Feature Index', 'Feature Type']), combined_run_metadata, as_tables)
+            df_combined = self.alignment_output(df_combined.drop(columns=['Feature Index', 'Feature Type']), combined_run_metadata, as_tables)
 
-            self.write_to_log(
-                "Capturing " + str(len(inchikeys)) + " features found in both positive and negative modes for merging")
 
-            # For each inchikey,
-            for index, inchikey in enumerate(inchikeys):
 
-                # Put the duplicate pos/neg features into a single DataFrame
-                loopdf = duplicate_inchikeys[duplicate_inchikeys['INCHIKEY'] == inchikey]
+        self.write_to_log("Sorting by INCHIKEY and cleaning up sheets...")
+        self.write_to_log("Combining complete")
+
+        step_two_log = self.log.copy()
 
-                if inchikey != 'null':
+        return {
+            "Unique Annotated": df_unique,
+            "Combined Annotated": df_combined,
+            "Pos All Features": df_pos_final,
+            "Neg All Features": df_neg_final,
+            "Log": step_two_log
+        }
 
-                    # Remove the duplicate features from the Combined Annotated sheet for now
-                    df_combined.drop(df_combined[(df_combined['INCHIKEY'] == inchikey)
-                                                & (df_combined['Feature Index'] == 3)].index, inplace=True)
 
-                    # Now separate pos/neg features into separate DataFrames
-                    pos_feature = loopdf.loc[loopdf['Polarity'] == 'pos']
-                    neg_feature = loopdf.loc[loopdf['Polarity'] == 'neg']
+    def alignment_output(self, feature_table, run_metadata, as_tables):
 
-                    if not neg_feature.empty and not pos_feature.empty:
+        """
+        The sheet of a feature table and its run metadata, or with as_tables the pair itself
+        """
 
-                        pos_rt = pos_feature['Average Rt(min)'].astype(float).values
-                        neg_rt = neg_feature['Average Rt(min)'].astype(float).values
-                        rt_difference = abs(pos_rt - neg_rt)
+        if as_tables:
+            return feature_table, run_metadata
+        return assemble_alignment_sheet(feature_table, run_metadata)
 
-                        # Calculate Pearson's correlation coefficient
-                        sample_cols = np.array(df_combined.iloc[1] == 'Sample')
-                        pos_feature_sample_intensity = pos_feature.iloc[:, sample_cols].astype(float)
-                        neg_feature_sample_intensity = neg_feature.iloc[:, sample_cols].astype(float)
+    def merge_polarities(self, df_pos, df_neg, sample_columns, blank_columns, qc_columns):
 
-                        sample_cols = np.array(df_combined.iloc[1] == 'Sample')
-                        pos_feature_sample_average = pos_feature.iloc[:, sample_cols].fillna(0).astype(
-                            float).values.mean(axis=1)
-                        neg_feature_sample_average = neg_feature.iloc[:, sample_cols].fillna(0).astype(
-                            float).values.mean(axis=1)
+        """
+        Merges the annotated features of the positive and negative alignments (same columns, see combine_annotations)
+        and returns the (Unique Annotated, Combined Annotated) feature tables.
+        Every INCHIKEY with one feature in each polarity is paired: pos and neg are pivoted on INCHIKEY once,
+        the Pearson correlations of all pairs are one matrix operation and the RT match and intensity averages
+        are column-wise. benchmark_polarity_merge.py checks it against a second, one-INCHIKEY-at-a-time implementation
+        """
 
-                        x_diff = pos_feature_sample_intensity.sub(pos_feature_sample_average.squeeze())
-                        y_diff = neg_feature_sample_intensity.sub(neg_feature_sample_average.squeeze())
+        df_combined, df_combined_features, duplicated = self.find_features_in_both_polarities(df_pos, df_neg)
+        inchikeys = df_combined_features['INCHIKEY']
 
-                        x_diff_squared = x_diff ** 2
-                        y_diff_squared = y_diff ** 2
+        # INCHIKEYs with exactly one feature in each polarity are merged, other duplicates are left for human review
+        is_pos = df_combined_features['Polarity'] == 'pos'
+        is_neg = df_combined_features['Polarity'] == 'neg'
+        has_inchikey = inchikeys.notnull() & (inchikeys != 'null')
+        paired = (duplicated & has_inchikey
+                  & (is_pos.groupby(inchikeys).transform('sum') == 1)
+                  & (is_neg.groupby(inchikeys).transform('sum') == 1))
 
-                        numerator = x_diff.astype(float).values * y_diff.astype(float).values
-                        numerator = numerator.sum()
-                        denominator = (x_diff_squared.astype(float).values.sum() * y_diff_squared.astype(
-                            float).values.sum()) ** 0.5
+        # One row per INCHIKEY in each polarity, neg in the order of pos
+        pos_feature = df_combined_features[paired & is_pos]
+        neg_feature = df_combined_features[paired & is_neg]
+        neg_feature = neg_feature.iloc[pd.Index(neg_feature['INCHIKEY']).get_indexer(pos_feature['INCHIKEY'])]
 
-                        # Set Pearson correlation coefficient values
-                        loopdf['Pearson'] = numerator / denominator
-                        pos_feature['Pearson'] = numerator / denominator
-                        neg_feature['Pearson'] = numerator / denominator
+        rt_difference = np.abs(pos_feature['Average Rt(min)'].to_numpy(dtype=float) - neg_feature['Average Rt(min)'].to_numpy(dtype=float))
+        rt_match = rt_difference <= 0.1
 
-                        # Comma-separate values together
-                        merged_feature = pos_feature.copy()
-                        merged_feature['MSI'] = pos_feature['MSI'].astype(str).values + ', ' + neg_feature['MSI'].astype(str).values
-                        merged_feature['Alignment ID'] = pos_feature['Alignment ID'].astype(str).values + ', ' + \
-                                                        neg_feature['Alignment ID'].astype(str).values
-                        merged_feature['Average Rt(min)'] = pos_feature['Average Rt(min)'].astype(str).values + ', ' + \
-                                                            neg_feature['Average Rt(min)'].astype(str).values
-                        merged_feature['Average Mz'] = pos_feature['Average Mz'].astype(str).values + ', ' + \
-                                                    neg_feature['Average Mz'].astype(str).values
-                        merged_feature['Polarity'] = 'both'
+        # Calculate Pearson's correlation coefficient of every pair at once
+        pearson = self.pearson_of_rows(pos_feature[sample_columns].to_numpy(dtype=float),
+                                       neg_feature[sample_columns].to_numpy(dtype=float))
 
-                        # Average sample intensities
-                        sample_cols = np.array(df_combined.iloc[1] == 'Sample')
-                        pos_feature_sample_intensity = pos_feature.iloc[:, sample_cols].astype(float).values
-                        neg_feature_sample_intensity = neg_feature.iloc[:, sample_cols].astype(float).values
-                        merged_feature.iloc[:, sample_cols] = (
-                                                                        pos_feature_sample_intensity + neg_feature_sample_intensity) / 2
-                        merged_feature.iloc[:, sample_cols] = merged_feature.iloc[:, sample_cols].round(0)
+        # Set Pearson correlation coefficient values, in the Combined Annotated sheet too
+        pos_feature = pos_feature.assign(Pearson=pd.Series(pearson, index=pos_feature.index, dtype=object))
+        neg_feature = neg_feature.assign(Pearson=pd.Series(pearson, index=neg_feature.index, dtype=object))
+        df_combined.loc[pos_feature.index, 'Pearson'] = pos_feature['Pearson']
+        df_combined.loc[neg_feature.index, 'Pearson'] = neg_feature['Pearson']
 
-                        # Average blank intensities
-                        blank_cols = np.array(df_combined.iloc[1] == 'Blank')
-                        pos_feature_blank = pos_feature.iloc[:, blank_cols].astype(float).values
-                        neg_feature_blank = neg_feature.iloc[:, blank_cols].astype(float).values
-                        merged_feature.iloc[:, blank_cols] = (pos_feature_blank + neg_feature_blank) / 2
-                        merged_feature.iloc[:, blank_cols] = merged_feature.iloc[:, blank_cols].round(0)
+        # Comma-separate values together
+        merged_feature = pos_feature[rt_match].copy()
+        for column in ['MSI', 'Alignment ID', 'Average Rt(min)', 'Average Mz']:
+            merged_feature[column] = self.join_polarity_values(pos_feature[column][rt_match], neg_feature[column][rt_match])
+        merged_feature['Polarity'] = 'both'
 
-                        # Average pool intensities
-                        qc_cols = np.array(df_combined.iloc[1] == 'QC')
-                        pos_feature_qc = pos_feature.iloc[:, qc_cols].astype(float).values
-                        neg_feature_qc = neg_feature.iloc[:, qc_cols].astype(float).values
-                        merged_feature.iloc[:, qc_cols] = (pos_feature_qc + neg_feature_qc) / 2
-                        merged_feature.iloc[:, qc_cols] = merged_feature.iloc[:, qc_cols].round(0)
+        # Average sample, blank and pool intensities
+        for columns in [sample_columns, blank_columns, qc_columns]:
+            merged_feature[columns] = np.round(
+                (pos_feature[columns][rt_match].to_numpy(dtype=float) + neg_feature[columns][rt_match].to_numpy(dtype=float)) / 2, 0)
 
-                        # Add pos/neg features with Pearson correlation back to Combined Annotated sheet
-                        df_combined = df_combined.append(loopdf, ignore_index=True)
+        # If RT match, add merged feature to Unique Annotated sheet... if not, add pos/neg features separately
+        for name in pos_feature['Metabolite name'][~rt_match]:
+            self.write_to_log("No RT match for " + name + ", leaving as-is")
 
-                        # If RT match, add merged feature to Unique Annotated sheet... if not, add pos/neg features separately
-                        if rt_difference <= 0.1:
+        no_rt_match = pd.concat([pos_feature[~rt_match], neg_feature[~rt_match]]).assign(Pearson='No RT match')
 
-                            df_unique = df_unique.append(merged_feature, ignore_index=True)
+        # If there's some sort of mistake, add both features for human review
+        unpaired = df_combined_features[duplicated & has_inchikey & ~paired].assign(Pearson='Error 1')
+        null_inchikeys = df_combined_features[duplicated & (inchikeys == 'null')].assign(Pearson='Error 2')
+        missing_inchikeys = df_combined_features[duplicated & inchikeys.isnull()]
 
-                        else:
+        self.write_to_log("Did not merge " + str(np.count_nonzero(~rt_match)) + " features found in both positive/negative mode due to significant RT difference")
 
-                            loopdf['Pearson'] = 'No RT match'
-                            df_unique = df_unique.append(loopdf, ignore_index=True)
-                            self.write_to_log(
-                                "No RT match for " + pos_feature['Metabolite name'].iloc[0] + ", leaving as-is")
+        df_unique = pd.concat([merged_feature, no_rt_match, unpaired, null_inchikeys, missing_inchikeys])
 
-                    else:
+        return self.finish_unique_and_combined(df_unique, df_combined, df_combined_features, duplicated)
 
-                        # If there's some sort of mistake, add both features for human review
-                        loopdf['Pearson'] = 'Error 1'
-                        df_unique = df_unique.append(loopdf, ignore_index=True)
+    def find_features_in_both_polarities(self, df_pos, df_neg):
 
+        """
+        Stacks the pos and neg features into the Combined Annotated sheet, without unknowns, and returns it with
+        its annotated metabolites and which of them share an INCHIKEY
+        """
 
-                else:
+        df_combined = pd.concat([df_pos, df_neg], ignore_index=True)
+        df_combined['Pearson'] = df_combined['Pearson'].astype(object)
 
-                    # If there's some sort of mistake, add both features for human review
-                    loopdf['Pearson'] = 'Error 2'
-                    df_unique = df_unique.append(loopdf, ignore_index=True)
+        self.write_to_log("Size of Combined Annotated sheet: " + str(len(df_combined)))
+        self.write_to_log("Expected size: " + str(len(df_pos) + len(df_neg)))
 
-                # After duplicate inchikey has been rectified, drop it from DataFrame
-                duplicate_inchikeys.drop(duplicate_inchikeys[
-                                            duplicate_inchikeys['INCHIKEY'] == inchikey].index, inplace=True)
+        # Remove unknowns
+        df_combined = df_combined[df_combined['Feature Index'] != 4].copy()
 
-            # Append rest of duplicates DataFrame, if merging algorithm misses any duplicates for any reason
-            df_unique = df_unique.append(duplicate_inchikeys, ignore_index=True)
+        self.write_to_log("Removed unknowns from Combined Annotated sheet")
 
-            self.write_to_log("Did not merge " + str(len(df_unique) - len(
-                inchikeys)) + " features found in both positive/negative mode due to significant RT difference")
+        # Get features (inchikeys) that appear in both positive and negative mode
+        df_combined_features = df_combined[df_combined['Feature Index'] == 3]
+        duplicated = df_combined_features.duplicated(subset=['INCHIKEY'], keep=False)
 
-            # Add remaining features to Unique Annotated
-            internal_standards = df_combined[df_combined['Feature Index'] == 2]
-            non_duplicate_inchikeys = df_combined_features.drop_duplicates(subset=['INCHIKEY'], keep=False)
-            df_unique = df_unique.append([internal_standards, non_duplicate_inchikeys], ignore_index=True)
+        self.write_to_log(
+            "Capturing " + str(df_combined_features['INCHIKEY'][duplicated].nunique(dropna=False)) + " features found in both positive and negative modes for merging")
 
-            self.write_to_log("Size of Unique Annotated sheet: " + str(len(df_unique)))
+        return df_combined, df_combined_features, duplicated
 
-            # Sort by INCHIKEY
-            df_unique.sort_values(by=['Feature Index', 'INCHIKEY'], inplace=True)
-            df_unique.reset_index(drop=True, inplace=True)
-            df_combined.sort_values(by=['Feature Index', 'INCHIKEY'], inplace=True)
-            df_combined.reset_index(drop=True, inplace=True)
+    def finish_unique_and_combined(self, df_unique, df_combined, df_combined_features, duplicated):
 
+        """
+        Adds the internal standards and the features found only once to the Unique Annotated sheet
+        and sorts both sheets
+        """
 
+        # Add remaining features to Unique Annotated
+        internal_standards = df_combined[df_combined['Feature Index'] == 2]
+        non_duplicate_inchikeys = df_combined_features[~duplicated]
+        df_unique = pd.concat([df_unique, internal_standards, non_duplicate_inchikeys], ignore_index=True)
 
-        #do some cleanup
-        if pos_alignment !=None:
-            df_pos_final.drop(columns=['Feature Index', 'Feature Type', 'Pearson'], inplace=True)
-            df_pos_final.drop('Weighted MS2 Score',axis='columns',inplace=True)
-            print(df_pos_final.columns)
-            df_pos_final.rename(columns={'Adduct type':'adduct','Polarity':'Polarity/Filename'},inplace=True)
-            df_pos_final = self.insert_row(4, df_pos_final, list(df_pos_final.columns))
-            df_pos_final.drop(2,axis='index',inplace=True)
-            df_pos_final.reset_index(drop=True,inplace=True)
-            df_pos_final.at[0,'Polarity/Filename']='Class'
-            df_pos_final.at[1,'Polarity/Filename']='Sample Type'
-            df_pos_final.at[2,'Polarity/Filename']='WRONG Name from collaborator'
-            print(df_pos_final)
-            print(df_pos_final.INCHIKEY)
-            #hold=input('asdf')
-            #injected to fix output
+        self.write_to_log("Size of Unique Annotated sheet: " + str(len(df_unique)))
 
-            df_pos_final = self.movecol(df_pos_final, 
-                cols_to_move=['adduct','comment','bin_id','english_name_top_match','curation_text','Polarity/Filename'],
+        # Sort by INCHIKEY
+        df_unique = df_unique.sort_values(by=['Feature Index', 'INCHIKEY'], kind='stable', ignore_index=True)
+        df_combined = df_combined.sort_values(by=['Feature Index', 'INCHIKEY'], kind='stable', ignore_index=True)
 
-                ref_col='INCHIKEY', place='After')
-            
-        if neg_alignment !=None:
-            df_neg_final.drop(columns=['Feature Index', 'Feature Type', 'Pearson'], inplace=True)
-            df_neg_final = self.insert_row(4, df_neg_final, list(df_neg_final.columns))
+        return df_unique, df_combined
 
-        if pos_alignment!=None and neg_alignment!=None:
-            df_unique.drop(columns=['Feature Index', 'Feature Type'], inplace=True)
-            df_combined.drop(columns=['Feature Index', 'Feature Type'], inplace=True)
-            df_combined = self.insert_row(4, df_combined, list(df_combined.columns))
-            df_unique = self.insert_row(4, df_unique, list(df_unique.columns))
+    def pearson_of_rows(self, x, y):
 
+        """
+        Pearson's correlation coefficient of every row of x with the same row of y
+        """
 
+        # Means with missing intensities counted as 0, a missing intensity makes the coefficient NaN
+        x_diff = x - np.nan_to_num(x).mean(axis=1, keepdims=True)
+        y_diff = y - np.nan_to_num(y).mean(axis=1, keepdims=True)
 
-        self.write_to_log("Sorting by INCHIKEY and cleaning up sheets...")
-        self.write_to_log("Combining complete")
+        numerator = (x_diff * y_diff).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return numerator / ((x_diff ** 2).sum(axis=1) * (y_diff ** 2).sum(axis=1)) ** 0.5
 
-        step_two_log = self.log.copy()
+    def join_polarity_values(self, pos_values, neg_values):
 
-        return {
-            "Unique Annotated": df_unique,
-            "Combined Annotated": df_combined,
-            "Pos All Features": df_pos_final,
-            "Neg All Features": df_neg_final,
-            "Log": step_two_log
-        }
+        """
+        'pos value, neg value' for two aligned columns
+        """
 
+        return [str(pos_value) + ', ' + str(neg_value)
+                for pos_value, neg_value in zip(pos_values.tolist(), neg_values.tolist())]
 
     def write_to_log(self, text):
 
@@ -709,6 +904,8 @@ class PyCutterProcessing:
 if __name__ == "__main__":
 
     step_to_do=sys.argv[1]
+    #optional, the output as an .arrow directory (or a .tsv) instead of the default sheet
+    output_address=sys.argv[2] if len(sys.argv)>2 else None
 
     # Remove columns generated by MS-DIAL
     columns_to_remove = ['Reference RT', 'deltaRT', 'Total score', 'MS2Score', 'RT similarity',
@@ -733,13 +930,21 @@ if __name__ == "__main__":
     if step_to_do=='one':
         step_one_files=pycutter.process_alignment(
             '../../../data/BRYU005_pipeline_test/step_0_raw_from_ms_dial/BRYU005_pos_alignment_raw.txt',
-            '../../../data/BRYU005_pipeline_test/step_0_raw_from_ms_dial/BRYU005_seq_MetaData.csv'
+            '../../../data/BRYU005_pipeline_test/step_0_raw_from_ms_dial/BRYU005_seq_MetaData.csv',
+            as_tables=True
+        )
+        write_alignment_tables(
+            *step_one_files['Reduced'],
+            output_address or f'../../../data/BRYU005_pipeline_test/step_1_post_pycutter/py_cutter_step_1_output.tsv'
         )
-        step_one_files['Reduced'].to_csv(
+
+
+
+    elif step_to_do=='one_streaming':
+        step_one_files=pycutter.process_alignment_streaming(
+            '../../../data/BRYU005_pipeline_test/step_0_raw_from_ms_dial/BRYU005_pos_alignment_raw.txt',
             f'../../../data/BRYU005_pipeline_test/step_1_post_pycutter/py_cutter_step_1_output.tsv',
-            sep='\t',
-            index=None,
-            header=None
+            '../../../data/BRYU005_pipeline_test/step_0_raw_from_ms_dial/BRYU005_seq_MetaData.csv'
         )
 
 
@@ -748,17 +953,16 @@ if __name__ == "__main__":
         step_two_files=pycutter.combine_annotations(
             columns_to_remove,
             rearranged_columns,
-            pos_alignment='../../../data/BRYU005_pipeline_test/step_1_b_post_auto_curation/pycutter_step_1_autocurated.tsv'
+            pos_alignment='../../../data/BRYU005_pipeline_test/step_1_b_post_auto_curation/pycutter_step_1_autocurated.tsv',
+            as_tables=True
         )
 
 
-        print(step_two_files['Pos All Features'])
+        print(step_two_files['Pos All Features'][0])
 
-        step_two_files['Pos All Features'].to_csv(
-            f'../../../data/BRYU005_pipeline_test/step_2_final_alignment/py_cutter_step_2_output_auto_curated.tsv',
-            sep='\t',
-            index=None,
-            header=None
+        write_alignment_tables(
+            *step_two_files['Pos All Features'],
+            output_address or f'../../../data/BRYU005_pipeline_test/step_2_final_alignment/py_cutter_step_2_output_auto_curated.tsv'
         )
 
     # Step 1 – Processing raw MS-DIAL alignment
@@ -0,0 +1,343 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+'''
+reads ms-dial alignments (and the pycutter sheets made from them) into typed tables.
+
+the sheets look like
+    rows 0-3: run metadata (Class, File type, Injection order, Batch ID). the labels are in one column
+        (the label column, MS/MS spectrum in ms-dial exports) and the values in the run columns right after it
+    row 4: column names
+    rows 5-: one feature per row
+so read as one table every column holds text from the metadata rows and has to be converted before any math.
+here they are split into
+    feature_table: one row per feature. intensities are float (intensity_dtype), the known numeric annotation
+        columns are float/int and everything else is text
+    run_metadata: one row per run column (index), one column per metadata row (Class, File type, ...).
+        the name of the label column is kept as the name of the index
+assemble_alignment_sheet puts the two back together into the sheet layout for writing.
+
+between the pipeline steps the two tables can instead be kept as arrow ipc (feather) files, in a directory whose name
+ends with .arrow (see write_alignment_arrow). every reader here takes either, so the sheet (tsv) is only needed
+for people to look at. pyarrow is only imported when an .arrow alignment is read or written
+'''
+
+metadata_row_count=4
+
+integer_columns=['Alignment ID','Feature Index']
+
+#the numeric annotation columns of ms-dial, and the ones that pycutter step 1 adds
+msdial_float_columns=[
+    'Average Rt(min)','Average Mz','Reference RT','Reference m/z','Fill %','Total score','RT similarity',
+    'Dot product','Reverse dot product','Fragment presence %','S/N average'
+]
+pycutter_float_columns=['deltaRT','MS2Score','Sample Max','SAmax/BKavg','Percent CV','Sample Average','Weighted MS2 Score']
+float_columns=msdial_float_columns+pycutter_float_columns
+
+summary_file_types=['Average','Stdev']
+
+#the values that pycutter step 1 writes into the metadata rows of its own columns
+pycutter_header_row_values={'Feature Type':'Header','Feature Index':0}
+
+#the text that pd.read_csv reads as a missing value by default, so what reading a sheet gives as missing
+sheet_na_values=[
+    '','#N/A','#N/A N/A','#NA','-1.#IND','-1.#QNAN','-NaN','-nan','1.#IND','1.#QNAN','<NA>','N/A','NA','NULL','NaN',
+    'None','n/a','nan','null'
+]
+
+alignment_arrow_suffix='.arrow'
+feature_table_file_name='feature_table.arrow'
+run_metadata_file_name='run_metadata.arrow'
+
+
+def split_header_rows(header_rows,sheet_metadata_row_count=metadata_row_count):
+    '''
+    header_rows are the metadata rows and the column names row of a sheet, read without a header
+    (sheet_metadata_row_count metadata rows, 4 for ms-dial and pycutter step 1, 3 for the all features sheets of step 2).
+    returns (column names, positions of the run columns, run_metadata).
+    the label column is the first column with a value in every metadata row, the run columns are
+    the columns right after it that have a File type
+    '''
+    column_names=header_rows.iloc[sheet_metadata_row_count].tolist()
+    metadata_values=header_rows.iloc[:sheet_metadata_row_count].to_numpy(dtype=object)
+
+    labelled_columns=np.flatnonzero(pd.notna(metadata_values).all(axis=0))
+    if len(labelled_columns)==0:
+        raise ValueError('no run metadata found in the first rows of the alignment')
+    label_position=int(labelled_columns[0])
+
+    run_positions=list()
+    for temp_position in range(label_position+1,len(column_names)):
+        if pd.isna(metadata_values[1,temp_position]):
+            break
+        run_positions.append(temp_position)
+
+    run_metadata=pd.DataFrame(
+        metadata_values[:,run_positions].T,
+        index=pd.Index([column_names[temp_position] for temp_position in run_positions],name=column_names[label_position]),
+        columns=metadata_values[:,label_position].tolist()
+    )
+    return column_names,run_positions,run_metadata
+
+
+def feature_table_dtypes(column_names,run_positions,intensity_dtype):
+    '''
+    {column position: dtype} for reading the feature rows
+    '''
+    run_positions=set(run_positions)
+    dtypes=dict()
+    for temp_position,temp_name in enumerate(column_names):
+        if temp_position in run_positions:
+            dtypes[temp_position]=intensity_dtype
+        elif temp_name in integer_columns:
+            dtypes[temp_position]=np.int64
+        elif temp_name in float_columns:
+            dtypes[temp_position]=np.float64
+        else:
+            dtypes[temp_position]=object
+    return dtypes
+
+
+def read_alignment_header(alignment_address,sheet_metadata_row_count=metadata_row_count):
+    '''
+    (column names, positions of the run columns, run_metadata) of a tab separated sheet, without reading the features
+    '''
+    header_rows=pd.read_csv(
+        alignment_address,sep='\t',header=None,index_col=False,nrows=sheet_metadata_row_count+1,dtype=object
+    )
+    return split_header_rows(header_rows,sheet_metadata_row_count)
+
+
+def read_alignment_tables(alignment_address,intensity_dtype=np.float64):
+    '''
+    reads an ms-dial alignment or a pycutter sheet (tab separated, the Reduced sheet of an .xlsx or an .arrow directory)
+    and returns (feature_table, run_metadata)
+    '''
+    if is_alignment_arrow(alignment_address):
+        feature_table,run_metadata=read_alignment_arrow(alignment_address)
+        for temp_position,temp_name in enumerate(feature_table.columns):
+            if temp_name in run_metadata.index:
+                feature_table.isetitem(temp_position,feature_table.iloc[:,temp_position].astype(intensity_dtype))
+        return feature_table,run_metadata
+    elif '.xlsx' in alignment_address:
+        sheet=pd.read_excel(alignment_address,sheet_name='Reduced',header=None,index_col=False,dtype=object)
+        column_names,run_positions,run_metadata=split_header_rows(sheet.iloc[:metadata_row_count+1])
+        feature_table=sheet.iloc[metadata_row_count+1:].reset_index(drop=True)
+        for temp_position,temp_dtype in feature_table_dtypes(column_names,run_positions,intensity_dtype).items():
+            feature_table.isetitem(temp_position,feature_table.iloc[:,temp_position].astype(temp_dtype))
+    else:
+        column_names,run_positions,run_metadata=read_alignment_header(alignment_address)
+        feature_table=pd.read_csv(
+            alignment_address,
+            sep='\t',
+            header=None,
+            index_col=False,
+            skiprows=metadata_row_count+1,
+            dtype=feature_table_dtypes(column_names,run_positions,intensity_dtype)
+        )
+    feature_table.columns=column_names
+    return feature_table,run_metadata
+
+
+def run_columns(run_metadata,file_type):
+    '''
+    the names of the run columns of one file type (Sample, Blank, QC...), in sheet order
+    '''
+    return run_metadata.index[run_metadata['File type']==file_type].tolist()
+
+
+def summary_columns(run_metadata):
+    '''
+    the ms-dial summary stat columns (Average/Stdev) among the run columns
+    '''
+    return run_metadata.index[run_metadata.isin(summary_file_types).any(axis='columns')].tolist()
+
+
+def assemble_alignment_sheet(feature_table,run_metadata,header_row_values=None,include_column_names=True):
+    '''
+    the sheet layout of feature_table and run_metadata: the metadata rows, the column names (if include_column_names)
+    and then the features, every cell an object. written with header=False and index=False it is the file that
+    read_alignment_tables reads.
+    run columns that do not exist in feature_table are left out, a column in header_row_values gets that value in
+    every metadata row (by default the header_row_values that came with run_metadata from an .arrow alignment)
+    '''
+    if header_row_values is None:
+        header_row_values=run_metadata.attrs.get('header_row_values',dict())
+    column_names=feature_table.columns.tolist()
+
+    #run columns that share a name (summary stats of the same class) are matched up in order.
+    #a name that feature_table has more often than run_metadata goes through the same metadata again
+    #(Average, Stdev, Average, Stdev...) instead of running out
+    metadata_by_name=dict()
+    for temp_name,temp_values in zip(run_metadata.index,run_metadata.to_numpy(dtype=object)):
+        metadata_by_name.setdefault(temp_name,list()).append(temp_values)
+
+    metadata_values=np.full((run_metadata.shape[1],len(column_names)),np.nan,dtype=object)
+    name_counts=dict()
+    for temp_position,temp_name in enumerate(column_names):
+        if temp_name==run_metadata.index.name:
+            metadata_values[:,temp_position]=run_metadata.columns.tolist()
+        elif temp_name in metadata_by_name:
+            name_count=name_counts.get(temp_name,0)
+            metadata_values[:,temp_position]=metadata_by_name[temp_name][name_count%len(metadata_by_name[temp_name])]
+            name_counts[temp_name]=name_count+1
+        elif temp_name in header_row_values:
+            metadata_values[:,temp_position]=header_row_values[temp_name]
+
+    sheet_blocks=[metadata_values]
+    if include_column_names:
+        sheet_blocks.append(np.array([column_names],dtype=object))
+    sheet_blocks.append(feature_sheet_values(feature_table,run_metadata))
+    return pd.DataFrame(np.concatenate(sheet_blocks),columns=column_names)
+
+
+def feature_sheet_values(feature_table,run_metadata):
+    '''
+    the features as an object array for the sheet. whole numbers in the run columns and the ms-dial
+    annotation columns are written without a trailing .0, the way ms-dial writes them
+    (other numbers are written as python writes floats, so 6.460 comes back as 6.46).
+    this is a deliberate change of format from the sheets that step 1 wrote before the typed tables, where
+    Fragment presence % (and Dot product and Reverse dot product in Reduced) were written as floats (49.0, now 49)
+    and decimals kept the trailing zeros of the ms-dial export. the numbers are the same
+    '''
+    feature_values=feature_table.to_numpy(dtype=object)
+    whole_number_columns=set(run_metadata.index).union(msdial_float_columns)
+    for temp_position,temp_name in enumerate(feature_table.columns):
+        if (temp_name not in whole_number_columns) or (not pd.api.types.is_float_dtype(feature_table.dtypes.iloc[temp_position])):
+            continue
+        temp_values=feature_table.iloc[:,temp_position].to_numpy()
+        is_whole=np.isfinite(temp_values)&(temp_values==np.round(temp_values))
+        feature_values[is_whole,temp_position]=[int(temp_value) for temp_value in temp_values[is_whole]]
+    return feature_values
+
+
+def is_alignment_arrow(alignment_address):
+    '''
+    whether alignment_address is an .arrow directory rather than a sheet
+    '''
+    return str(alignment_address).rstrip('/').endswith(alignment_arrow_suffix)
+
+
+def text_values(column):
+    '''
+    the values of a column as text. missing values and the text that reading the sheet turns into missing values
+    (sheet_na_values, like the 'null' INCHIKEY of unknowns) are None, so an .arrow alignment reads back
+    with the same missing values as its sheet
+    '''
+    values=column.to_numpy(dtype=object)
+    is_missing=pd.isna(values)|np.asarray(column.isin(sheet_na_values),dtype=bool)
+    return np.where(is_missing,None,values.astype(str))
+
+
+def write_alignment_arrow(feature_table,run_metadata,alignment_address,header_row_values=None):
+    '''
+    writes feature_table and run_metadata as two uncompressed arrow ipc files in the directory alignment_address,
+    so that read_alignment_arrow can memory map them.
+    numeric columns keep their dtype. every other column, and all of run_metadata, is kept as text, which is
+    what reading the sheet gives back, so ids in mixed columns (like the joined ones of Combined Annotated) stay as
+    written. header_row_values (or the ones run_metadata came with) are stored with the run metadata
+    '''
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    if header_row_values is None:
+        header_row_values=run_metadata.attrs.get('header_row_values',dict())
+    os.makedirs(alignment_address,exist_ok=True)
+
+    feature_arrays=list()
+    for temp_position in range(feature_table.shape[1]):
+        temp_column=feature_table.iloc[:,temp_position]
+        if pd.api.types.is_numeric_dtype(temp_column.dtype):
+            feature_arrays.append(pa.array(temp_column.to_numpy(),from_pandas=True))
+        else:
+            feature_arrays.append(pa.array(text_values(temp_column),type=pa.string()))
+    #arrow tables allow repeated column names, which the ms-dial summary stats have
+    feature_arrow=pa.Table.from_arrays(feature_arrays,names=[str(temp_name) for temp_name in feature_table.columns])
+    feather.write_feather(
+        feature_arrow,os.path.join(alignment_address,feature_table_file_name),compression='uncompressed'
+    )
+
+    run_metadata=run_metadata.reset_index()
+    run_metadata_arrow=pa.Table.from_arrays(
+        [pa.array(text_values(run_metadata[temp_name]),type=pa.string()) for temp_name in run_metadata.columns],
+        names=[str(temp_name) for temp_name in run_metadata.columns]
+    ).replace_schema_metadata({'header_row_values':json.dumps(header_row_values)})
+    feather.write_feather(
+        run_metadata_arrow,os.path.join(alignment_address,run_metadata_file_name),compression='uncompressed'
+    )
+
+
+def read_alignment_arrow(alignment_address,include_features=True):
+    '''
+    (feature_table, run_metadata) of an .arrow directory written by write_alignment_arrow, memory mapped.
+    text columns stay arrow backed strings (no copy into python objects), missing text is missing like in
+    read_alignment_tables, and the header_row_values are put in run_metadata.attrs.
+    without include_features only the run metadata is read (feature_table is None)
+    '''
+    import pyarrow.feather as feather
+
+    feature_table=None
+    if include_features:
+        feature_table=feather.read_table(
+            os.path.join(alignment_address,feature_table_file_name),memory_map=True
+        ).to_pandas()
+
+    run_metadata_arrow=feather.read_table(os.path.join(alignment_address,run_metadata_file_name),memory_map=True)
+    run_metadata=run_metadata_arrow.to_pandas()
+    run_metadata=run_metadata.set_index(run_metadata.columns[0])
+    run_metadata.columns=run_metadata.columns.tolist()
+    run_metadata.attrs['header_row_values']=json.loads(run_metadata_arrow.schema.metadata[b'header_row_values'])
+    return feature_table,run_metadata
+
+
+def write_alignment_tables(feature_table,run_metadata,alignment_address,header_row_values=None):
+    '''
+    writes an alignment as an .arrow directory, or, for any other address, as a tab separated sheet
+    '''
+    if is_alignment_arrow(alignment_address):
+        write_alignment_arrow(feature_table,run_metadata,alignment_address,header_row_values)
+    else:
+        assemble_alignment_sheet(feature_table,run_metadata,header_row_values).to_csv(
+            alignment_address,sep='\t',header=False,index=False
+        )
+
+
+def read_alignment_run_metadata(alignment_address,sheet_metadata_row_count=metadata_row_count):
+    '''
+    the run_metadata of an alignment, without reading the features. sheet_metadata_row_count is the number of
+    metadata rows of a sheet (see split_header_rows), an .arrow alignment has its own
+    '''
+    if is_alignment_arrow(alignment_address):
+        return read_alignment_arrow(alignment_address,include_features=False)[1]
+    return read_alignment_header(alignment_address,sheet_metadata_row_count)[2]
+
+
+def sheet_column_names(column_names):
+    '''
+    column_names as pd.read_csv makes them from a header row: a repeated name (the summary stats of a class)
+    gets .1, .2... appended
+    '''
+    seen_names=set()
+    sheet_names=list()
+    for temp_name in column_names:
+        sheet_name=temp_name
+        repeat_count=0
+        while sheet_name in seen_names:
+            repeat_count+=1
+            sheet_name=f'{temp_name}.{repeat_count}'
+        seen_names.add(sheet_name)
+        sheet_names.append(sheet_name)
+    return sheet_names
+
+
+def read_alignment_feature_rows(alignment_address,sheet_metadata_row_count):
+    '''
+    the features of an alignment with the column names as the header, like reading its sheet
+    with skiprows=sheet_metadata_row_count
+    '''
+    if is_alignment_arrow(alignment_address):
+        feature_table=read_alignment_arrow(alignment_address)[0]
+        return feature_table.set_axis(sheet_column_names(feature_table.columns),axis='columns')
+    return pd.read_csv(alignment_address,sep='\t',skiprows=sheet_metadata_row_count)
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+import sys
+import time
+from PyCutterProcessing import PyCutterProcessing
+
+'''
+times the group-by duplicate rectification against the one-INCHIKEY-at-a-time loop on a synthetic set of
+duplicated features and checks that both give the same rows in the same order with the same labels
+
+usage: python benchmark_duplicate_rectification.py [duplicate_group_count] [sample_count]
+'''
+
+
+def rectify_duplicates_looped(duplicates):
+    '''
+    the one-INCHIKEY-at-a-time loop that PyCutterProcessing.rectify_duplicates replaced
+    '''
+
+    df3 = duplicates[0:0]
+
+    # Sort duplicates
+    duplicates = duplicates.sort_values(by=['INCHIKEY', 'Metabolite name', 'Weighted MS2 Score', 'Sample Average'],
+                                        ascending=[True, True, False, False])
+
+    # Grabs list of all unique InChIKeys
+    entries = duplicates[~duplicates.duplicated(subset=['INCHIKEY'])]
+    entries['INCHIKEY'] = entries['INCHIKEY'].fillna('null')
+    entries = entries['INCHIKEY'].tolist()
+
+    # For each unique metabolite,
+    for entry in entries:
+
+        loopdf = duplicates[duplicates['INCHIKEY'] == entry]
+
+        if entry != 'null':
+            # If the difference in Weighted MS2 Score < 5 between duplicate [M+H]+ adducts,
+            adducts_only = loopdf[(loopdf['Adduct type'] == '[M+H]+') | (loopdf['Adduct type'] == '[M-H]-')]
+
+            threshold_score = adducts_only['Weighted MS2 Score'].max() - 5
+
+            entries_above_threshold = loopdf[(loopdf['Weighted MS2 Score'] >= threshold_score) &
+                                             ((loopdf['Adduct type'] == '[M+H]+') | (
+                                                         loopdf['Adduct type'] == '[M-H]-'))]
+
+            entries_below_threshold = loopdf[((loopdf['Weighted MS2 Score'] >= threshold_score) &
+                                              (loopdf['Adduct type'] != '[M+H]+') & (loopdf['Adduct type'] != '[M-H]-'))
+                                             | (loopdf['Weighted MS2 Score'] < threshold_score)]
+
+            if not entries_above_threshold.empty:
+                # Choose the duplicate with the highest sample average
+                greatest_sample_average = entries_above_threshold['Sample Average'].max()
+                entries_above_threshold.loc[
+                    (entries_above_threshold['Sample Average'] == greatest_sample_average), 'Algorithm'] = 'Correct'
+
+                # Mark duplicates for machine learning
+                entries_above_threshold.loc[
+                    (entries_above_threshold['Sample Average'] != greatest_sample_average), 'Algorithm'] = 'Duplicate'
+                entries_below_threshold['Algorithm'] = 'Duplicate'
+
+                metabolite = pd.concat([entries_above_threshold, entries_below_threshold])
+
+                # Append set of duplicates to sheet
+                df3 = pd.concat([df3, metabolite], ignore_index=True)
+
+            else:
+                loopdf['Algorithm'] = 'Duplicate'
+
+                # Append set of duplicates to sheet
+                df3 = pd.concat([df3, loopdf], ignore_index=True)
+
+        else:
+
+            df3 = pd.concat([df3, loopdf], ignore_index=True)
+
+        # After duplicate has been rectified, drop it from DataFrame
+        duplicates = duplicates.drop(duplicates[duplicates['INCHIKEY'] == entry].index)
+
+    # If duplicate rectifying algorithm misses any duplicates for any reason,
+    # they will still be re-appended to df3, the DataFrame containing rectified duplicates
+    return pd.concat([df3, duplicates], ignore_index=True)
+
+
+def make_duplicate_features(duplicate_group_count,sample_count=30,seed=0):
+    '''
+    the duplicated metabolites of an alignment as process_alignment has them just before rectification:
+    2-6 features per INCHIKEY with a mix of adducts, weighted scores and sample averages (with ties),
+    plus a few features without an INCHIKEY
+    '''
+    rng=np.random.default_rng(seed)
+    group_sizes=rng.integers(2,7,size=duplicate_group_count)
+    inchikeys=np.repeat([f'KEY{i:07d}-XXXX' for i in range(duplicate_group_count)],group_sizes).astype(object)
+    feature_count=len(inchikeys)
+    inchikeys[rng.random(feature_count)<0.005]=np.nan
+
+    duplicates=pd.DataFrame({
+        'Alignment ID':rng.permutation(feature_count),
+        'Metabolite name':np.array([f'cmpd{i}' for i in range(duplicate_group_count)],dtype=object)[
+            np.repeat(np.arange(duplicate_group_count),group_sizes)
+        ],
+        'INCHIKEY':inchikeys,
+        'Adduct type':rng.choice(['[M+H]+','[M+Na]+','[M+NH4]+','[M-H]-'],size=feature_count,p=[0.5,0.2,0.2,0.1]),
+        'Algorithm':None,
+        'Weighted MS2 Score':rng.integers(40,80,size=feature_count).astype(float),
+        'Sample Average':rng.integers(1000,1050,size=feature_count).astype(float),
+        'Feature Index':3
+    })
+    sample_intensities=pd.DataFrame(
+        rng.uniform(0,1e5,size=(feature_count,sample_count)),
+        columns=[f'sample_{i}' for i in range(sample_count)]
+    )
+    return pd.concat([duplicates,sample_intensities],axis='columns').sample(frac=1,random_state=seed)
+
+
+if __name__=="__main__":
+
+    duplicate_group_count=5000
+    sample_count=30
+    if len(sys.argv)>1:
+        duplicate_group_count=int(sys.argv[1])
+    if len(sys.argv)>2:
+        sample_count=int(sys.argv[2])
+
+    duplicates=make_duplicate_features(duplicate_group_count,sample_count)
+    pycutter=PyCutterProcessing()
+
+    start=time.perf_counter()
+    rectified=pycutter.rectify_duplicates(duplicates)
+    grouped_time=time.perf_counter()-start
+
+    start=time.perf_counter()
+    rectified_looped=rectify_duplicates_looped(duplicates)
+    looped_time=time.perf_counter()-start
+
+    pd.testing.assert_frame_equal(rectified,rectified_looped,check_dtype=False)
+    print(
+        f'{duplicate_group_count} duplicate groups ({len(duplicates)} features, {sample_count} samples): '
+        f'group-by {grouped_time:.3f}s loop {looped_time:.2f}s, same rows and labels'
+    )
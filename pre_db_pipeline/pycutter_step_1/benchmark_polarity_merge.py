@@ -0,0 +1,188 @@
+import numpy as np
+import pandas as pd
+import sys
+import time
+from PyCutterProcessing import PyCutterProcessing
+
+'''
+times the pivoted positive/negative merge against a second, one-INCHIKEY-at-a-time implementation on synthetic
+step 2 feature tables. both are checked for the same Unique and Combined Annotated sheets on a smaller pair of alignments first,
+then the pivoted merge is timed on two alignments of feature_count features each
+
+usage: python benchmark_polarity_merge.py [feature_count] [sample_count]
+'''
+
+
+def merge_polarities_looped(pycutter, df_pos, df_neg, sample_columns, blank_columns, qc_columns):
+    '''
+    a second implementation of PyCutterProcessing.merge_polarities, one INCHIKEY at a time, to check it against.
+    this is not the loop that combine_annotations used to run (that one referenced undefined names and could not run):
+    it is that loop rewritten with its rules fixed the same way as merge_polarities. groups that are not one pos + one neg
+    feature go to Unique Annotated as 'Error 1' and stay in Combined Annotated, and the neg table is not cut at row 5
+    '''
+
+    df_combined, df_combined_features, duplicated = pycutter.find_features_in_both_polarities(df_pos, df_neg)
+    duplicate_inchikeys = df_combined_features[duplicated]
+    df_unique = df_combined_features[0:0]
+    not_merged = 0
+
+    # Get list of unique inchikeys
+    inchikeys = duplicate_inchikeys[~duplicate_inchikeys.duplicated(subset=['INCHIKEY'])]
+    inchikeys = inchikeys['INCHIKEY'].fillna('null').tolist()
+
+    # For each inchikey,
+    for inchikey in inchikeys:
+
+        # Put the duplicate pos/neg features into a single DataFrame
+        loopdf = duplicate_inchikeys[duplicate_inchikeys['INCHIKEY'] == inchikey]
+
+        if inchikey != 'null':
+
+            # Now separate pos/neg features into separate DataFrames
+            pos_feature = loopdf.loc[loopdf['Polarity'] == 'pos']
+            neg_feature = loopdf.loc[loopdf['Polarity'] == 'neg']
+
+            if len(pos_feature) == 1 and len(neg_feature) == 1:
+
+                rt_difference = abs(pos_feature['Average Rt(min)'].iloc[0] - neg_feature['Average Rt(min)'].iloc[0])
+
+                # Calculate Pearson's correlation coefficient
+                pearson = pycutter.pearson_of_rows(pos_feature[sample_columns].to_numpy(dtype=float),
+                                               neg_feature[sample_columns].to_numpy(dtype=float))[0]
+
+                # Set Pearson correlation coefficient values
+                loopdf = loopdf.copy()
+                loopdf['Pearson'] = pearson
+                pos_feature = loopdf.loc[loopdf['Polarity'] == 'pos']
+                neg_feature = loopdf.loc[loopdf['Polarity'] == 'neg']
+                df_combined.loc[loopdf.index, 'Pearson'] = pearson
+
+                # Comma-separate values together
+                merged_feature = pos_feature.copy()
+                for column in ['MSI', 'Alignment ID', 'Average Rt(min)', 'Average Mz']:
+                    merged_feature[column] = pycutter.join_polarity_values(pos_feature[column], neg_feature[column])
+                merged_feature['Polarity'] = 'both'
+
+                # Average sample, blank and pool intensities
+                for columns in [sample_columns, blank_columns, qc_columns]:
+                    merged_feature[columns] = np.round(
+                        (pos_feature[columns].to_numpy(dtype=float) + neg_feature[columns].to_numpy(dtype=float)) / 2, 0)
+
+                # If RT match, add merged feature to Unique Annotated sheet... if not, add pos/neg features separately
+                if rt_difference <= 0.1:
+
+                    df_unique = pd.concat([df_unique, merged_feature])
+
+                else:
+
+                    loopdf['Pearson'] = 'No RT match'
+                    df_unique = pd.concat([df_unique, loopdf])
+                    not_merged = not_merged + 1
+                    pycutter.write_to_log(
+                        "No RT match for " + pos_feature['Metabolite name'].iloc[0] + ", leaving as-is")
+
+            else:
+
+                # If there's some sort of mistake, add both features for human review
+                df_unique = pd.concat([df_unique, loopdf.assign(Pearson='Error 1')])
+
+        else:
+
+            # If there's some sort of mistake, add both features for human review
+            df_unique = pd.concat([df_unique, loopdf.assign(Pearson='Error 2')])
+
+        # After duplicate inchikey has been rectified, drop it from DataFrame
+        duplicate_inchikeys = duplicate_inchikeys.drop(duplicate_inchikeys[
+                                    duplicate_inchikeys['INCHIKEY'] == inchikey].index)
+
+    pycutter.write_to_log("Did not merge " + str(not_merged) + " features found in both positive/negative mode due to significant RT difference")
+
+    # Append rest of duplicates DataFrame, if merging algorithm misses any duplicates for any reason
+    df_unique = pd.concat([df_unique, duplicate_inchikeys])
+
+    return pycutter.finish_unique_and_combined(df_unique, df_combined, df_combined_features, duplicated)
+
+
+def make_polarity_feature_tables(feature_count,sample_count=30,blank_count=3,qc_count=5,seed=0):
+    '''
+    (pos table, neg table, sample columns, blank columns, qc columns) like combine_annotations has them
+    after do_things_for_one_alignment_polarity, with the neg columns already renamed to the pos ones.
+    about two thirds of the metabolites of each polarity are found in the other one too, most of them at the same rt,
+    and there are some internal standards, unknowns, INCHIKEYs found twice in one polarity and missing INCHIKEYs
+    '''
+    rng=np.random.default_rng(seed)
+    sample_columns=[f'sample_{i}' for i in range(sample_count)]
+    blank_columns=[f'blank_{i}' for i in range(blank_count)]
+    qc_columns=[f'qc_{i}' for i in range(qc_count)]
+
+    compound_count=int(feature_count*1.5)
+    compound_rt=rng.uniform(0.5,20,size=compound_count)
+    compound_intensity=rng.uniform(1e3,1e6,size=(compound_count,sample_count))
+
+    tables=list()
+    for temp_polarity in ['pos','neg']:
+        temp_compounds=rng.permutation(compound_count)[:feature_count]
+        found_twice=rng.random(feature_count)<0.02
+        temp_compounds[found_twice]=rng.choice(temp_compounds,size=found_twice.sum())
+        feature_index=rng.choice([2,3,4],size=feature_count,p=[0.02,0.6,0.38])
+        inchikeys=np.array([f'KEY{i:07d}-XXXX' for i in temp_compounds],dtype=object)
+        inchikeys[feature_index==2]='Internal Standard'
+        inchikeys[feature_index==4]='null'
+        inchikeys[(feature_index==3)&(rng.random(feature_count)<0.005)]=np.nan
+        rt_shift=np.where(rng.random(feature_count)<0.9,rng.normal(0,0.02,size=feature_count),rng.uniform(0.2,2,size=feature_count))
+
+        table=pd.DataFrame({
+            'MSI':np.where(rng.random(feature_count)<0.5,'2','').astype(object),
+            'Alignment ID':np.arange(feature_count),
+            'Average Rt(min)':np.round(compound_rt[temp_compounds]+rt_shift,3),
+            'Average Mz':np.round(rng.uniform(70,1000,size=feature_count),4),
+            'Metabolite name':np.array([f'cmpd{i}' for i in temp_compounds],dtype=object),
+            'INCHIKEY':inchikeys,
+            'Polarity':temp_polarity,
+            'Pearson':0,
+            'Feature Type':pd.Series(feature_index).map({2:'Internal Standard',3:'Metabolite',4:'Unknown'}).to_numpy(dtype=object),
+            'Feature Index':feature_index
+        })
+        intensities=np.round(compound_intensity[temp_compounds]*rng.uniform(0.3,1.2,size=(feature_count,1))*rng.lognormal(0,0.2,size=(feature_count,sample_count)))
+        intensities[rng.random(intensities.shape)<0.001]=np.nan
+        tables.append(pd.concat([
+            table,
+            pd.DataFrame(intensities,columns=sample_columns),
+            pd.DataFrame(np.round(rng.uniform(0,1e3,size=(feature_count,blank_count))),columns=blank_columns),
+            pd.DataFrame(np.round(rng.uniform(1e3,1e6,size=(feature_count,qc_count))),columns=qc_columns)
+        ],axis='columns'))
+    return tables[0],tables[1],sample_columns,blank_columns,qc_columns
+
+
+if __name__=="__main__":
+
+    feature_count=20000
+    sample_count=30
+    if len(sys.argv)>1:
+        feature_count=int(sys.argv[1])
+    if len(sys.argv)>2:
+        sample_count=int(sys.argv[2])
+
+    for temp_seed in range(3):
+        polarity_tables=make_polarity_feature_tables(2000,sample_count,seed=temp_seed)
+        pycutter=PyCutterProcessing()
+        df_unique,df_combined=pycutter.merge_polarities(*polarity_tables)
+        merge_log=[line[11:] for line in pycutter.log]
+
+        pycutter=PyCutterProcessing()
+        start=time.perf_counter()
+        df_unique_looped,df_combined_looped=merge_polarities_looped(pycutter,*polarity_tables)
+        looped_time=time.perf_counter()-start
+
+        pd.testing.assert_frame_equal(df_unique,df_unique_looped,check_dtype=False)
+        pd.testing.assert_frame_equal(df_combined,df_combined_looped,check_dtype=False)
+        assert merge_log==[line[11:] for line in pycutter.log]
+        print(f'2000+2000 features (seed {temp_seed}): same sheets and log as the one-INCHIKEY-at-a-time implementation, which took {looped_time:.2f}s')
+
+    polarity_tables=make_polarity_feature_tables(feature_count,sample_count)
+    start=time.perf_counter()
+    df_unique,df_combined=PyCutterProcessing().merge_polarities(*polarity_tables)
+    print(
+        f'{feature_count}+{feature_count} features, {sample_count} samples: merged in {time.perf_counter()-start:.3f}s '
+        f'({len(df_unique)} unique, {len(df_combined)} combined, {(df_unique["Polarity"]=="both").sum()} merged)'
+    )
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+import sys
+import os
+import tempfile
+from alignment_tables import write_alignment_tables
+from alignment_tables import read_alignment_tables
+from alignment_tables import read_alignment_feature_rows
+
+'''
+checks that an alignment written as an .arrow directory and as a tab separated sheet reads back the same:
+the same missing values (the 'null' INCHIKEY of unknowns, empty cells, NA...) and the same values
+through read_alignment_tables and read_alignment_feature_rows.
+exits with an AssertionError on the first difference
+
+usage: python check_alignment_round_trip.py [number_of_random_cases]
+'''
+
+missing_value_spellings=['null','','NA','N/A',np.nan,None]
+
+
+def make_random_alignment(rng,feature_count=200):
+    '''
+    (feature_table, run_metadata) with samples, blanks, a qc and the two summary columns of one class,
+    and text columns that have every spelling of a missing value in them
+    '''
+    run_names=['S0','S1','S2','S3','B0','B1','Q0','sample','sample']
+    run_metadata=pd.DataFrame(
+        {
+            'Class':['sample']*4+['blank']*2+['qc','sample','sample'],
+            'File type':['Sample']*4+['Blank']*2+['QC','Average','Stdev'],
+            'Injection order':[str(i+1) for i in range(7)]+[np.nan,np.nan],
+            'Batch ID':['1']*7+[np.nan,np.nan]
+        },
+        index=pd.Index(run_names,name='MS/MS spectrum')
+    )
+
+    def with_missing_values(values):
+        values=np.array(values,dtype=object)
+        is_missing=rng.random(feature_count)<0.3
+        values[is_missing]=rng.choice(np.array(missing_value_spellings,dtype=object),size=is_missing.sum())
+        return values
+
+    feature_table=pd.DataFrame({
+        'Alignment ID':np.arange(feature_count),
+        'Average Rt(min)':np.round(rng.uniform(0.5,20,size=feature_count),3),
+        'Average Mz':np.round(rng.uniform(70,1000,size=feature_count),4),
+        'Metabolite name':with_missing_values([f'cmpd{i}' for i in rng.integers(0,50,size=feature_count)]),
+        'Adduct type':rng.choice(['[M+H]+','[M+Na]+','[M-H]-'],size=feature_count).astype(object),
+        'INCHIKEY':with_missing_values([f'KEY{i:07d}-XXXX' for i in rng.integers(0,50,size=feature_count)]),
+        'MSI':with_missing_values(rng.choice(['2','3'],size=feature_count)),
+        'Dot product':np.where(rng.random(feature_count)<0.1,np.nan,rng.integers(30,100,size=feature_count)),
+        'MS/MS spectrum':with_missing_values(['100.1:5 120.2:7']*feature_count)
+    })
+    intensities=np.round(rng.uniform(0,1e5,size=(feature_count,len(run_names))),1)
+    intensities[rng.random(intensities.shape)<0.05]=np.nan
+    feature_table=pd.concat([feature_table,pd.DataFrame(intensities,columns=run_names)],axis='columns')
+    return feature_table,run_metadata
+
+
+def assert_same_values(arrow_panda,sheet_panda,description):
+    '''
+    the same column names, the same missing cells, and the same values in the others
+    (numerically where the sheet gave numbers, as text otherwise)
+    '''
+    assert arrow_panda.columns.tolist()==sheet_panda.columns.tolist(),f'{description}: different columns'
+    assert arrow_panda.shape==sheet_panda.shape,f'{description}: different shape'
+    for temp_position,temp_name in enumerate(sheet_panda.columns):
+        arrow_column=arrow_panda.iloc[:,temp_position]
+        sheet_column=sheet_panda.iloc[:,temp_position]
+        is_missing=sheet_column.isna().to_numpy()
+        assert (arrow_column.isna().to_numpy()==is_missing).all(),f'{description}: different missing values in {temp_name}'
+        if pd.api.types.is_numeric_dtype(sheet_column.dtype):
+            np.testing.assert_allclose(
+                pd.to_numeric(arrow_column[~is_missing]).to_numpy(dtype=float),
+                sheet_column[~is_missing].to_numpy(dtype=float),
+                rtol=1e-12,
+                err_msg=f'{description}: different values in {temp_name}'
+            )
+        else:
+            assert (arrow_column[~is_missing].astype(str).to_numpy()==sheet_column[~is_missing].astype(str).to_numpy()).all(),\
+                f'{description}: different values in {temp_name}'
+
+
+def check_alignment_round_trip(number_of_random_cases,seed=0):
+    '''
+    writes number_of_random_cases random alignments both ways and asserts that both readers give the same back
+    '''
+    rng=np.random.default_rng(seed)
+    scratch_directory=tempfile.mkdtemp()
+    arrow_address=os.path.join(scratch_directory,'alignment.arrow')
+    sheet_address=os.path.join(scratch_directory,'alignment.tsv')
+    for i in range(number_of_random_cases):
+        feature_table,run_metadata=make_random_alignment(rng)
+        write_alignment_tables(feature_table,run_metadata,arrow_address)
+        write_alignment_tables(feature_table,run_metadata,sheet_address)
+
+        arrow_features,arrow_run_metadata=read_alignment_tables(arrow_address)
+        sheet_features,sheet_run_metadata=read_alignment_tables(sheet_address)
+        assert_same_values(arrow_features,sheet_features,f'read_alignment_tables features, case {i}')
+        assert_same_values(arrow_run_metadata,sheet_run_metadata,f'read_alignment_tables run metadata, case {i}')
+        assert arrow_run_metadata.index.equals(sheet_run_metadata.index),f'read_alignment_tables run names, case {i}'
+
+        assert_same_values(
+            read_alignment_feature_rows(arrow_address,4),
+            read_alignment_feature_rows(sheet_address,4),
+            f'read_alignment_feature_rows, case {i}'
+        )
+
+
+if __name__=="__main__":
+
+    number_of_random_cases=20
+    if len(sys.argv)>1:
+        number_of_random_cases=int(sys.argv[1])
+
+    check_alignment_round_trip(number_of_random_cases)
+    print(f'{number_of_random_cases} random alignments: the same values and missing values from .arrow and from the sheet')
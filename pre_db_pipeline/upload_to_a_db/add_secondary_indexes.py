@@ -0,0 +1,37 @@
+import sys
+from make_starting_db import *
+
+'''
+brings databases made before the secondary indexes existed up to date, then checks
+that every hot query is actually using an index
+
+usage: python add_secondary_indexes.py transient|main|both
+'''
+
+if __name__=="__main__":
+
+    to_transient_for_pycutter_pipeline=sys.argv[1]
+
+    database_locations=list()
+    if to_transient_for_pycutter_pipeline in ['transient','both']:
+        database_locations.append("../../../data/database/transient_bucketbase.db")
+    if to_transient_for_pycutter_pipeline in ['main','both']:
+        database_locations.append("../../../data/database/bucketbase.db")
+
+    all_queries_use_indexes=True
+    for database_location in database_locations:
+        print(database_location)
+        connection=create_connection(database_location)
+        create_secondary_indexes(connection)
+        #so that the planner has statistics to choose between the indexes
+        connection.execute('ANALYZE')
+
+        for query_name,(uses_index,plan) in check_hot_query_plans(connection).items():
+            print(f'{query_name}: {"uses index" if uses_index else "FULL SCAN"}')
+            for temp_step in plan:
+                print(f'    {temp_step}')
+            all_queries_use_indexes=all_queries_use_indexes and uses_index
+        connection.close()
+
+    if all_queries_use_indexes==False:
+        sys.exit(1)
@@ -2,6 +2,10 @@
 #from sqlite3 import Error
 import sqlalchemy
 import sys
+sys.path.insert(0, '../../utils/')
+sys.path.insert(0, '../../consensus_routine/')
+from contributor_sampling import create_consensus_sampling_table
+from incremental_consensus import create_consensus_watermark_table
 
 
 # def create_database(database_address):
@@ -18,10 +22,79 @@ import sys
 
 def create_connection(database_address):
     ## sqlite://<nohostname>/<path>
-    engine=sqlalchemy.create_engine(f"sqlite:///{my_database_location}")
+    engine=sqlalchemy.create_engine(f"sqlite:///{database_address}")
     connection=engine.connect()
     return connection
 
+#the primary keys alone left every hot query doing a full table scan
+#name: (table, columns)
+secondary_indexes={
+    'annotations_bin_id_index':('annotations','bin_id'),
+    'annotations_run_id_index':('annotations','run_id'),
+    'bins_valid_for_autocuration_index':('bins','valid_for_autocuration'),
+    'bins_polarity_adduct_mz_rt_index':('bins','polarity, adduct, consensus_mz, consensus_rt'),
+}
+
+#the queries that the consensus routine and auto curation run over and over
+#the literal values do not matter for the query plan
+hot_queries={
+    'spectra for a bin':'''
+    select annotation_id, spectrum 
+    from annotations
+    inner join
+    runs
+    on annotations.run_id=runs.run_id
+    where (annotations.bin_id=0) and (annotations.spectrum is not null) and (runs.run_type='Sample')
+    ''',
+    'bins without autocuration status':'''
+    select bin_id 
+    from bins
+    where valid_for_autocuration is null
+    ''',
+    'candidate bins for auto curation':'''
+    select * from bins
+    where
+    (valid_for_autocuration=1) AND
+    (polarity="pos") AND
+    (adduct="[M+H]+") AND
+    ((consensus_mz>100.0) AND (consensus_mz<100.02)) AND
+    ((consensus_rt>1.0) AND (consensus_rt<3.0))
+    ''',
+}
+
+def create_secondary_indexes(connection):
+    '''
+    safe to run on a database that already has some or all of them
+    '''
+    for index_name,(table_name,column_names) in secondary_indexes.items():
+        connection.execute(
+            f'''CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({column_names})'''
+        )
+
+def drop_secondary_indexes(connection):
+    '''
+    for bulk loads, where building the indexes once at the end is cheaper than maintaining them row by row
+    '''
+    for index_name in secondary_indexes.keys():
+        connection.execute(
+            f'''DROP INDEX IF EXISTS {index_name}'''
+        )
+
+def check_hot_query_plans(connection):
+    '''
+    runs explain query plan on every hot query and returns {query name: (uses index, plan)}
+    a query counts as using an index if none of its steps is a plain table scan
+    '''
+    output_dict=dict()
+    for query_name,query in hot_queries.items():
+        temp_cursor=connection.execute('EXPLAIN QUERY PLAN '+query)
+        plan=[element[-1] for element in temp_cursor.fetchall()]
+        uses_index=all(
+            ('USING' in temp_step) for temp_step in plan if temp_step.startswith('SCAN')
+        )
+        output_dict[query_name]=(uses_index,plan)
+    return output_dict
+
 if __name__ =="__main__":
 
     to_transient_for_pycutter_pipeline=sys.argv[1]
@@ -90,6 +163,16 @@ if __name__ =="__main__":
         '''
     )
 
+    #which annotations contributed to a bins consensus spectrum is member_of_consensus,
+    #how they were chosen is here (consensus_routine/contributor_sampling.py)
+    create_consensus_sampling_table(connection)
+
+    #how far each bins consensus spectrum has got through the annotations, for incremental updates
+    #(consensus_routine/incremental_consensus.py)
+    create_consensus_watermark_table(connection)
+
+    create_secondary_indexes(connection)
+
     # connection.execute(
     #     '''
     #     INSERT INTO bins
@@ -0,0 +1,68 @@
+import sys
+import os
+import time
+sys.path.insert(0, '../../utils/')
+from utils import encode_spectrum_text_binary
+from make_starting_db import create_connection
+
+'''
+converts the text spectra of an existing database (annotations.spectrum and bins.consensus_spectrum)
+to the binary format in utils (encode_spectrum_arrays_binary), then vacuums so that the file shrinks.
+only rows that are still text are touched, so it is safe to run again after new uploads.
+every reader goes through parse_text_spectra_return_pairs/split_stored_spectrum_clusters,
+which take either format, so a half-migrated database still works
+
+usage: python migrate_spectra_to_binary.py transient|main
+'''
+
+def migrate_spectrum_column(connection,table_name,key_column,spectrum_column,rows_per_batch=50000):
+    '''
+    reads the text spectra in key order, rows_per_batch at a time, and writes them back as blobs
+    returns the number of converted rows
+    '''
+    converted_count=0
+    last_key=None
+    while True:
+        #keyset pagination, the rows already converted are no longer text so they drop out anyway
+        query=f'''
+        select {key_column}, {spectrum_column}
+        from {table_name}
+        where (typeof({spectrum_column})='text')'''+(f''' and ({key_column}>{last_key})''' if last_key is not None else '')+f'''
+        order by {key_column}
+        limit {rows_per_batch}
+        '''
+        temp_rows=connection.execute(query).fetchall()
+        if len(temp_rows)==0:
+            break
+
+        with connection.begin():
+            connection.execute(
+                f'''update {table_name} set {spectrum_column}=? where {key_column}=?''',
+                [(encode_spectrum_text_binary(element[1]),element[0]) for element in temp_rows]
+            )
+        converted_count+=len(temp_rows)
+        last_key=temp_rows[-1][0]
+        print(f'{table_name}: {converted_count} spectra converted')
+    return converted_count
+
+
+if __name__=="__main__":
+
+    to_transient_for_pycutter_pipeline=sys.argv[1]
+    if to_transient_for_pycutter_pipeline=='transient':
+        database_address="../../../data/database/transient_bucketbase.db"
+    elif to_transient_for_pycutter_pipeline=='main':
+        database_address="../../../data/database/bucketbase.db"
+
+    size_before=os.path.getsize(database_address)
+    start=time.perf_counter()
+
+    connection=create_connection(database_address)
+    migrate_spectrum_column(connection,'annotations','annotation_id','spectrum')
+    migrate_spectrum_column(connection,'bins','bin_id','consensus_spectrum')
+    #give the space back to the filesystem
+    connection.execute('VACUUM')
+    connection.close()
+
+    size_after=os.path.getsize(database_address)
+    print(f'{database_address}: {size_before/1e6:.1f} MB -> {size_after/1e6:.1f} MB in {time.perf_counter()-start:.1f}s')
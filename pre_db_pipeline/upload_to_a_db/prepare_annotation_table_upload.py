@@ -2,7 +2,14 @@
 # import pandas as pd
 # import sqlalchemy
 import os
+import sys
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, '../../utils/')
+from utils import parse_text_spectra_return_parallel
+from utils import parse_text_spectra_return_ragged
+from utils import binary_spectrum_magic
 
 from prepare_bin_table_upload import * #find_lowest_bin,create_bin_table_upload
 
@@ -152,33 +159,97 @@ def clean_mapping_panda(mapping_panda,alignment_id_bin_id_panda):
 
     return mapping_panda
 
-def create_annotation_table_wrapper(individual_files_directory,mapping_panda,database_address):
+#the only columns of an ms-dial individual (per-sample) file that we use, and what we call them
+individual_file_column_swap_dict={
+    'Height':'intensity_height',
+    'RT (min)':'retention_time',
+    'MSMS spectrum':'spectrum',
+    'Adduct':'adduct',
+    'Precursor m/z':'precursor_mz',
+    'PeakID':'peak_id'
+}
+#declared up front so that read_csv does not have to infer them
+individual_file_dtypes={
+    'Height':np.float64,
+    'RT (min)':np.float64,
+    'MSMS spectrum':object,
+    'Adduct':object,
+    'Precursor m/z':np.float64,
+    'PeakID':np.int64
+}
+
+def read_individual_file(individual_files_directory,temp_file):
+    '''
+    reads the six columns that we need from one individual file, already renamed
+    '''
+    individual_file_panda=pd.read_csv(
+        individual_files_directory+temp_file,
+        sep='\t',
+        usecols=list(individual_file_column_swap_dict.keys()),
+        dtype=individual_file_dtypes
+    )
+    individual_file_panda=individual_file_panda.loc[
+        :,
+        individual_file_column_swap_dict.keys()
+    ]
+    individual_file_panda.rename(
+        mapper=individual_file_column_swap_dict,
+        inplace=True,
+        axis='columns'
+    )
+    return individual_file_panda
+
+def assign_annotation_ids(temp_annotation_upload_panda,next_annotation_id):
+    '''
+    numbers the annotations of one file on from next_annotation_id. returns the panda and the id after the last one
+    '''
+    temp_annotation_upload_panda['annotation_id']=np.arange(
+        next_annotation_id,next_annotation_id+len(temp_annotation_upload_panda.index)
+    )
+    return temp_annotation_upload_panda,next_annotation_id+len(temp_annotation_upload_panda.index)
+
+def iterate_annotation_tables(individual_files_directory,mapping_panda,first_annotation_id,n_workers=4,use_binary_spectra=False):
+    '''
+    generator. yields the annotation upload panda of each individual file, in os.listdir order,
+    with annotation_id numbered on from first_annotation_id.
+    files are read and prepared by a pool of n_workers threads (read_csv and the numpy work let go of the gil,
+    and threads share the mapping_panda instead of copying it), with at most 2*n_workers files in flight
+    so that memory stays bounded no matter how many runs the study has.
+    meant to be handed straight to upload_tables_to_db_bulk.
+    with use_binary_spectra the spectra are stored in the binary format (see utils) instead of as text
+    '''
+    file_list=os.listdir(individual_files_directory)
+    next_annotation_id=first_annotation_id
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures_in_flight=deque()
+        for i,temp_file in enumerate(file_list):
+            print(i)
+            futures_in_flight.append(
+                executor.submit(create_annotation_table_one_individual_file,individual_files_directory,temp_file,mapping_panda,use_binary_spectra)
+            )
+            if len(futures_in_flight)>=2*n_workers:
+                temp_annotation_upload_panda,next_annotation_id=assign_annotation_ids(futures_in_flight.popleft().result(),next_annotation_id)
+                yield temp_annotation_upload_panda
+        while len(futures_in_flight)>0:
+            temp_annotation_upload_panda,next_annotation_id=assign_annotation_ids(futures_in_flight.popleft().result(),next_annotation_id)
+            yield temp_annotation_upload_panda
+
+def create_annotation_table_wrapper(individual_files_directory,mapping_panda,database_address,n_workers=4,use_binary_spectra=False):
     '''
     This function, for each individual file, creates an annotation upload panda.
     It then combines them to one gigantic annotation upload panda
     then assigns the annotation_id by finding the smallest ID from the sqlite DB
-    '''
-    file_list=os.listdir(individual_files_directory)
 
-    annotation_panda_upload_list=list()
-    for i,temp_file in enumerate(file_list):
-        #if i>5 and i<255:
-        #    continue
-        print(i)
-        annotation_panda_upload_list.append(
-            create_annotation_table_one_individual_file(individual_files_directory,temp_file,mapping_panda)
-        )
+    for big studies, hand iterate_annotation_tables to the db loader instead, which never holds more than a few files
+    '''
+    lowest_annotation_id=1+find_lowest_annotation(database_address)
 
     annotation_upload_panda=pd.concat(
-        annotation_panda_upload_list,
+        list(iterate_annotation_tables(individual_files_directory,mapping_panda,lowest_annotation_id,n_workers,use_binary_spectra)),
         axis='index',
         ignore_index=True,
-    ) 
-    lowest_annotation_id=1+find_lowest_annotation(database_address)
-
-    annotation_upload_panda['annotation_id']=list(range(
-        lowest_annotation_id,(lowest_annotation_id+len(annotation_upload_panda.index))
-    ))
+    )
 
     return annotation_upload_panda
 
@@ -192,16 +263,9 @@ def normalize_spectrum(spectrum):
 def parse_one_ms_dial_spectrum(spectrum_text):
     '''
     takes an ms/ms spectrum as a string and returns an array
+    (mz in the first row, intensity in the second)
     '''
-
-    mz_int_pair_list=spectrum_text.split(' ')
-    mz_list=[float(temp_pair.split(':')[0]) for temp_pair in mz_int_pair_list]
-    intensity_list=[float(temp_pair.split(':')[1]) for temp_pair in mz_int_pair_list]
-    
-    return np.array([
-        mz_list,
-        intensity_list
-    ])
+    return parse_text_spectra_return_parallel([spectrum_text])[0]
 
 def convert_np_spectrum_to_text(spectrum_array):
     '''
@@ -213,7 +277,54 @@ def convert_np_spectrum_to_text(spectrum_array):
     return ' '.join(string_rep)
 
 
-def create_annotation_table_one_individual_file(individual_files_directory,temp_file,mapping_panda):    
+def normalize_ragged_spectra(offsets,intensity):
+    '''
+    the batched normalize_spectrum. divides every intensity by the max of its own spectrum,
+    for all of the spectra of a file at once (ragged layout from parse_text_spectra_return_ragged)
+    '''
+    peak_counts=np.diff(offsets)
+    #reduceat needs strictly increasing starts, so spectra without peaks sit out
+    spectrum_maxes=np.maximum.reduceat(intensity,offsets[:-1][peak_counts>0])
+    return intensity/np.repeat(spectrum_maxes,peak_counts[peak_counts>0])
+
+def serialize_ragged_spectra_text(offsets,mz,intensity):
+    '''
+    the batched convert_np_spectrum_to_text. "mz:int mz:int" for every spectrum of the ragged layout.
+    python floats print the same as numpy float64 elements do, so the text is identical
+    '''
+    #one str() per number is the floor for text, everything around it stays in c (map, join)
+    number_texts=list(map(str,np.column_stack([mz,intensity]).ravel().tolist()))
+    peak_texts=list(map(':'.join,zip(number_texts[0::2],number_texts[1::2])))
+    offsets=offsets.tolist()
+    return [' '.join(peak_texts[temp_start:temp_end]) for temp_start,temp_end in zip(offsets[:-1],offsets[1:])]
+
+def serialize_ragged_spectra_binary(offsets,mz,intensity):
+    '''
+    like serialize_ragged_spectra_text, but in the binary spectrum format (utils.encode_spectrum_arrays_binary, one cluster).
+    the peaks of every spectrum are one slice of a single buffer, so there is no per-peak python work at all
+    '''
+    all_peak_bytes=np.column_stack([mz,intensity]).astype('<f8').tobytes()
+    #magic, one cluster, the peak count and 4 bytes of padding
+    header_start=binary_spectrum_magic+np.array([1],dtype='<u4').tobytes()
+    peak_count_bytes=[temp_count.tobytes() for temp_count in np.diff(offsets).astype('<u4')]
+    offsets=offsets.tolist()
+    return [
+        header_start+temp_count_bytes+bytes(4)+all_peak_bytes[16*temp_start:16*temp_end]
+        for temp_count_bytes,temp_start,temp_end in zip(peak_count_bytes,offsets[:-1],offsets[1:])
+    ]
+
+def prepare_spectra_for_upload(spectra_text,use_binary_spectra=False):
+    '''
+    parse, normalize and serialize a list of ms-dial spectra in one batch.
+    does what parse_one_ms_dial_spectrum, normalize_spectrum and convert_np_spectrum_to_text do one spectrum at a time
+    '''
+    offsets,mz,intensity=parse_text_spectra_return_ragged(spectra_text)
+    intensity=normalize_ragged_spectra(offsets,intensity)
+    if use_binary_spectra==True:
+        return serialize_ragged_spectra_binary(offsets,mz,intensity)
+    return serialize_ragged_spectra_text(offsets,mz,intensity)
+
+def create_annotation_table_one_individual_file(individual_files_directory,temp_file,mapping_panda,use_binary_spectra=False):    
     '''
     The order of events is to 
     1) take subset of the mapping panda. keep only bin_id, alignment_id, and the particular sample that we want (peak ids)
@@ -232,26 +343,7 @@ def create_annotation_table_one_individual_file(individual_files_directory,temp_
         ['bin_id','alignment_id',run_id]
     ]
 
-    individual_file_panda=pd.read_csv(individual_files_directory+temp_file,sep='\t')
-    
-    column_swap_dict={
-        'Height':'intensity_height',
-        'RT (min)':'retention_time',
-        'MSMS spectrum':'spectrum',
-        'Adduct':'adduct',
-        'Precursor m/z':'precursor_mz',
-        'PeakID':'peak_id'
-    }
-    individual_file_panda=individual_file_panda.loc[
-        :,
-        column_swap_dict.keys()
-    ]
-
-    individual_file_panda.rename(
-        mapper=column_swap_dict,
-        inplace=True,
-        axis='columns'
-    ) 
+    individual_file_panda=read_individual_file(individual_files_directory,temp_file)
 
 
     temp_annotation_upload_panda=temp_annotation_upload_panda.merge(
@@ -270,26 +362,19 @@ def create_annotation_table_one_individual_file(individual_files_directory,temp_
         axis='columns'
     )
 
-    #map, like apply, is not true vectorizaiton
-    #opted for map to avoid putting nan case handlers in called functions
-    #the idea is to normalize spectra then return them to text for upload
-    temp_annotation_upload_panda.loc[
-        temp_annotation_upload_panda['spectrum'].notna(),'spectrum'
-    ]=temp_annotation_upload_panda.loc[
-        temp_annotation_upload_panda['spectrum'].notna(),'spectrum'
-    ].apply(parse_one_ms_dial_spectrum)
-
+    #the spectra of the whole file are parsed, normalized and turned back into text (or binary) in one batch
+    spectrum_present=temp_annotation_upload_panda['spectrum'].notna()
+    temp_annotation_upload_panda['spectrum']=temp_annotation_upload_panda['spectrum'].astype(object)
     temp_annotation_upload_panda.loc[
-        temp_annotation_upload_panda['spectrum'].notna(),'spectrum'
-    ]=temp_annotation_upload_panda.loc[
-        temp_annotation_upload_panda['spectrum'].notna(),'spectrum'
-    ].apply(normalize_spectrum)
-
-    temp_annotation_upload_panda.loc[
-        temp_annotation_upload_panda['spectrum'].notna(),'spectrum'
-    ]=temp_annotation_upload_panda.loc[
-        temp_annotation_upload_panda['spectrum'].notna(),'spectrum'
-    ].apply(convert_np_spectrum_to_text)
+        spectrum_present,'spectrum'
+    ]=pd.Series(
+        prepare_spectra_for_upload(
+            temp_annotation_upload_panda.loc[spectrum_present,'spectrum'].tolist(),
+            use_binary_spectra
+        ),
+        index=temp_annotation_upload_panda.index[spectrum_present],
+        dtype=object
+    )
 
     return temp_annotation_upload_panda
 
@@ -1,35 +1,21 @@
 import numpy as np
 import pandas as pd
 import sqlalchemy
+import sys
 
 
-def create_run_table_upload(alignment_panda,to_transient_for_pycutter_pipeline):
+def create_run_table_upload(run_metadata,to_transient_for_pycutter_pipeline):
     '''
     steps: 
     1) we pre-plan the set of bin_id that will be new
     2) we check conformity to standards? (to some extent?)
     3) we coerce the bin_panda into a panda for upload to db
-    '''
-
-    #drop the columns where the first three rows are na
-    alignment_panda.dropna(
-        axis='columns',
-        how='all',
-        subset=[0,1,2],
-        inplace=True
-    )
 
-    alignment_panda.set_index(
-        alignment_panda.columns[0],
-        drop=True,
-        append=False,
-        inplace=True
-    )
+    run_metadata is the one of the alignment (alignment_tables.read_alignment_run_metadata), one row per run column.
+    the name of its index (the label column of the sheet) becomes one of the columns
+    '''
 
-    #an artifact of this operation seems to be that the column index is named
-    #which is weird (in this case, 9, which was a column name previous)
-    #doesnt seem to affect things, so will ignore
-    alignment_panda=alignment_panda.transpose()
+    alignment_panda=run_metadata.reset_index()
 
     if to_transient_for_pycutter_pipeline=='transient':
         column_swap_dict={
@@ -72,9 +58,9 @@ def create_run_table_upload(alignment_panda,to_transient_for_pycutter_pipeline):
 if __name__=="__main__":
     
     #out of date
+    sys.path.insert(0,'../pycutter_step_1/')
+    from alignment_tables import read_alignment_run_metadata
     final_alignment_address='../../../data/BRYU005_pipeline_test/step_2_final_alignment/BRYU005_CombineSubmit_June2022_pos.txt'
     database_address='../../../data/database/bucketbase.db'
-    alignment_panda=pd.read_csv(
-        final_alignment_address,sep='\t',nrows=4,header=None
-    )
-    create_run_table_upload(alignment_panda)
\ No newline at end of file
+    run_metadata=read_alignment_run_metadata(final_alignment_address,3)
+    create_run_table_upload(run_metadata,'main')
@@ -2,6 +2,15 @@ from prepare_bin_table_upload import *
 from prepare_run_table_upload import *
 from prepare_annotation_table_upload import *
 import sys
+import time
+sys.path.insert(0, '../../utils/')
+from utils import panda_rows_as_parameters
+sys.path.insert(0, '../pycutter_step_1/')
+from alignment_tables import read_alignment_run_metadata
+from alignment_tables import read_alignment_feature_rows
+from make_starting_db import create_connection
+from make_starting_db import create_secondary_indexes
+from make_starting_db import drop_secondary_indexes
 
 def upload_table_to_db(temp_panda,table_name):
 
@@ -21,6 +30,81 @@ def upload_table_to_db(temp_panda,table_name):
     engine.dispose()
 
 
+def iterate_panda_chunks(panda_or_pandas,rows_per_chunk):
+    '''
+    receives one panda or an iterable of pandas (for example a reader that yields one file at a time)
+    and yields slices of at most rows_per_chunk rows
+    '''
+    if isinstance(panda_or_pandas,pd.DataFrame):
+        panda_or_pandas=[panda_or_pandas]
+    for temp_panda in panda_or_pandas:
+        for chunk_start in range(0,len(temp_panda.index),rows_per_chunk):
+            yield temp_panda.iloc[chunk_start:chunk_start+rows_per_chunk]
+
+def upload_tables_to_db_bulk(
+    database_address,
+    tables,
+    rows_per_chunk=50000,
+    use_fast_pragmas=False,
+    defer_index_builds=False
+):
+    '''
+    the fast path for upload_table_to_db.
+    tables is a list of (table name, panda or iterable of pandas), loaded in order (runs, bins, annotations)
+    on one connection and inside one transaction, so a failed load leaves the db as it was.
+    each chunk of rows_per_chunk rows goes in through a single executemany.
+
+    use_fast_pragmas sets journal_mode=WAL and synchronous=OFF for the duration of the load
+    (synchronous=OFF means that a power cut during the load can corrupt the db, so keep a copy).
+    defer_index_builds drops the secondary indexes and builds them once at the end.
+
+    prints rows/sec for every table and returns {table name: rows loaded}
+    '''
+    connection=create_connection(database_address)
+
+    #pragmas have to be set outside of a transaction
+    if use_fast_pragmas==True:
+        previous_journal_mode=connection.execute('PRAGMA journal_mode').fetchall()[0][0]
+        previous_synchronous=connection.execute('PRAGMA synchronous').fetchall()[0][0]
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=OFF')
+
+    row_counts=dict()
+    load_start=time.perf_counter()
+    if defer_index_builds==True:
+        drop_secondary_indexes(connection)
+    try:
+        with connection.begin():
+            for table_name,panda_or_pandas in tables:
+                table_start=time.perf_counter()
+                row_counts[table_name]=row_counts.get(table_name,0)
+                for temp_chunk in iterate_panda_chunks(panda_or_pandas,rows_per_chunk):
+                    if len(temp_chunk.index)==0:
+                        continue
+                    connection.execute(
+                        f'insert into {table_name} ('+', '.join(temp_chunk.columns)+') values ('+', '.join(['?']*len(temp_chunk.columns))+')',
+                        panda_rows_as_parameters(temp_chunk)
+                    )
+                    row_counts[table_name]+=len(temp_chunk.index)
+                table_time=time.perf_counter()-table_start
+                print(f'{table_name}: {row_counts[table_name]} rows in {table_time:.2f}s ({row_counts[table_name]/max(table_time,1e-9):.0f} rows/sec)')
+    finally:
+        #built whether or not the load went through, a rollback would not bring the dropped indexes back
+        if defer_index_builds==True:
+            index_start=time.perf_counter()
+            create_secondary_indexes(connection)
+            print(f'secondary indexes built in {time.perf_counter()-index_start:.2f}s')
+        if use_fast_pragmas==True:
+            connection.execute(f'PRAGMA synchronous={previous_synchronous}')
+            connection.execute(f'PRAGMA journal_mode={previous_journal_mode}')
+        connection.close()
+
+    load_time=time.perf_counter()-load_start
+    total_rows=sum(row_counts.values())
+    print(f'total: {total_rows} rows in {load_time:.2f}s ({total_rows/max(load_time,1e-9):.0f} rows/sec)')
+    return row_counts
+
+
 if __name__=="__main__":
     '''
     order of events:
@@ -34,6 +118,10 @@ if __name__=="__main__":
 
     to_transient_for_pycutter_pipeline=sys.argv[1]
     ion_mode=sys.argv[2]
+    #optional, 'fast' turns on the wal/synchronous=off pragmas and deferred index builds for the load
+    use_fast_load=(len(sys.argv)>3) and (sys.argv[3]=='fast')
+    #optional, 'binary' stores the annotation spectra in the binary format instead of as text
+    use_binary_spectra=(len(sys.argv)>4) and (sys.argv[4]=='binary')
     if to_transient_for_pycutter_pipeline=='transient':
         database_address="../../../data/database/transient_bucketbase.db"
         final_alignment_address='../../../data/BRYU005_pipeline_test/step_1_post_pycutter/py_cutter_step_1_output.tsv'
@@ -48,26 +136,23 @@ if __name__=="__main__":
         individual_files_directory='../../../data/three_studies/individual_sample_data_subset/unzipped/BRYU005_Bacterial_Supernatant/pos/'    
 
 
+    #the pycutter output can also be an .arrow directory (see alignment_tables.py), the readers take either
     #run_panda
     if to_transient_for_pycutter_pipeline=='transient':
-        alignment_panda=pd.read_csv(
-            final_alignment_address,sep='\t',nrows=5,header=None
-        )
+        run_metadata=read_alignment_run_metadata(final_alignment_address,4)
     elif to_transient_for_pycutter_pipeline=='main':
-        alignment_panda=pd.read_csv(
-            final_alignment_address,sep='\t',nrows=4,header=None
-        )    
+        run_metadata=read_alignment_run_metadata(final_alignment_address,3)
     run_panda_for_upload=create_run_table_upload(
-        alignment_panda,
+        run_metadata,
         to_transient_for_pycutter_pipeline
     )
 
     #bin_panda
     if to_transient_for_pycutter_pipeline=='transient':
-        alignment_panda=pd.read_csv(final_alignment_address,sep='\t',skiprows=4)
+        alignment_panda=read_alignment_feature_rows(final_alignment_address,4)
         bin_panda_for_upload=create_bin_table_upload(alignment_panda,database_address,to_transient_for_pycutter_pipeline,ion_mode)
     elif to_transient_for_pycutter_pipeline=='main':
-        alignment_panda=pd.read_csv(final_alignment_address,sep='\t',skiprows=3)    
+        alignment_panda=read_alignment_feature_rows(final_alignment_address,3)
         bin_panda_for_upload=create_bin_table_upload(alignment_panda,database_address,to_transient_for_pycutter_pipeline)
     
 
@@ -75,8 +160,20 @@ if __name__=="__main__":
     alignment_id_bin_id_panda=get_alignment_id_bin_id_map(alignment_panda,bin_panda_for_upload)
     mapping_panda=pd.read_csv(mapping_file_address,sep='\t',skiprows=4)
     mapping_panda=clean_mapping_panda(mapping_panda,alignment_id_bin_id_panda)
-    annotation_panda_for_upload=create_annotation_table_wrapper(individual_files_directory,mapping_panda,database_address)
+    #the annotations are read and prepared a few files at a time while they are being written,
+    #rather than concatenated into one panda first
+    first_annotation_id=1+find_lowest_annotation(database_address)
+    annotation_pandas_for_upload=iterate_annotation_tables(
+        individual_files_directory,mapping_panda,first_annotation_id,use_binary_spectra=use_binary_spectra
+    )
 
-    upload_table_to_db(run_panda_for_upload,'runs')
-    upload_table_to_db(bin_panda_for_upload,'bins')
-    upload_table_to_db(annotation_panda_for_upload,'annotations')
\ No newline at end of file
+    upload_tables_to_db_bulk(
+        database_address,
+        [
+            ('runs',run_panda_for_upload),
+            ('bins',bin_panda_for_upload),
+            ('annotations',annotation_pandas_for_upload)
+        ],
+        use_fast_pragmas=use_fast_load,
+        defer_index_builds=use_fast_load
+    )
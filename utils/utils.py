@@ -49,25 +49,248 @@ def execute_query_connection_established(database_connection,query_string,return
     elif returns_rows==False:
         return
 
-def parse_text_spectra_return_pairs(spectra_text):
+def load_keys_into_temp_table(database_connection,temp_table_name,keys):
     '''
+    puts a list of integer keys (bin ids, annotation ids) into a temp table
+    so that big sets of ids can be joined against instead of written out as an IN (...) list.
+    the table lives as long as the connection does and its contents are replaced on every call.
+    we empty it rather than drop it because sqlite refuses to drop a table while another
+    query on the connection is still being read (the streaming selects)
     '''
-    output_list=list()
-    for spectrum in spectra_text:
-        mz_int_pair_list=spectrum.split(' ')
-        mz_list=[float(temp_pair.split(':')[0]) for temp_pair in mz_int_pair_list]
-        intensity_list=[float(temp_pair.split(':')[1]) for temp_pair in mz_int_pair_list]   
-        #we make it parallel and then pair for time saving during development
-        temp_spectrum_parallel=np.array([mz_list,intensity_list])
-        temp_spectrum_pair=np.column_stack(temp_spectrum_parallel)
-        output_list.append(temp_spectrum_pair)
-    return output_list
+    execute_query_connection_established(database_connection,f'create temp table if not exists {temp_table_name} (key INTEGER PRIMARY KEY)',returns_rows=False)
+    execute_query_connection_established(database_connection,f'delete from temp.{temp_table_name}',returns_rows=False)
+    keys=[(int(element),) for element in keys]
+    if len(keys)==0:
+        return
+    database_connection.execute(
+        f'insert or ignore into temp.{temp_table_name} (key) values (?)',
+        keys
+    )
 
+def panda_rows_as_parameters(panda):
+    '''
+    the rows of a panda as a list of tuples of python scalars (nan becomes None),
+    which is what sqlite3 can bind in an executemany
+    '''
+    return list(panda.astype(object).where(panda.notna(),None).itertuples(index=False,name=None))
 
-def parse_text_spectra_return_parallel(spectra_text):
+def load_panda_into_temp_table(database_connection,temp_table_name,panda):
+    '''
+    puts the rows of a panda into a temp table with the same column names, through one executemany.
+    values are bound as parameters, so spectrum text with quotes in it or binary spectra go in as-is,
+    and nan goes in as null.
+    unlike load_keys_into_temp_table the table is dropped and remade, because the columns change from call to call
+    '''
+    execute_query_connection_established(database_connection,f'drop table if exists temp.{temp_table_name}',returns_rows=False)
+    execute_query_connection_established(
+        database_connection,
+        f'create temp table {temp_table_name} ('+', '.join(panda.columns)+')',
+        returns_rows=False
+    )
+    if len(panda.index)==0:
+        return
+    database_connection.execute(
+        f'insert into temp.{temp_table_name} ('+', '.join(panda.columns)+') values ('+', '.join(['?']*len(panda.columns))+')',
+        panda_rows_as_parameters(panda)
+    )
+
+def bulk_update_from_panda(database_connection,table_name,key_column,panda):
+    '''
+    sets every column of panda (other than key_column) on the rows of table_name whose key_column matches.
+    the panda is loaded into a temp table and applied with a single update ... from, all in one transaction
+    '''
+    temp_table_name=f'{table_name}_updates'
+    set_text=',\n'.join([
+        f'{temp_column} = {temp_table_name}.{temp_column}' for temp_column in panda.columns if temp_column!=key_column
+    ])
+    query=f'''
+    update {table_name} set
+        {set_text}
+    from temp.{temp_table_name}
+    where {table_name}.{key_column}={temp_table_name}.{key_column}
     '''
+    with database_connection.begin():
+        load_panda_into_temp_table(database_connection,temp_table_name,panda)
+        execute_query_connection_established(database_connection,query,returns_rows=False)
 
+def bulk_set_column_for_keys(database_connection,table_name,key_column,column_name,value,keys):
     '''
-    pass
+    sets column_name to one value on every row of table_name whose key_column is in keys.
+    the keys go through a temp table (load_keys_into_temp_table), all in one transaction
+    '''
+    temp_table_name=f'{table_name}_update_keys'
+    with database_connection.begin():
+        load_keys_into_temp_table(database_connection,temp_table_name,keys)
+        database_connection.execute(
+            f'''
+            update {table_name}
+            set {column_name} = ?
+            where {key_column} in (select key from temp.{temp_table_name})
+            ''',
+            (value,)
+        )
+
+def stream_rows_grouped_by_bin(database_connection,query_string,bin_list,rows_per_fetch=10000):
+    '''
+    runs a query whose first column is bin_id and that is ordered by bin_id, and yields
+    (bin_id, [rest of the row, ...]) one bin at a time. rows are fetched rows_per_fetch at a time,
+    so only the current bin is ever held in python.
+    every bin in bin_list is yielded once in ascending order, with an empty list if the query had no rows for it
+    '''
+    temp_cursor=database_connection.execute(query_string)
+    requested_bins=iter(sorted(set(bin_list)))
 
+    current_bin=None
+    current_rows=list()
+    while True:
+        fetched_rows=temp_cursor.fetchmany(rows_per_fetch)
+        if len(fetched_rows)==0:
+            break
+        for row in fetched_rows:
+            if row[0]!=current_bin:
+                if current_bin is not None:
+                    yield current_bin,current_rows
+                #bins that the query skipped over still get their (empty) turn
+                for temp_bin in requested_bins:
+                    if temp_bin==row[0]:
+                        break
+                    yield temp_bin,list()
+                current_bin=row[0]
+                current_rows=list()
+            current_rows.append(tuple(row[1:]))
+    if current_bin is not None:
+        yield current_bin,current_rows
+    for temp_bin in requested_bins:
+        yield temp_bin,list()
+
+#binary spectrum format, stored as a BLOB in annotations.spectrum and bins.consensus_spectrum
+#(sqlite keeps a BLOB as-is in a TEXT column, so the schema does not change)
+#    4 bytes   magic, b'BBS1'
+#    uint32    number of clusters (the '@'-separated parts of a consensus spectrum, 1 for an annotation)
+#    uint32    number of peaks in each cluster
+#    padding   up to a multiple of 8 bytes
+#    float64   mz,intensity,mz,intensity,... for every peak of every cluster, in order
+#all little-endian. the peaks are interleaved so that each cluster decodes to an (n_peaks x 2)
+#view of the blob, which is the paired layout that spectral_entropy and the consensus code use
+binary_spectrum_magic=b'BBS1'
+
+def is_binary_spectrum(stored_spectrum):
+    '''
+    true for a spectrum that was stored with encode_spectrum_arrays_binary
+    '''
+    return isinstance(stored_spectrum,(bytes,bytearray,memoryview)) and bytes(stored_spectrum[:4])==binary_spectrum_magic
 
+def encode_spectrum_arrays_binary(cluster_spectra):
+    '''
+    receives a list of paired spectra (one per cluster) and returns the binary representation
+    '''
+    peak_counts=np.array([len(temp_spectrum) for temp_spectrum in cluster_spectra],dtype='<u4')
+    header=binary_spectrum_magic+np.array([len(cluster_spectra)],dtype='<u4').tobytes()+peak_counts.tobytes()
+    header=header+bytes((-len(header))%8)
+    if peak_counts.sum()==0:
+        return header
+    all_peaks=np.concatenate(
+        [np.asarray(temp_spectrum,dtype='<f8').reshape(-1,2) for temp_spectrum in cluster_spectra]
+    )
+    return header+all_peaks.tobytes()
+
+def encode_spectrum_text_binary(spectrum_text):
+    '''
+    converts a text spectrum ("mz:int mz:int", clusters separated by '@') to the binary representation
+    '''
+    return encode_spectrum_arrays_binary(
+        parse_text_spectra_return_pairs(spectrum_text.split('@'))
+    )
+
+def decode_spectrum_binary(stored_spectrum):
+    '''
+    returns a list with one (n_peaks x 2) float64 array per cluster.
+    these are read-only views into stored_spectrum (np.frombuffer), nothing is copied.
+    use .T for the parallel (2 x n_peaks) layout
+    '''
+    cluster_count=int(np.frombuffer(stored_spectrum,dtype='<u4',count=1,offset=4)[0])
+    peak_counts=np.frombuffer(stored_spectrum,dtype='<u4',count=cluster_count,offset=8)
+    header_length=8+4*cluster_count
+    header_length=header_length+(-header_length)%8
+
+    all_peaks=np.frombuffer(
+        stored_spectrum,dtype='<f8',count=2*int(peak_counts.sum()),offset=header_length
+    ).reshape(-1,2)
+    cluster_ends=np.cumsum(peak_counts,dtype=np.int64)
+    return [
+        all_peaks[temp_end-temp_count:temp_end] for temp_end,temp_count in zip(cluster_ends,peak_counts)
+    ]
+
+def split_stored_spectrum_clusters(stored_spectrum):
+    '''
+    a stored spectrum, text or binary, as a list of paired spectra (one per cluster)
+    '''
+    if is_binary_spectrum(stored_spectrum):
+        return decode_spectrum_binary(stored_spectrum)
+    return parse_text_spectra_return_pairs(stored_spectrum.split('@'))
+
+def convert_stored_spectrum_to_text(stored_spectrum):
+    '''
+    the text representation of a stored spectrum, for output meant for humans (excel, json).
+    text spectra are returned untouched
+    '''
+    if not is_binary_spectrum(stored_spectrum):
+        return stored_spectrum
+    return '@'.join([
+        ' '.join([
+            str(temp_mz)+':'+str(temp_intensity) for temp_mz,temp_intensity in temp_spectrum.tolist()
+        ]) for temp_spectrum in decode_spectrum_binary(stored_spectrum)
+    ])
+
+def parse_text_spectra_return_ragged(spectra_text):
+    '''
+    parses a whole batch of text spectra ("mz:int mz:int") in one pass.
+    returns offsets, mz, intensity, where the peaks of spectrum i are mz[offsets[i]:offsets[i+1]]
+    (the same for intensity). the batch is tokenized by a single np.fromstring call
+    '''
+    peak_counts=np.array([spectrum.count(':') for spectrum in spectra_text],dtype=np.int64)
+    offsets=np.zeros(len(spectra_text)+1,dtype=np.int64)
+    np.cumsum(peak_counts,out=offsets[1:])
+
+    all_values=np.fromstring(' '.join(spectra_text).replace(':',' '),dtype=np.float64,sep=' ')
+    #fromstring stops at the first token it cannot read instead of failing
+    if len(all_values)!=2*offsets[-1]:
+        raise ValueError('could not parse every mz:int pair of the spectra')
+
+    return offsets,all_values[0::2],all_values[1::2]
+
+def split_ragged_spectra(offsets,all_peaks):
+    '''
+    splits a per-peak array (along its first axis) into one view per spectrum
+    '''
+    return [all_peaks[offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]
+
+def parse_text_spectra_return_pairs(spectra_text):
+    '''
+    receives a list of stored spectra and returns a list of paired (n_peaks x 2) arrays.
+    text spectra are parsed together by parse_text_spectra_return_ragged and returned as views of one array,
+    binary spectra (annotations, so a single cluster) are decoded without copying
+    '''
+    output_list=[None]*len(spectra_text)
+    text_positions=list()
+    for i,spectrum in enumerate(spectra_text):
+        if is_binary_spectrum(spectrum):
+            output_list[i]=decode_spectrum_binary(spectrum)[0]
+        else:
+            text_positions.append(i)
+
+    offsets,all_mz,all_intensity=parse_text_spectra_return_ragged([spectra_text[i] for i in text_positions])
+    all_pairs=np.column_stack([all_mz,all_intensity])
+    for i,temp_spectrum_pair in zip(text_positions,split_ragged_spectra(offsets,all_pairs)):
+        output_list[i]=temp_spectrum_pair
+    return output_list
+
+
+def parse_text_spectra_return_parallel(spectra_text):
+    '''
+    like parse_text_spectra_return_pairs, but each spectrum is a parallel (2 x n_peaks) array
+    (mz in the first row, intensity in the second), views of one array for the whole batch
+    '''
+    offsets,all_mz,all_intensity=parse_text_spectra_return_ragged(spectra_text)
+    all_parallel=np.vstack([all_mz,all_intensity])
+    return [all_parallel[:,offsets[i]:offsets[i+1]] for i in range(len(offsets)-1)]